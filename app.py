@@ -1,31 +1,148 @@
-from aiogram import Bot, Dispatcher
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+import argparse
+import asyncio
+
+from aiogram import Dispatcher
 from aiogram.utils import executor
+from aiohttp import web
 
+import expiry
 import handlers
+import metrics
+import models
+import outbound
+import session
+import sharding
+import webhook
+from config import METRICS_HOST, METRICS_PORT, WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_MAX_CONNECTIONS, WEBHOOK_PATH
+from storage import PonyStorage
+from ticket_renderer import renderer
 
 try:
     from settings import TOKEN, ADMIN_ID
 except ImportError:
     exit('DO cp setting.py.default settings.py and set token.')
 
-bot = Bot(token=TOKEN, parse_mode='HTML')
+try:
+    from settings import WEBHOOK_HOST
+except ImportError:
+    WEBHOOK_HOST = None
+
+bot = outbound.ScheduledBot(token=TOKEN, parse_mode='HTML')
 
-storage = MemoryStorage()
+storage = PonyStorage(dumps=session.dumps, loads=session.loads)
 
 dp = Dispatcher(bot, storage=storage)
 
+sweeper = expiry.SessionSweeper(storage)
+dp.middleware.setup(expiry.ActivityMiddleware(sweeper))
+metrics.add_bot_collectors(bot, sweeper)
+
 handlers.register_handlers(dp, handlers.handlers_config)
 
 
 async def send_to_admin(*args):
     """Оповещение админа о запуске бота"""
     handlers.log.info('Бот запущен')
-    await bot.send_message(chat_id=ADMIN_ID, text='Бот запущен')
+    with outbound.priority(outbound.BULK):
+        await bot.send_message(chat_id=ADMIN_ID, text='Бот запущен')
+
+
+async def on_startup(*args):
+    """Восстановление прогресса после падения, запуск отложенной записи, очистки брошенных заказов
+    и пула отрисовки билетов"""
+    recovered = await models.run_in_db(models.state_buffer.recover)
+    if recovered:
+        handlers.log.info('Восстановлен прогресс %s пользователей', recovered)
+    await sweeper.seed()
+    dp['state_flush_task'] = asyncio.create_task(models.state_buffer.run())
+    dp['storage_flush_task'] = asyncio.create_task(storage.run())
+    dp['sweep_task'] = asyncio.create_task(sweeper.run(handlers.log))
+    if METRICS_PORT is not None:
+        # Без метрик бот работает, поэтому занятый порт не мешает запуску
+        try:
+            dp['metrics_runner'] = await metrics.start_server(METRICS_HOST, METRICS_PORT)
+        except OSError as exc:
+            handlers.log.error('Сервер метрик на %s:%s не запущен: %s', METRICS_HOST, METRICS_PORT, exc)
+    renderer.start()
+    await send_to_admin()
+
+
+async def set_webhook(*args):
+    """Регистрация webhook в Telegram, накопившиеся за время простоя обновления пропускаются"""
+    await bot.set_webhook(WEBHOOK_HOST + WEBHOOK_PATH, max_connections=WEBHOOK_MAX_CONNECTIONS,
+                          drop_pending_updates=True)
+
+
+async def on_startup_webhook(*args):
+    await set_webhook()
+    await on_startup()
+
+
+async def on_shutdown(*args):
+    """Сброс отложенных записей, завершение пулов БД и отрисовки билетов"""
+    dp['state_flush_task'].cancel()
+    dp['storage_flush_task'].cancel()
+    dp['sweep_task'].cancel()
+    if 'metrics_runner' in dp:
+        await dp['metrics_runner'].cleanup()
+    await models.state_buffer.flush()
+    await storage.close()
+    await bot.scheduler.close()
+    models.executor.shutdown(wait=True)
+    renderer.close()
+
+
+async def poll_sharded(supervisor):
+    await send_to_admin()
+    try:
+        await sharding.poll_updates(bot, supervisor)
+    finally:
+        await bot.scheduler.close()
+        await (await bot.get_session()).close()
+
+
+def run_sharded(workers, use_webhook):
+    """Основной процесс только принимает обновления и раздает их workers процессам-обработчикам"""
+    supervisor = sharding.Supervisor(workers, TOKEN, bot_class=outbound.ScheduledBot)
+    supervisor.start()
+    try:
+        if use_webhook:
+            front_app = sharding.create_front_app(supervisor)
+            front_app.on_startup.append(set_webhook)
+            front_app.on_startup.append(send_to_admin)
+            web.run_app(front_app, host=WEBAPP_HOST, port=WEBAPP_PORT)
+        else:
+            asyncio.run(poll_sharded(supervisor))
+    finally:
+        supervisor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Avia Ticket Telegram Bot')
+    parser.add_argument('--webhook', action='store_true',
+                        help='получать обновления через webhook (WEBHOOK_HOST в settings.py) вместо long polling')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='число процессов-обработчиков, обновления распределяются между ними по chat.id')
+    args = parser.parse_args()
+    if args.webhook and not WEBHOOK_HOST:
+        exit('Set WEBHOOK_HOST in settings.py to run in webhook mode.')
+
+    handlers.configure_logging(handlers.log)
+
+    if args.workers > 1:
+        run_sharded(args.workers, args.webhook)
+        return
+
+    models.warm_up()
+    if args.webhook:
+        executor.set_webhook(dp, WEBHOOK_PATH, on_startup=on_startup_webhook, on_shutdown=on_shutdown,
+                             web_app=webhook.create_app()).run_app(host=WEBAPP_HOST, port=WEBAPP_PORT)
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
 
 
 if __name__ == '__main__':
     try:
-        executor.start_polling(dp, skip_updates=True, on_startup=send_to_admin)
+        main()
     except BaseException as exc:
         handlers.log.exception(exc)
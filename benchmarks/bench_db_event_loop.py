@@ -0,0 +1,66 @@
+"""Задержка цикла событий при медленной БД.
+
+Запрос к медленной БД имитируется блокирующим ожиданием DB_DELAY секунд. Пока идут запросы,
+фоновая задача измеряет, насколько позже запланированного она просыпается.
+Сравниваются прямой вызов блокирующего кода в цикле событий и models.run_in_db.
+
+Запуск из корня проекта: python -m benchmarks.bench_db_event_loop
+"""
+import asyncio
+import statistics
+import time
+
+import models
+
+DB_DELAY = 0.05
+REQUESTS = 40
+CONCURRENCY = 10
+TICK = 0.005
+
+
+def slow_query(user_id):
+    time.sleep(DB_DELAY)
+    return user_id
+
+
+async def measure_lag(stop, lags):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - started - TICK)
+
+
+async def blocking_call(user_id):
+    slow_query(user_id)
+
+
+async def executor_call(user_id):
+    await models.run_in_db(slow_query, user_id)
+
+
+async def run(call):
+    stop = asyncio.Event()
+    lags = []
+    monitor = asyncio.create_task(measure_lag(stop, lags))
+    await asyncio.sleep(TICK)
+
+    started = time.perf_counter()
+    for batch in range(0, REQUESTS, CONCURRENCY):
+        await asyncio.gather(*(call(user_id) for user_id in range(batch, batch + CONCURRENCY)))
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await monitor
+    return elapsed, lags
+
+
+def main():
+    models.warm_up()
+    for name, call in (('в цикле событий', blocking_call), ('models.run_in_db', executor_call)):
+        elapsed, lags = asyncio.run(run(call))
+        print(f'{name}: {REQUESTS} запросов за {elapsed:.2f} с, задержка цикла событий '
+              f'p50 {statistics.median(lags) * 1000:.1f} мс, max {max(lags) * 1000:.1f} мс')
+
+
+if __name__ == '__main__':
+    main()
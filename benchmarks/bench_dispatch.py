@@ -0,0 +1,82 @@
+"""Стоимость выбора обработчика шага сценария на одно сообщение.
+
+Dispatcher проверяет фильтр обработчика некорректного ввода, затем корректного. Старые фильтры
+(лямбды с двойным strptime, списком range и некомпилированным regex) скопированы сюда
+и сравниваются с фильтрами StepValidator из handlers_config.
+
+Запуск из корня проекта: python -m benchmarks.bench_dispatch
+"""
+import datetime
+import re
+import time
+
+from aiogram import types
+
+import city_recognizer
+from handlers import handlers_config
+
+MESSAGES_PER_SAMPLE = 2000
+FLIGHT_DATE = (datetime.date.today() + datetime.timedelta(days=30)).strftime('%d-%m-%Y')
+
+
+def _legacy_ticket_date_check(message):
+    try:
+        if any([datetime.datetime.strptime(message.text, '%d-%m-%Y') < datetime.datetime.today(),
+                datetime.datetime.strptime(message.text, '%d-%m-%Y') >=
+                datetime.datetime.today() + datetime.timedelta(days=365)]):
+            return False
+        else:
+            return True
+    except ValueError:
+        return False
+
+
+LEGACY_FILTERS = {
+    'city_from': (lambda message: city_recognizer.recognize(message.text).city is None,
+                  lambda message: city_recognizer.recognize(message.text).city is not None),
+    'flight_date': (lambda message: not _legacy_ticket_date_check(message),
+                    lambda message: _legacy_ticket_date_check(message)),
+    'flight_choice': (
+        lambda message: not all([message.text.isdigit(), message.text in [str(x) for x in range(1, 6)]]),
+        lambda message: all([message.text.isdigit(), message.text in [str(x) for x in range(1, 6)]])),
+    'phone_number': (
+        lambda message: not re.match(r'^(\d{3})\D?(\d{3})\D?(\d{4})\D?(\d*)$', message.text),
+        lambda message: re.match(r'^(\d{3})\D?(\d{3})\D?(\d{4})\D?(\d*)$', message.text)),
+}
+
+SAMPLES = {
+    'city_from': ('Москва', 'Москваа'),
+    'flight_date': (FLIGHT_DATE, '32-13-2021'),
+    'flight_choice': ('3', '7'),
+    'phone_number': ('88005553535', '1234'),
+}
+
+
+def _compiled_filters():
+    filters = {}
+    for _, message_filter, state in handlers_config['state_handlers']:
+        filters.setdefault(state.state.split(':')[1], []).append(message_filter)
+    return filters
+
+
+def route(filters, messages):
+    invalid_filter, valid_filter = filters
+    started = time.perf_counter()
+    for message in messages:
+        if not invalid_filter(message):
+            valid_filter(message)
+    return (time.perf_counter() - started) / len(messages)
+
+
+def main():
+    compiled = _compiled_filters()
+    for state, texts in SAMPLES.items():
+        for text in texts:
+            messages = [types.Message(text=text) for _ in range(MESSAGES_PER_SAMPLE)]
+            legacy = route(LEGACY_FILTERS[state], messages)
+            current = route(compiled[state], messages)
+            print(f'{state} {text!r}: было {legacy * 1e6:.2f} мкс, стало {current * 1e6:.2f} мкс на сообщение')
+
+
+if __name__ == '__main__':
+    main()
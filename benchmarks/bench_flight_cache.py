@@ -0,0 +1,53 @@
+"""Доля попаданий общего кэша поиска рейсов и память на одну запись (маршрут и дата).
+
+USERS пользователей ищут рейсы по популярным направлениям на ближайшие DAYS дней
+(направления и даты выбираются с перекосом, как в реальной нагрузке). Сравнивается время
+поиска без кэша и через utils.flights_after.
+
+Запуск из корня проекта: python -m benchmarks.bench_flight_cache
+"""
+import datetime
+import random
+import time
+
+import routes
+import utils
+from flight_cache import flight_cache
+from timetable import from_minutes
+
+USERS = 20000
+DAYS = 60
+POPULAR_ROUTES = 50
+
+
+def main():
+    generator = random.Random(1)
+    pairs = [(city_from, city_to) for city_from in routes.CITIES for city_to in routes.CITIES
+             if city_from != city_to]
+    generator.shuffle(pairs)
+    pairs = pairs[:POPULAR_ROUTES]
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    start = utils.search_start(today + datetime.timedelta(days=1))
+    searches = [(*generator.choice(pairs[:generator.randint(1, POPULAR_ROUTES)]),
+                 start + int(generator.expovariate(1 / 10)) % DAYS * 24 * 60)
+                for _ in range(USERS)]
+
+    started = time.perf_counter()
+    for city_from, city_to, after in searches:
+        utils._search(city_from, city_to, from_minutes(after))
+    uncached = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for city_from, city_to, after in searches:
+        utils.flights_after(city_from, city_to, after)
+    cached = time.perf_counter() - started
+
+    stats = flight_cache.stats()
+    print(f'поисков: {USERS}, без кэша {uncached / USERS * 1e6:.1f} мкс, с кэшем {cached / USERS * 1e6:.1f} мкс '
+          f'на поиск')
+    print(f'попаданий {stats["hit_rate"]:.1%}, записей {stats["entries"]}, '
+          f'{stats["bytes_per_entry"]:.0f} байт на маршрут и дату, всего {stats["bytes"] / 1024:.0f} КиБ')
+
+
+if __name__ == '__main__':
+    main()
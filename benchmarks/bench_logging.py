@@ -0,0 +1,88 @@
+"""Время логирования в цикле событий на одно сообщение и на один заказ.
+
+Прежняя настройка: FileHandler пишет текст прямо из обработчика, заказ - пять вызовов log.info,
+на каждом шаге log.debug с f-строкой словаря данных FSM (форматируется и при выключенном debug).
+Новая: log_pipeline.LogPipeline, запись в очередь, JSON и файл в фоновом потоке, одно событие на заказ.
+Считается время в вызывающем потоке и общее время до записи всего в файл.
+
+Запуск из корня проекта: python -m benchmarks.bench_logging
+"""
+import logging
+import os
+import tempfile
+import time
+
+import log_pipeline
+import session
+
+BOOKINGS = 20000
+STEPS = 8
+
+
+def legacy_logger(path):
+    log = logging.getLogger('bench_logging_legacy')
+    log.propagate = False
+    file_handler = logging.FileHandler(path, encoding='utf8')
+    file_handler.setFormatter(log_pipeline.TEXT_FORMAT)
+    log.addHandler(file_handler)
+    log.setLevel(logging.INFO)
+    return log, file_handler
+
+
+def legacy_booking(log, data):
+    for _ in range(STEPS):
+        log.debug(f'{data}')
+    log.info(f'Вася заполнил(а) форму для заказа авиабилетов. ID {data["user_id"]}')
+    log.info(f'Выбранный рейс: {data["flight"]}')
+    log.info(f'Количество мест: {data["sits"]}')
+    log.info(f'Комментарий: {data["comment"]}')
+    log.info(f'Номер телефона: {data["phone_number"]}\n')
+
+
+def pipeline_booking(log, booking, data):
+    for _ in range(STEPS):
+        log.debug('%r', booking)
+    log.info('%s заполнил(а) форму для заказа авиабилетов. ID %s', 'Вася', data['user_id'],
+             extra=log_pipeline.event('booking', **data))
+
+
+def main():
+    booking = session.BookingSession(city_from='Москва', city_to='Лондон', flight_search=1000, chosen_flight=2,
+                                     sits=2, comment='У окна', phone_number='+79991234567')
+    data = {'user_id': 1234567890, 'flight': 'Москва 10:00 05-11-2021 - Лондон 14:00 05-11-2021\nчасов в полете - 4',
+            'sits': 2, 'comment': 'У окна', 'phone_number': '+79991234567'}
+    # Данные FSM прежнего формата с текстами пяти рейсов, которые попадали в log.debug
+    fsm_data = dict(data, **{str(index): data['flight'] for index in range(1, 6)})
+
+    with tempfile.TemporaryDirectory() as directory:
+        log, file_handler = legacy_logger(os.path.join(directory, 'legacy.log'))
+        started = time.perf_counter()
+        for _ in range(BOOKINGS):
+            legacy_booking(log, fsm_data)
+        legacy = time.perf_counter() - started
+        file_handler.close()
+
+        log = logging.getLogger('bench_logging_pipeline')
+        log.propagate = False
+        log.setLevel(logging.INFO)
+        pipeline = log_pipeline.LogPipeline(os.path.join(directory, 'pipeline.log'), queue_size=0, stream=False,
+                                            max_bytes=0, interval=0)
+        log.addHandler(pipeline.handler)
+        pipeline.start()
+        started = time.perf_counter()
+        for _ in range(BOOKINGS):
+            pipeline_booking(log, booking, data)
+        caller = time.perf_counter() - started
+        pipeline.stop()
+        total = time.perf_counter() - started
+
+    messages = BOOKINGS * (STEPS + 1)
+    print(f'заказов: {BOOKINGS}, шагов на заказ: {STEPS + 1}')
+    print(f'FileHandler в цикле событий: {legacy / BOOKINGS * 1e6:.1f} мкс на заказ, '
+          f'{legacy / messages * 1e6:.2f} мкс на сообщение')
+    print(f'очередь и фоновый поток:     {caller / BOOKINGS * 1e6:.1f} мкс на заказ, '
+          f'{caller / messages * 1e6:.2f} мкс на сообщение (до записи в файл {total / BOOKINGS * 1e6:.1f} мкс)')
+
+
+if __name__ == '__main__':
+    main()
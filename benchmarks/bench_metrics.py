@@ -0,0 +1,46 @@
+"""Накладные расходы metrics.timed на вызов корутины и время отдачи метрик Prometheus.
+
+Сравнивается CALLS вызовов пустой корутины без обертки и с оберткой, затем формируется
+текст /metrics для TIMERS таймеров (примерно столько их у бота: обработчики, models, отрисовка).
+
+Запуск из корня проекта: python -m benchmarks.bench_metrics
+"""
+import asyncio
+import time
+
+import metrics
+
+CALLS = 200000
+TIMERS = 40
+
+
+async def handler():
+    pass
+
+
+async def run(func):
+    started = time.perf_counter()
+    for _ in range(CALLS):
+        await func()
+    return time.perf_counter() - started
+
+
+def main():
+    registry = metrics.Registry()
+    plain = asyncio.run(run(handler))
+    timed = asyncio.run(run(registry.timed('handler')(handler)))
+    print(f'вызовов: {CALLS}, без обертки {plain / CALLS * 1e9:.0f} нс, с metrics.timed {timed / CALLS * 1e9:.0f} нс, '
+          f'накладные расходы {(timed - plain) / CALLS * 1e9:.0f} нс на вызов')
+
+    for index in range(TIMERS):
+        timer = registry.timer(f'handlers.step_{index}')
+        for seconds in (0.0005, 0.003, 0.02, 0.2):
+            timer.observe(seconds)
+    started = time.perf_counter()
+    text = registry.prometheus()
+    elapsed = time.perf_counter() - started
+    print(f'/metrics для {TIMERS} таймеров: {len(text) / 1024:.0f} КиБ за {elapsed * 1000:.2f} мс')
+
+
+if __name__ == '__main__':
+    main()
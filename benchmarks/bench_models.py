@@ -0,0 +1,92 @@
+"""Количество запросов к БД и время операций models до и после перехода на upsert.
+
+Старые реализации скопированы сюда для сравнения. Запросы считаются по логу SQL Pony
+(логгер pony.orm.sql), служебные BEGIN/COMMIT в него не попадают.
+
+Запуск из корня проекта (DB_CONFIG в settings.py, например SQLite):
+python -m benchmarks.bench_models
+"""
+import logging
+import time
+
+from pony.orm import db_session, set_sql_debug
+
+import models
+from models import UserState
+
+USERS = 300
+BASE_USER_ID = 2_000_000_000
+
+
+def legacy_create_user(user_id, username, user_state):
+    user_id = int(user_id)
+    with db_session:
+        if not UserState.get(user_id=user_id):
+            UserState(user_id=user_id, username=username, user_state=user_state)
+        else:
+            UserState.get(user_id=user_id).delete()
+            UserState(user_id=user_id, username=username, user_state=user_state)
+
+
+def legacy_update_user(user_id, user_state):
+    with db_session:
+        user = UserState.get(user_id=int(user_id))
+        if not user:
+            UserState(user_id=int(user_id), user_state=user_state)
+            user = UserState.get(user_id=int(user_id))
+        user.user_state = user_state
+
+
+def legacy_delete_user(user_id):
+    with db_session:
+        if UserState.get(user_id=int(user_id)):
+            UserState.get(user_id=int(user_id)).delete()
+
+
+class StatementCounter(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def measure(counter, func, *args):
+    counter.count = 0
+    started = time.perf_counter()
+    for user_id in range(BASE_USER_ID, BASE_USER_ID + USERS):
+        func(user_id, *args)
+    return counter.count / USERS, (time.perf_counter() - started) / USERS
+
+
+def main():
+    counter = StatementCounter()
+    # Без обработчиков у корневого логгера Pony печатает SQL в stdout, минуя logging
+    logging.root.addHandler(logging.NullHandler())
+    sql_log = logging.getLogger('pony.orm.sql')
+    sql_log.addHandler(counter)
+    sql_log.setLevel(logging.INFO)
+    sql_log.propagate = False
+    set_sql_debug(True)
+
+    scenarios = (
+        ('create_user (новый)', legacy_create_user, models._create_user, ('user', 'Город отправления')),
+        ('create_user (повторный)', legacy_create_user, models._create_user, ('user', 'Город отправления')),
+        ('update_user', legacy_update_user, models._update_user, ('Город назначения',)),
+        ('delete_user', legacy_delete_user, models._delete_user, ()),
+    )
+    results = {}
+    for version, index in (('до', 1), ('после', 2)):
+        for scenario in scenarios:
+            results[scenario[0], version] = measure(counter, scenario[index], *scenario[3])
+    set_sql_debug(False)
+
+    for name, *_ in scenarios:
+        (before_queries, before_time), (after_queries, after_time) = results[name, 'до'], results[name, 'после']
+        print(f'{name}: запросов {before_queries:.1f} -> {after_queries:.1f}, '
+              f'{before_time * 1e6:.0f} -> {after_time * 1e6:.0f} мкс')
+
+
+if __name__ == '__main__':
+    main()
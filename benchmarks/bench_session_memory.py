@@ -0,0 +1,101 @@
+"""Память на SESSIONS сессий заказа в хранилище FSM и размер записи в БД.
+
+Сравниваются данные FSM прежнего формата (словарь с текстами пяти рейсов), словарь после
+общего кэша рейсов и упакованная session.BookingSession. Все сессии на шаге ввода телефона,
+память считается tracemalloc, размер записи - длина того, что PonyStorage пишет в БД.
+
+Запуск из корня проекта: python -m benchmarks.bench_session_memory
+"""
+import datetime
+import gc
+import json
+import random
+import time
+import tracemalloc
+
+import routes
+import session
+import utils
+
+SESSIONS = 100000
+
+
+def _booking(generator, index, start):
+    city_from, city_to = generator.sample(routes.CITIES, 2)
+    return session.BookingSession(
+        city_from=city_from, city_to=city_to, flight_search=start + generator.randrange(365) * 24 * 60,
+        chosen_flight=generator.randint(1, 5), sits=generator.randint(1, 5),
+        comment=f'Комментарий {index}', phone_number=f'+7999{index:07d}',
+    )
+
+
+def legacy_data(booking):
+    """Данные FSM в прежнем формате: список рейсов и их тексты под ключами '1'..'5'"""
+    departure = datetime.datetime(2022, 1, 1) + datetime.timedelta(minutes=booking.flight_search % 525600)
+    flights = [(f'{departure + datetime.timedelta(days=day):%H:%M %d-%m-%Y}',
+                f'{departure + datetime.timedelta(days=day, hours=3):%H:%M %d-%m-%Y}', 3, ()) for day in range(5)]
+    data = {'city_from_check': False, 'city_from': booking.city_from, 'city_to': booking.city_to,
+            'flight_date': f'{departure:%d-%m-%Y}', 'flights_to_choose': flights}
+    for index, flight in enumerate(flights, start=1):
+        data[str(index)] = utils.format_flight(booking.city_from, booking.city_to, flight)
+    data.update({'chosen_flight': str(booking.chosen_flight), 'sits': str(booking.sits), 'comment': booking.comment,
+                 'correct_data': 'Да', 'phone_number': booking.phone_number})
+    return data
+
+
+def dict_data(booking):
+    """Данные FSM после общего кэша рейсов: только начало поиска и номер рейса"""
+    departure = datetime.datetime(2022, 1, 1) + datetime.timedelta(minutes=booking.flight_search % 525600)
+    return {'city_from': booking.city_from, 'city_to': booking.city_to, 'flight_date': f'{departure:%d-%m-%Y}',
+            'flight_search': booking.flight_search, 'chosen_flight': str(booking.chosen_flight),
+            'sits': str(booking.sits), 'comment': booking.comment, 'correct_data': 'Да',
+            'phone_number': booking.phone_number}
+
+
+def packed_data(booking):
+    return {session.SESSION_KEY: booking.pack()}
+
+
+def measure(build, bookings):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    storage = {index: build(booking) for index, booking in enumerate(bookings)}
+    elapsed = time.perf_counter() - started
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return storage, size, elapsed
+
+
+def main():
+    generator = random.Random(1)
+    start = utils.search_start(datetime.datetime.combine(datetime.date.today(), datetime.time()))
+    bookings = [_booking(generator, index, start) for index in range(SESSIONS)]
+
+    print(f'сессий: {SESSIONS}')
+    for name, build, dumps in (('словарь (прежний)', legacy_data, session.dumps),
+                               ('словарь', dict_data, session.dumps),
+                               ('BookingSession', packed_data, session.dumps)):
+        storage, size, elapsed = measure(build, bookings)
+        record = sum(len(dumps(data)) for data in storage.values()) / SESSIONS
+        print(f'{name:>18}: {size / 2 ** 20:7.1f} МиБ, {size / SESSIONS:5.0f} байт на сессию, '
+              f'запись в БД {record:4.0f} байт, сборка {elapsed / SESSIONS * 1e6:.1f} мкс')
+        del storage
+
+    packed = [booking.pack() for booking in bookings]
+    started = time.perf_counter()
+    for value in packed:
+        session.BookingSession.unpack(value).pack()
+    roundtrip = time.perf_counter() - started
+    dicts = [json.dumps(dict_data(booking), ensure_ascii=False).encode() for booking in bookings]
+    started = time.perf_counter()
+    for value in dicts:
+        json.dumps(json.loads(value), ensure_ascii=False).encode()
+    json_roundtrip = time.perf_counter() - started
+    print(f'чтение и запись сессии: BookingSession {roundtrip / SESSIONS * 1e6:.1f} мкс, '
+          f'JSON {json_roundtrip / SESSIONS * 1e6:.1f} мкс')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""Пропускная способность бота в зависимости от числа процессов-обработчиков.
+
+Обновления раздает sharding.Supervisor по chat.id, обработчики настоящие, вызовы Bot API
+отвечает OfflineBot без сети. USERS пользователей проходят начало сценария покупки билета,
+время считается от раздачи первого обновления до обработки последнего (запуск процессов не входит).
+Прирост ограничен числом ядер: os.cpu_count() печатается вместе с результатом.
+
+Запуск из корня проекта (DB_CONFIG в settings.py): python -m benchmarks.bench_sharding
+"""
+import datetime
+import os
+import time
+
+import sharding
+from fake_bot_api import OfflineBot, make_update
+
+USERS = 500
+BASE_USER_ID = 2_000_000_000
+WORKER_COUNTS = (1, 2, 4)
+STORAGES = ('memory', 'shared')
+FLIGHT_DATE = (datetime.date.today() + datetime.timedelta(days=30)).strftime('%d-%m-%Y')
+SCENARIO = ('/start', '/ticket', 'Москва', 'Лондон', FLIGHT_DATE, '/help', '/cancel')
+
+
+def bench(workers, storage_name):
+    supervisor = sharding.Supervisor(workers, '123456:ABCDEF', storage_name=storage_name, bot_class=OfflineBot,
+                                     log_level='WARNING')
+    supervisor.start()
+    update_id = 0
+    started = time.perf_counter()
+    try:
+        for text in SCENARIO:
+            for index in range(USERS):
+                update_id += 1
+                supervisor.dispatch(make_update(update_id, BASE_USER_ID + index, text))
+    finally:
+        processed = supervisor.close()
+    return processed / (time.perf_counter() - started)
+
+
+def main():
+    print(f'ядер: {os.cpu_count()}, обновлений: {USERS * len(SCENARIO)}')
+    for storage_name in STORAGES:
+        for workers in WORKER_COUNTS:
+            print(f'{storage_name}, процессов {workers}: {bench(workers, storage_name):.0f} обновлений/с')
+
+
+if __name__ == '__main__':
+    main()
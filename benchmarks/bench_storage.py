@@ -0,0 +1,59 @@
+"""Пропускная способность хранилищ FSM: PonyStorage с LRU-кэшем против MemoryStorage.
+
+Запуск из корня проекта (DB_CONFIG в settings.py): python -m benchmarks.bench_storage
+"""
+import asyncio
+import time
+
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from pony.orm import db_session, delete
+
+from models import FSMSession
+from storage import PonyStorage
+
+SESSIONS = 1000
+OPERATIONS = 50_000
+BASE_CHAT = 2_100_000_000
+DATA = {'city_from': 'Москва', 'city_to': 'Екатеринбург', 'flight_date': '05-11-2021', 'sits': '2'}
+
+
+async def bench(storage, operation):
+    started = time.perf_counter()
+    for index in range(OPERATIONS):
+        chat = BASE_CHAT + index % SESSIONS
+        if operation == 'get_state':
+            await storage.get_state(chat=chat, user=chat)
+        elif operation == 'get_data':
+            await storage.get_data(chat=chat, user=chat)
+        else:
+            await storage.set_data(chat=chat, user=chat, data=DATA)
+    return OPERATIONS / (time.perf_counter() - started)
+
+
+async def run():
+    storages = (('MemoryStorage', MemoryStorage()), ('PonyStorage', PonyStorage()))
+    for name, storage in storages:
+        for chat in range(BASE_CHAT, BASE_CHAT + SESSIONS):
+            await storage.set_state(chat=chat, user=chat, state='Steps:flight_date')
+            await storage.set_data(chat=chat, user=chat, data=DATA)
+        for operation in ('get_state', 'get_data', 'set_data'):
+            print(f'{name}.{operation}: {await bench(storage, operation):,.0f} операций/с')
+        if isinstance(storage, PonyStorage):
+            started = time.perf_counter()
+            flushed = await storage.flush()
+            print(f'{name}.flush: {flushed} сессий за {(time.perf_counter() - started) * 1000:.1f} мс')
+
+            cold = PonyStorage()
+            started = time.perf_counter()
+            for chat in range(BASE_CHAT, BASE_CHAT + SESSIONS):
+                await cold.get_data(chat=chat, user=chat)
+            print(f'{name}.get_data (холодный кэш): {SESSIONS / (time.perf_counter() - started):,.0f} операций/с')
+
+    # Только сессии прогона: chat хранится строкой, сравнение >= задело бы и настоящих пользователей
+    chats = [str(chat) for chat in range(BASE_CHAT, BASE_CHAT + SESSIONS)]
+    with db_session:
+        delete(session for session in FSMSession if session.chat in chats)
+
+
+if __name__ == '__main__':
+    asyncio.run(run())
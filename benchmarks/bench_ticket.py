@@ -0,0 +1,71 @@
+"""Скорость отрисовки билета и выделения памяти на один билет.
+
+Старая отрисовка (шаблон и шрифты с диска, подписи разделов на каждый билет) скопирована
+сюда для сравнения с ticket_renderer.render_ticket. Память Python считается через tracemalloc,
+память изображений Pillow - по счетчикам блоков Image.core.get_stats().
+
+Запуск из корня проекта: python -m benchmarks.bench_ticket
+"""
+import time
+import tracemalloc
+from io import BytesIO
+
+from PIL import Image, ImageDraw, ImageFont
+
+import ticket_renderer
+from ticket_renderer import (BLACK, DATA_FONT_PATH, DATA_FONT_SIZE, DATA_OFFSETS, SECTION_FONT_PATH,
+                             SECTION_FONT_SIZE, SECTION_OFFSETS, SECTIONS_TO_DRAW, TEMPLATE_PATH)
+
+TICKETS = 200
+TICKET_DATA = ('Вася', 'Москва 10:00 01-07-2027 - Лондон 14:00 01-07-2027', 2, '88005553535', 'SKILLBOX-AIRLINES')
+
+
+def legacy_render_ticket(ticket_data):
+    img = Image.open(TEMPLATE_PATH).convert('RGBA')
+    section_font = ImageFont.truetype(SECTION_FONT_PATH, SECTION_FONT_SIZE)
+    data_font = ImageFont.truetype(DATA_FONT_PATH, DATA_FONT_SIZE)
+    draw = ImageDraw.Draw(img)
+
+    for offset, text in zip(SECTION_OFFSETS, SECTIONS_TO_DRAW):
+        draw.text(xy=offset, text=text, fill=BLACK, font=section_font)
+
+    for offset, text in zip(DATA_OFFSETS, ticket_data):
+        draw.text(xy=offset, text=str(text), fill=BLACK, font=data_font)
+
+    temp_file = BytesIO()
+    img.save(temp_file, 'png')
+    return temp_file.getvalue()
+
+
+def bench(render):
+    render(TICKET_DATA)
+
+    started = time.perf_counter()
+    for _ in range(TICKETS):
+        render(TICKET_DATA)
+    tickets_per_second = TICKETS / (time.perf_counter() - started)
+
+    stats_before = Image.core.get_stats()
+    tracemalloc.start()
+    for _ in range(TICKETS):
+        render(TICKET_DATA)
+    python_blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    _, python_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats_after = Image.core.get_stats()
+    image_blocks = (stats_after['allocated_blocks'] + stats_after['reused_blocks']
+                    - stats_before['allocated_blocks'] - stats_before['reused_blocks'])
+
+    return tickets_per_second, image_blocks / TICKETS, python_blocks, python_peak
+
+
+def main():
+    for name, render in (('до (legacy)', legacy_render_ticket),
+                         ('после (render_ticket)', ticket_renderer.render_ticket)):
+        tickets_per_second, image_blocks, python_blocks, python_peak = bench(render)
+        print(f'{name}: {tickets_per_second:.0f} билетов/с, блоков изображений Pillow на билет {image_blocks:.1f}, '
+              f'живых объектов Python после {TICKETS} билетов {python_blocks}, пик {python_peak / 1024:.0f} КиБ')
+
+
+if __name__ == '__main__':
+    main()
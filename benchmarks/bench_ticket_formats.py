@@ -0,0 +1,60 @@
+"""Размер и время сжатия билета в разных форматах.
+
+Сжимается шаблон files/ticket_base.png и заполненный билет: полноцветный PNG, PNG с палитрой
+и optimize, JPEG и WebP с разным качеством. Отдельно сравнивается сохранение PNG в новый BytesIO
+и в переиспользуемый буфер ticket_renderer.encode.
+
+Запуск из корня проекта: python -m benchmarks.bench_ticket_formats
+"""
+import time
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+import ticket_renderer
+from ticket_renderer import BLACK, DATA_OFFSETS, TEMPLATE_PATH
+
+REPEATS = 50
+QUALITIES = (60, 80, 90)
+TICKET_DATA = ('Вася', 'Москва 10:00 01-07-2027 - Лондон 14:00 01-07-2027', 2, '88005553535', 'SKILLBOX-AIRLINES')
+
+
+def filled_ticket():
+    img = ticket_renderer._base_image().copy()
+    _, data_font = ticket_renderer._fonts()
+    draw = ImageDraw.Draw(img)
+    for offset, text in zip(DATA_OFFSETS, TICKET_DATA):
+        draw.text(xy=offset, text=str(text), fill=BLACK, font=data_font)
+    return img
+
+
+def timed(encode):
+    encoded = encode()
+    started = time.perf_counter()
+    for _ in range(REPEATS):
+        encode()
+    return (time.perf_counter() - started) / REPEATS * 1000, len(encoded)
+
+
+def fresh_png(img):
+    temp_file = BytesIO()
+    img.save(temp_file, 'png')
+    return temp_file.getvalue()
+
+
+def main():
+    modes = [('png', None), ('png8', None)]
+    modes += [(output_format, quality) for output_format in ('jpeg', 'webp') for quality in QUALITIES]
+
+    for name, img in (('шаблон', Image.open(TEMPLATE_PATH).convert('RGBA')), ('билет', filled_ticket())):
+        print(f'{name} {img.size[0]}x{img.size[1]}:')
+        for output_format, quality in modes:
+            milliseconds, size = timed(lambda: ticket_renderer.encode(img, output_format, quality))
+            label = output_format if quality is None else f'{output_format} q={quality}'
+            print(f'  {label:<20} {milliseconds:6.2f} мс, {size / 1024:6.1f} КиБ')
+        milliseconds, size = timed(lambda: fresh_png(img))
+        print(f'  {"png (новый BytesIO)":<20} {milliseconds:6.2f} мс, {size / 1024:6.1f} КиБ')
+
+
+if __name__ == '__main__':
+    main()
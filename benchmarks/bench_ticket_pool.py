@@ -0,0 +1,36 @@
+"""Пропускная способность отрисовки билетов в пуле процессов в зависимости от числа процессов.
+
+Запуск из корня проекта: python -m benchmarks.bench_ticket_pool
+"""
+import asyncio
+import os
+import time
+
+from ticket_renderer import TicketRenderer
+
+TICKETS = 200
+TICKET_DATA = ('Вася', 'Москва 10:00 01-07-2027 - Лондон 14:00 01-07-2027', 2, '88005553535', 'SKILLBOX-AIRLINES')
+
+
+async def bench(workers):
+    renderer = TicketRenderer(workers=workers, queue_size=workers * 4)
+    if workers:
+        renderer.start()
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(renderer.render(TICKET_DATA) for _ in range(TICKETS)))
+        return TICKETS / (time.perf_counter() - started)
+    finally:
+        renderer.close()
+
+
+def main():
+    cpus = os.cpu_count() or 1
+    print(f'Ядер: {cpus}')
+    for workers in sorted({0, 1, 2, 4, cpus, cpus * 2}):
+        name = f'процессов: {workers}' if workers else 'без пула (поток)'
+        print(f'{name}: {asyncio.run(bench(workers)):.0f} билетов/с')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Стоимость запроса "5 ближайших рейсов" к расписанию, в том числе с пересадками.
+
+Запуск из корня проекта: python -m benchmarks.bench_timetable
+"""
+import asyncio
+import datetime
+import time
+from itertools import cycle
+
+import connections
+import routes
+import utils
+from config import CITIES_AND_FLIGHT_TIME as SFT
+from timetable import timetable
+
+QUERIES = 100_000
+TARGET_QPS = 10_000
+
+
+def _routes():
+    return [(city_from, city_to) for city_from, destinations in SFT.items() if destinations
+            for city_to in destinations]
+
+
+def bench_next_departures(routes, dates):
+    started = time.perf_counter()
+    for (city_from, city_to), date in zip(cycle(routes), dates):
+        timetable.next_departures(city_from, city_to, date)
+    return (time.perf_counter() - started) / len(dates)
+
+
+def bench_connections(dates):
+    pairs = [(routes.CITIES[from_id], routes.CITIES[to_id]) for from_id, to_id in connections.CONNECTION_TABLE]
+    started = time.perf_counter()
+    for (city_from, city_to), date in zip(cycle(pairs), dates):
+        connections.plan(city_from, city_to, date)
+    return (time.perf_counter() - started) / len(dates)
+
+
+def bench_dispatcher(routes, dates):
+    async def run():
+        started = time.perf_counter()
+        for (city_from, city_to), date in zip(cycle(routes), dates):
+            await utils.dispatcher(city_from, city_to, date)
+        return (time.perf_counter() - started) / len(dates)
+
+    return asyncio.run(run())
+
+
+def main():
+    routes = _routes()
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    days = [today + datetime.timedelta(days=offset % 365) for offset in range(QUERIES)]
+
+    started = time.perf_counter()
+    timetable.build(today.date())
+    print(f'Разворачивание расписания: {(time.perf_counter() - started) * 1000:.1f} мс')
+
+    started = time.perf_counter()
+    connections.build_connection_table()
+    print(f'Предрасчет маршрутов с пересадками: {(time.perf_counter() - started) * 1000:.1f} мс')
+
+    for name, per_query in (
+            ('timetable.next_departures', bench_next_departures(routes, days)),
+            ('connections.plan', bench_connections(days[:QUERIES // 10])),
+            ('utils.dispatcher', bench_dispatcher(routes, days)),
+    ):
+        load = per_query * TARGET_QPS
+        print(f'{name}: {per_query * 1e6:.2f} мкс/запрос, до {1 / per_query:,.0f} запросов/с, '
+              f'при {TARGET_QPS} запросов/с занято {load:.1%} одного ядра')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Задержка и пропускная способность бота в режиме webhook без сети.
+
+Бот с настоящими обработчиками поднимается на локальном сервере aiohttp (webhook.create_app),
+запросы к Telegram Bot API отвечает FakeBotAPI на aresponses. USERS пользователей параллельно
+проходят короткий сценарий, время считается от отправки обновления до ответа webhook,
+то есть вместе со всеми запросами бота к API. Сравниваются разные пределы WEBHOOK_CONCURRENCY.
+
+Запуск из корня проекта (DB_CONFIG в settings.py, нужен пакет aresponses):
+python -m benchmarks.bench_webhook
+"""
+import asyncio
+import itertools
+import statistics
+import time
+
+from aiogram import Bot, Dispatcher
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.webhook import configure_app
+from aiohttp.test_utils import TestClient, TestServer
+
+import handlers
+import models
+import webhook
+from config import WEBHOOK_PATH
+from fake_bot_api import FakeBotAPI, make_update
+
+USERS = 200
+BASE_USER_ID = 2_000_000_000
+SCENARIO = ('/start', '/help', '/ticket', 'Москва', '/cancel')
+CONCURRENCY_LIMITS = (1, 10, 100)
+
+
+async def user_session(client, user_id, update_ids, latencies):
+    for text in SCENARIO:
+        started = time.perf_counter()
+        response = await client.post(WEBHOOK_PATH, json=make_update(next(update_ids), user_id, text))
+        await response.release()
+        latencies.append(time.perf_counter() - started)
+
+
+async def bench(concurrency):
+    bot = Bot(token='123456:ABCDEF')
+    dp = Dispatcher(bot, storage=MemoryStorage())
+    handlers.register_handlers(dp, handlers.handlers_config)
+    app = webhook.create_app(concurrency=concurrency)
+    configure_app(dp, app, WEBHOOK_PATH)
+
+    latencies = []
+    update_ids = itertools.count(1)
+    try:
+        async with FakeBotAPI() as api, TestClient(TestServer(app)) as client:
+            started = time.perf_counter()
+            await asyncio.gather(*(user_session(client, BASE_USER_ID + index, update_ids, latencies)
+                                   for index in range(USERS)))
+            elapsed = time.perf_counter() - started
+    finally:
+        await (await bot.get_session()).close()
+        await models.state_buffer.flush()
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    return len(latencies) / elapsed, quantiles[49], quantiles[94], sum(api.counts.values())
+
+
+async def main():
+    handlers.log.setLevel('WARNING')
+    for concurrency in CONCURRENCY_LIMITS:
+        updates_per_second, p50, p95, api_calls = await bench(concurrency)
+        print(f'WEBHOOK_CONCURRENCY={concurrency}: {updates_per_second:.0f} обновлений/с, '
+              f'p50 {p50 * 1000:.1f} мс, p95 {p95 * 1000:.1f} мс, запросов к API {api_calls}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,185 @@
+"""Нагрузочный прогон сценария покупки билета: тысячи пользователей одновременно, без сети.
+
+Настоящий Dispatcher с обработчиками из handlers.register_handlers получает types.Update,
+вызовы Bot API отвечает OfflineBot. Каждый пользователь проходит шаги Steps от /ticket до
+номера телефона и ждет ответа на сообщение, прежде чем отправить следующее. С вероятностью
+--invalid-rate на шаге сначала отправляется некорректный ввод (опечатка в городе, неверная дата,
+номер рейса и мест вне 1-5, неверный телефон), с вероятностью --abandon-rate пользователь отвечает
+"Нет" на проверке данных и заказ не оформляется. Печатается пропускная способность, p50/p99 времени
+обработки сообщения на каждом шаге и пиковая память процесса.
+
+БД берется из DB_CONFIG в settings.py, записи пользователей прогона удаляются после него.
+
+Запуск из корня проекта: python -m benchmarks.load_test --users 2000
+"""
+import argparse
+import asyncio
+import datetime
+import random
+import resource
+import time
+import tracemalloc
+
+from aiogram import Bot, Dispatcher, types
+from pony.orm import db_session, delete
+
+import connections
+import expiry
+import handlers
+import models
+import routes
+import sharding
+from fake_bot_api import OfflineBot, make_update
+from models import Registration, UserState
+from storage import PonyStorage
+from ticket_renderer import renderer
+
+# Registration.user_id - 32-битное целое, пользователи прогона не пересекаются с bench_sharding
+BASE_USER_ID = 2_100_000_000
+TOKEN = '123456:ABCDEF'
+STEPS = ('ticket', 'city_from', 'city_to', 'flight_date', 'flight_choice', 'sits_number', 'comment', 'validate_data',
+         'phone_number')
+
+
+def scenario(generator, invalid_rate, abandon_rate):
+    """Сообщения одного пользователя: список (шаг, текст)"""
+    city_from, city_to = generator.choice(ROUTES)
+    flight_date = datetime.date.today() + datetime.timedelta(days=generator.randint(1, 300))
+
+    def step(name, valid, invalid):
+        messages = []
+        if invalid is not None and generator.random() < invalid_rate:
+            messages.append((f'{name}_invalid', invalid))
+        messages.append((name, valid))
+        return messages
+
+    messages = [('ticket', '/ticket')]
+    messages += step('city_from', city_from, f'{city_from}ъ')
+    messages += step('city_to', city_to, f'{city_to}ъ')
+    messages += step('flight_date', flight_date.strftime('%d-%m-%Y'), '32-13-2021')
+    messages += step('flight_choice', str(generator.randint(1, 5)), '7')
+    messages += step('sits_number', str(generator.randint(1, 5)), '0')
+    messages += step('comment', f'Комментарий {generator.randrange(1000)}', None)
+    if generator.random() < abandon_rate:
+        return messages + [('validate_data_invalid', 'Нет')]
+    messages += step('validate_data', 'Да', None)
+    messages += step('phone_number', f'8999{generator.randrange(10 ** 7):07d}', '1234')
+    return messages
+
+
+ROUTES = [(city_from, city_to) for city_from in routes.CITIES for city_to in routes.CITIES
+          if city_from != city_to and connections.has_connection(city_from, city_to)]
+
+
+class LoadTest:
+    def __init__(self, users, concurrency, invalid_rate, abandon_rate, storage_name, seed):
+        self.users = users
+        self.concurrency = concurrency
+        self.invalid_rate = invalid_rate
+        self.abandon_rate = abandon_rate
+        self.storage_name = storage_name
+        self.generator = random.Random(seed)
+        self.latencies = {}
+        self.updates = 0
+        self.errors = 0
+
+    async def user(self, dp, index, slots):
+        user_id = BASE_USER_ID + index
+        messages = scenario(self.generator, self.invalid_rate, self.abandon_rate)
+        async with slots:
+            for step, text in messages:
+                self.updates += 1
+                update = types.Update(**make_update(self.updates, user_id, text))
+                started = time.perf_counter()
+                try:
+                    # Каждое обновление в своей задаче, как при polling: aiogram кэширует состояние FSM
+                    # в contextvars на время обработки обновления
+                    await asyncio.create_task(dp.process_update(update))
+                except Exception as exc:
+                    self.errors += 1
+                    handlers.log.exception(exc)
+                self.latencies.setdefault(step, []).append(time.perf_counter() - started)
+
+    async def run(self):
+        bot = OfflineBot(token=TOKEN, parse_mode='HTML')
+        storage = sharding.make_storage(self.storage_name, {})
+        dp = Dispatcher(bot, storage=storage)
+        handlers.register_handlers(dp, handlers.handlers_config)
+        dp.middleware.setup(expiry.ActivityMiddleware(expiry.SessionSweeper(storage)))
+        Bot.set_current(bot)
+        Dispatcher.set_current(dp)
+
+        background = [asyncio.create_task(models.state_buffer.run())]
+        if isinstance(storage, PonyStorage):
+            background.append(asyncio.create_task(storage.run()))
+        slots = asyncio.Semaphore(self.concurrency)
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(self.user(dp, index, slots) for index in range(self.users)))
+            elapsed = time.perf_counter() - started
+        finally:
+            for task in background:
+                task.cancel()
+            await models.state_buffer.flush()
+            await storage.close()
+            await (await bot.get_session()).close()
+        return elapsed, bot.counts
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def cleanup(users):
+    with db_session:
+        delete(user for user in UserState if user.user_id >= BASE_USER_ID and user.user_id < BASE_USER_ID + users)
+        delete(registration for registration in Registration
+               if registration.user_id >= BASE_USER_ID and registration.user_id < BASE_USER_ID + users)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон сценария покупки билета')
+    parser.add_argument('--users', type=int, default=1000, help='число пользователей')
+    parser.add_argument('--concurrency', type=int, default=1000,
+                        help='сколько пользователей проходят сценарий одновременно')
+    parser.add_argument('--invalid-rate', type=float, default=0.2,
+                        help='вероятность некорректного ввода на каждом шаге')
+    parser.add_argument('--abandon-rate', type=float, default=0.1,
+                        help='доля пользователей, которые отвечают "Нет" на проверке данных')
+    parser.add_argument('--storage', choices=sharding.STORAGES, default='memory', help='хранилище FSM')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='пиковая память Python-объектов через tracemalloc (замедляет прогон)')
+    args = parser.parse_args()
+
+    handlers.log.setLevel('WARNING')
+    models.state_buffer.journal_path = None
+    models.warm_up()
+    renderer.start()
+    if args.tracemalloc:
+        tracemalloc.start()
+    test = LoadTest(args.users, args.concurrency, args.invalid_rate, args.abandon_rate, args.storage, args.seed)
+    try:
+        elapsed, counts = asyncio.run(test.run())
+    finally:
+        renderer.close()
+        cleanup(args.users)
+
+    print(f'пользователей: {args.users}, одновременно: {min(args.concurrency, args.users)}, '
+          f'хранилище: {args.storage}')
+    print(f'обновлений: {test.updates} за {elapsed:.1f} с, {test.updates / elapsed:.0f} обновлений/с, '
+          f'ошибок: {test.errors}')
+    print(f'вызовов Bot API: {dict(counts)}')
+    for step in (name for step in STEPS for name in (f'{step}_invalid', step) if name in test.latencies):
+        latencies = test.latencies[step]
+        print(f'{step:>24}: {len(latencies):6} сообщ., p50 {percentile(latencies, 0.5) * 1000:7.2f} мс, '
+              f'p99 {percentile(latencies, 0.99) * 1000:7.2f} мс')
+    # ru_maxrss в Linux в килобайтах
+    print(f'пиковая память процесса: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} МиБ')
+    if args.tracemalloc:
+        print(f'пиковая память объектов Python: {tracemalloc.get_traced_memory()[1] / 2 ** 20:.0f} МиБ')
+
+
+if __name__ == '__main__':
+    main()
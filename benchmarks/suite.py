@@ -0,0 +1,241 @@
+"""Набор микробенчмарков горячих функций с базовыми значениями и порогом регрессии.
+
+Каждый случай сначала прогревается, число вызовов в серии подбирается так, чтобы серия шла
+не меньше MIN_SERIES_TIME секунд, затем REPEATS раз по кругу выполняется серия каждого случая.
+В результат попадает медиана и минимум времени одного вызова по сериям. --save сохраняет
+результаты в JSON, --baseline сравнивает их с сохраненными: если минимум (он меньше всего
+зависит от фоновой нагрузки машины) хуже базового больше чем на --margin, печатается регрессия
+и код выхода 1. Случаи models сравниваются только на той же БД (provider из DB_CONFIG),
+для них нужна локальная SQLite.
+
+Запуск из корня проекта:
+python -m benchmarks.suite --save benchmarks/baseline.json      # новое базовое значение
+python -m benchmarks.suite --baseline benchmarks/baseline.json  # проверка перед выкладкой
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import fnmatch
+import functools
+import json
+import platform
+import statistics
+import sys
+import time
+import unittest.mock
+
+import city_recognizer
+import connections
+import models
+import routes
+import utils
+import validators
+from generate_ticket import draw_ticket
+from config import CITIES_AND_FLIGHT_TIME
+from models import Registration
+from pony.orm import db_session, delete
+from ticket_cache import TicketCache
+from ticket_renderer import render_ticket
+from timetable import from_minutes
+
+REPEATS = 15
+WARMUP_CALLS = 3
+MIN_SERIES_TIME = 0.02
+DEFAULT_MARGIN = 0.25
+BASE_USER_ID = 2_050_000_000
+REFERENCE = 'reference'
+FLIGHT_DATE = (datetime.date.today() + datetime.timedelta(days=30)).strftime('%d-%m-%Y')
+SEARCH_START = utils.search_start(datetime.datetime.strptime(FLIGHT_DATE, '%d-%m-%Y'))
+TICKET_DATA = ('Вася', 'Москва 10:00 01-07-2027 - Лондон 14:00 01-07-2027', 2, '88005553535', 'SKILLBOX-AIRLINES')
+TRANSFER_ROUTE = ('Рио-де-Жанейро', 'Южно-Сахалинск')
+REGISTRATION = {'username': TICKET_DATA[0], 'chosen_flight': TICKET_DATA[1], 'sits': TICKET_DATA[2],
+                'phone_number': TICKET_DATA[3]}
+
+
+class UserIds:
+    """Новый id пользователя на каждый вызов, чтобы операции models не упирались в одну строку"""
+
+    def __init__(self):
+        self.next_id = BASE_USER_ID
+
+    def __call__(self):
+        self.next_id += 1
+        return self.next_id
+
+
+user_ids = UserIds()
+
+
+async def _create_and_delete_user():
+    user_id = user_ids()
+    await models.create_user(user_id, 'bench', 'Город отправления')
+    await models.delete_user(user_id)
+
+
+async def _update_user():
+    await models.update_user(BASE_USER_ID, 'Выбор рейса', models.STRONG)
+
+
+async def _register_and_get():
+    registration = await models.register_user([BASE_USER_ID, 'bench', TICKET_DATA[1], 2, 'комментарий',
+                                               TICKET_DATA[3]])
+    await models.get_registration(registration['id'])
+
+
+def _reference():
+    """Эталонная нагрузка на чистом Python, по ней нормируются остальные случаи"""
+    return sum(index * index for index in range(1000))
+
+
+@contextlib.contextmanager
+def _uncached_tickets():
+    with unittest.mock.patch('generate_ticket.ticket_cache', TicketCache(max_bytes=0)):
+        yield
+
+
+@functools.lru_cache(maxsize=None)
+def _transfer_route_table():
+    """Таблица маршрутов без прямого рейса TRANSFER_ROUTE и пересадки, предрасчитанные по ней"""
+    table = {city: dict(destinations or {}) for city, destinations in CITIES_AND_FLIGHT_TIME.items()}
+    table[TRANSFER_ROUTE[0]].pop(TRANSFER_ROUTE[1], None)
+    table[TRANSFER_ROUTE[1]].pop(TRANSFER_ROUTE[0], None)
+    cities, city_ids, flight_times, closed_pairs = routes.build_route_table(table)
+    patched = {'CITIES': cities, 'CITY_IDS': city_ids, 'FLIGHT_TIMES': flight_times, 'CLOSED_PAIRS': closed_pairs,
+               'CITIES_COUNT': len(cities)}
+    with unittest.mock.patch.multiple(routes, **patched):
+        return patched, connections.build_connection_table()
+
+
+@contextlib.contextmanager
+def _without_direct_flight():
+    """Между городами TRANSFER_ROUTE летают только с пересадками: в настоящей таблице у них есть прямой рейс"""
+    patched, connection_table = _transfer_route_table()
+    with unittest.mock.patch.multiple(routes, **patched), \
+            unittest.mock.patch('connections.CONNECTION_TABLE', connection_table):
+        yield
+
+
+# Случаи: имя -> (функция без аргументов, корутина ли она, контекст на время замера, группа)
+CASES = {
+    REFERENCE: (_reference, False, None, 'cpu'),
+    'utils.dispatcher': (lambda: utils.dispatcher('Москва', 'Екатеринбург', datetime.datetime.strptime(
+        FLIGHT_DATE, '%d-%m-%Y')), True, None, 'cpu'),
+    'utils._search': (lambda: utils._search('Москва', 'Екатеринбург', from_minutes(SEARCH_START)), False, None, 'cpu'),
+    'utils._search.transfers': (lambda: utils._search(*TRANSFER_ROUTE, from_minutes(SEARCH_START)),
+                                False, _without_direct_flight, 'cpu'),
+    'validators.flight_date': (lambda: validators.flight_date(FLIGHT_DATE), False, None, 'cpu'),
+    'validators.flight_date.invalid': (lambda: validators.flight_date('32-13-2021'), False, None, 'cpu'),
+    'validators.city': (lambda: validators.city('Москва'), False, None, 'cpu'),
+    'city_recognizer.match': (lambda: city_recognizer.recognizer.recognize('в Москве'), False, None, 'cpu'),
+    'city_recognizer.closest': (lambda: city_recognizer.recognizer.recognize('Масква'), False, None, 'cpu'),
+    'validators.phone_number': (lambda: validators.phone_number('88005553535'), False, None, 'cpu'),
+    'ticket_renderer.render_ticket': (lambda: render_ticket(TICKET_DATA), False, None, 'cpu'),
+    'generate_ticket.draw_ticket': (lambda: draw_ticket(REGISTRATION), True, _uncached_tickets, 'cpu'),
+    'generate_ticket.draw_ticket.cached': (lambda: draw_ticket(REGISTRATION), True, None, 'cpu'),
+    'models.create_user+delete_user': (_create_and_delete_user, True, None, 'db'),
+    'models.update_user': (_update_user, True, None, 'db'),
+    'models.register_user+get_registration': (_register_and_get, True, None, 'db'),
+}
+
+
+async def _series(func, is_async, number):
+    started = time.perf_counter()
+    if is_async:
+        for _ in range(number):
+            await func()
+    else:
+        for _ in range(number):
+            func()
+    return time.perf_counter() - started
+
+
+async def calibrate(func, is_async, warmup=WARMUP_CALLS, min_time=MIN_SERIES_TIME):
+    """Прогрев и число вызовов в серии, при котором серия идет не меньше min_time"""
+    await _series(func, is_async, warmup)
+    number = 1
+    while await _series(func, is_async, number) < min_time:
+        number *= 2
+    return number
+
+
+async def run(names, repeats):
+    """Серии всех случаев по кругу: медленные периоды машины достаются всем случаям поровну"""
+    numbers = {}
+    for name in names:
+        func, is_async, context, _ = CASES[name]
+        with context() if context is not None else contextlib.nullcontext():
+            numbers[name] = await calibrate(func, is_async)
+    times = {name: [] for name in names}
+    for _ in range(repeats):
+        for name in names:
+            func, is_async, context, _ = CASES[name]
+            with context() if context is not None else contextlib.nullcontext():
+                times[name].append(await _series(func, is_async, numbers[name]) / numbers[name])
+    results = {}
+    for name in names:
+        results[name] = {'median': statistics.median(times[name]), 'min': min(times[name]), 'number': numbers[name],
+                         'repeats': repeats}
+        print(f'{name:>40}: {results[name]["min"] * 1e6:12.2f} мкс (медиана {results[name]["median"] * 1e6:.2f})')
+    return results
+
+
+def environment():
+    return {'python': platform.python_version(), 'machine': platform.machine(), 'system': platform.system(),
+            'db': models.db.provider_name}
+
+
+def compare(baseline, report, margin):
+    """Регрессии: [(имя, базовое время, текущее время)] для случаев, которые медленнее базы больше чем на margin"""
+    same_db = baseline.get('environment', {}).get('db') == report['environment']['db']
+    speed = report['results'][REFERENCE]['min'] / baseline['results'][REFERENCE]['min']
+    regressions = []
+    for name, result in report['results'].items():
+        base = baseline['results'].get(name)
+        if name == REFERENCE or base is None or (CASES[name][3] == 'db' and not same_db):
+            continue
+        if result['min'] > base['min'] * speed * (1 + margin):
+            regressions.append((name, base['min'] * speed, result['min']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Микробенчмарки горячих функций бота')
+    parser.add_argument('--save', help='сохранить результаты в JSON')
+    parser.add_argument('--baseline', help='JSON с базовыми значениями для сравнения')
+    parser.add_argument('--margin', type=float, default=DEFAULT_MARGIN,
+                        help='допустимое замедление относительно базы (0.25 - на 25%%)')
+    parser.add_argument('--only', default='*', help='шаблон имен случаев, например "utils.*"')
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    args = parser.parse_args()
+
+    names = [REFERENCE] + [name for name in CASES if name != REFERENCE and fnmatch.fnmatch(name, args.only)]
+    models.state_buffer.journal_path = None
+    models.warm_up()
+    try:
+        results = asyncio.run(run(names, args.repeats))
+    finally:
+        models._delete_users(range(BASE_USER_ID, user_ids.next_id + 1))
+        with db_session:
+            delete(registration for registration in Registration if registration.user_id == BASE_USER_ID)
+        models.executor.shutdown(wait=True)
+    report = {'environment': environment(), 'results': results}
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf8') as output:
+            json.dump(report, output, ensure_ascii=False, indent=2, sort_keys=True)
+            output.write('\n')
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf8') as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(baseline, report, args.margin)
+        for name, base, current in regressions:
+            print(f'РЕГРЕССИЯ {name}: {base * 1e6:.2f} -> {current * 1e6:.2f} мкс ({current / base - 1:+.0%})')
+        if regressions:
+            sys.exit(1)
+        print(f'Регрессий нет (допуск {args.margin:.0%})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import re
+from collections import namedtuple
+from functools import lru_cache
+from heapq import nlargest
+
+import routes
+
+# Окончания падежей, которые допускаются после основы названия города
+CASE_ENDINGS = ('а', 'я', 'ы', 'и', 'е', 'у', 'ю', 'ой', 'ей', 'ом', 'ем', 'ою', 'ею', 'ах', 'ях', 'ам', 'ям')
+# Окончания, которые отбрасываются, чтобы получить основу (Москва -> москв, Афины -> афин)
+STEM_ENDINGS = ('а', 'я', 'ы', 'ь', 'й')
+PREPOSITIONS = re.compile(r'^(?:в|во|из|до|на)\s+')
+SEPARATORS = re.compile(r'[\s\-–—]+')
+
+CONFIRMATION_SIMILARITY = 0.5
+
+Recognition = namedtuple('Recognition', ('city', 'suggestions', 'similarity'))
+
+
+def normalize(text):
+    """Приведение ввода к нижнему регистру, без предлога и с дефисами вместо пробелов"""
+    text = text.strip().lower().replace('ё', 'е')
+    text = PREPOSITIONS.sub('', text)
+    return SEPARATORS.sub('-', text)
+
+
+def trigrams(text):
+    padded = f'  {text} '
+    return {padded[index:index + 3] for index in range(len(padded) - 2)}
+
+
+def city_pattern(city):
+    """Регулярное выражение для падежных форм названия города"""
+    name = normalize(city)
+    stem = name[:-1] if name.endswith(STEM_ENDINGS) else name
+    if stem == name and name.endswith(('о', 'е', 'у', 'и')):
+        # Несклоняемые названия: Токио, Баку, Нью-Дели
+        return re.escape(name)
+    return f'{re.escape(stem)}(?:{"|".join(CASE_ENDINGS + STEM_ENDINGS)})?'
+
+
+class CityRecognizer:
+    """Распознавание города по вводу пользователя: падежные формы и ближайшие по триграммам"""
+
+    def __init__(self, cities):
+        self.cities = tuple(cities)
+        self.pattern = re.compile('|'.join(
+            f'(?P<city{index}>{city_pattern(city)})' for index, city in enumerate(self.cities)
+        ))
+        self.city_trigrams = [len(trigrams(normalize(city))) for city in self.cities]
+        self.index = {}
+        for city_id, city in enumerate(self.cities):
+            for trigram in trigrams(normalize(city)):
+                self.index.setdefault(trigram, []).append(city_id)
+
+    def match(self, text):
+        """Город, если ввод - одна из форм его названия, иначе None"""
+        match = self.pattern.fullmatch(normalize(text))
+        return self.cities[int(match.lastgroup[4:])] if match else None
+
+    def closest(self, text, k=5):
+        """k ближайших городов с коэффициентом сходства Жаккара по триграммам"""
+        query = trigrams(normalize(text))
+        overlaps = {}
+        for trigram in query:
+            for city_id in self.index.get(trigram, ()):
+                overlaps[city_id] = overlaps.get(city_id, 0) + 1
+        similarities = (
+            (overlap / (len(query) + self.city_trigrams[city_id] - overlap), -city_id)
+            for city_id, overlap in overlaps.items()
+        )
+        return [(self.cities[-negative_id], similarity) for similarity, negative_id in nlargest(k, similarities)]
+
+    def recognize(self, text, k=5):
+        city = self.match(text)
+        if city is not None:
+            return Recognition(city, (city,), 1.0)
+        closest = self.closest(text, k)
+        if len(closest) < k:
+            # Добиваем подсказки городами без общих триграмм, чтобы клавиатура была полной
+            known = {city for city, _ in closest}
+            closest += [(city, 0.0) for city in self.cities if city not in known][:k - len(closest)]
+        return Recognition(None, tuple(city for city, _ in closest), closest[0][1])
+
+
+recognizer = CityRecognizer(routes.CITIES)
+
+
+@lru_cache(maxsize=1024)
+def recognize(text):
+    """Распознавание с кэшем: фильтры и обработчики одного сообщения разделяют результат"""
+    return recognizer.recognize(text)
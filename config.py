@@ -1,4 +1,5 @@
-# Города и время полета до них в часах
+# Города и время полета до них в часах. Нет пары - нет прямого рейса, но можно долететь с пересадками,
+# None - между городами нет сообщения, в том числе с пересадками
 CITIES_AND_FLIGHT_TIME = {
     'Москва': {'Екатеринбург': 2, 'Санкт-Петербург': 1, 'Барнаул': 4, 'Владивосток': 9, 'Самара': 2, 'Крым': 3,
                'Южно-Сахалинск': 9, 'Ростов': 2, 'Киев': 5, 'Минск': 2, 'Баку': 3, 'Ереван': 3, 'Нур-Султан': 4,
@@ -41,7 +42,7 @@ CITIES_AND_FLIGHT_TIME = {
     'Южно-Сахалинск': {'Ростов': 13, 'Киев': 18, 'Минск': 13, 'Баку': 22, 'Ереван': 14, 'Нур-Султан': 13, 'Душанбе': 11,
                        'Ташкент': 11, 'Лондон': 16, 'Амстердам': 15, 'Токио': 3, 'Пекин': 15, 'Нью-Дели': 23,
                        'Анталия': 18, 'Никосия': 19, 'Афины': 18, 'Рим': 15, 'Нью-Йорк': 22, 'Вашингтон': 23,
-                       'Лос-Анджелес': 17, 'Сен-Тропе': 18, 'Рио-де-Жанейро': 33},
+                       'Лос-Анджелес': 17, 'Сен-Тропе': None, 'Рио-де-Жанейро': 33},
 
     'Ростов': {'Киев': 9, 'Минск': 3, 'Баку': 8, 'Ереван': 2, 'Нур-Султан': 7, 'Душанбе': 4,
                'Ташкент': 8, 'Лондон': 8, 'Амстердам': 8, 'Токио': 15, 'Пекин': 22, 'Нью-Дели': 11,
@@ -112,3 +113,113 @@ CITIES_AND_FLIGHT_TIME = {
     'Рио-де-Жанейро': None
 
 }
+
+# Расписание рейсов по умолчанию: дни недели (0 - понедельник) и время вылета
+DEFAULT_SCHEDULE = {'weekdays': (0, 1, 2, 3, 4, 5, 6), 'times': ('06:40', '11:20', '15:50', '19:10', '23:30')}
+
+# Расписание отдельных направлений: по дням недели (weekdays) или по дням месяца (monthdays)
+FLIGHT_SCHEDULES = {
+    ('Москва', 'Лондон'): {'weekdays': (0, 2), 'times': ('10:00',)},
+    ('Лондон', 'Москва'): {'weekdays': (1, 3), 'times': ('14:00',)},
+    ('Лондон', 'Амстердам'): {'monthdays': (10, 20), 'times': ('15:30',)},
+    ('Амстердам', 'Лондон'): {'monthdays': (11, 21), 'times': ('09:45',)},
+}
+
+# На сколько дней вперед разворачивается расписание (год продаж + запас для редких рейсов)
+TIMETABLE_HORIZON_DAYS = 365 + 120
+
+# Поиск рейсов с пересадками: максимум пересадок, минимальное время на пересадку
+# и сколько статически кратчайших маршрутов проверять по расписанию
+MAX_TRANSFERS = 2
+MIN_TRANSFER_MINUTES = 60
+CONNECTION_CANDIDATES = 10
+
+# Пул потоков для запросов к БД: сколько запросов выполняется одновременно
+DB_WORKERS = 4
+
+# Отложенная запись прогресса пользователей (UserState): как часто и какими пачками сбрасывать в БД,
+# журнал для восстановления несохраненных изменений после падения (None - без журнала) и как часто
+# дописывать в него накопленные изменения (столько секунд изменений может потеряться при падении)
+STATE_FLUSH_INTERVAL = 2.0
+STATE_FLUSH_SIZE = 200
+STATE_JOURNAL_PATH = 'user_state.journal'
+STATE_JOURNAL_INTERVAL = 0.2
+
+# Хранилище состояний FSM: сколько сессий держать в памяти и как часто сбрасывать изменения в БД
+FSM_CACHE_SIZE = 10000
+FSM_FLUSH_INTERVAL = 1.0
+FSM_FLUSH_SIZE = 500
+
+# Отрисовка билетов в пуле процессов: число процессов, сколько билетов может ждать в очереди
+# и сколько секунд ждать билет, прежде чем отрисовать его в потоке
+TICKET_WORKERS = 2
+TICKET_QUEUE_SIZE = 32
+TICKET_RENDER_TIMEOUT = 5.0
+
+# Кэш билетов: сколько байт отрисованных PNG держать в памяти
+# и для скольких билетов помнить file_id, который вернул Telegram после первой отправки
+TICKET_CACHE_BYTES = 32 * 1024 * 1024
+TICKET_FILE_ID_CACHE_SIZE = 100000
+
+# Формат картинки билета: png (полноцветный PNG), png8 (PNG с палитрой и optimize), jpeg или webp,
+# и качество для jpeg и webp. Сравнение размера и скорости: python -m benchmarks.bench_ticket_formats
+TICKET_FORMAT = 'png'
+TICKET_QUALITY = 80
+
+# Режим webhook (python app.py --webhook): путь и адрес, на котором слушает aiohttp,
+# сколько обновлений обрабатывать одновременно, предельный размер тела запроса в байтах
+# и сколько соединений Telegram может открыть к webhook. Адрес бота снаружи - WEBHOOK_HOST в settings.py
+WEBHOOK_PATH = '/webhook'
+WEBAPP_HOST = '0.0.0.0'
+WEBAPP_PORT = 8080
+WEBHOOK_CONCURRENCY = 100
+WEBHOOK_MAX_BODY_SIZE = 64 * 1024
+WEBHOOK_MAX_CONNECTIONS = 40
+
+# Запуск с несколькими процессами-обработчиками (python app.py --workers N): хранилище состояний FSM
+# (pony - БД, shared - общий словарь процессов для локального запуска, memory - память процесса)
+# и сколько обновлений каждый процесс обрабатывает одновременно. Очередь процесса ограничена WORKER_QUEUE_SIZE
+# обновлениями: когда она полна, прием обновления сразу завершается ошибкой (webhook отвечает 503, long polling
+# запрашивает обновления заново через WORKER_RETRY_DELAY секунд).
+# Процессы должны сообщить о готовности за WORKER_START_TIMEOUT секунд
+FSM_STORAGE = 'pony'
+WORKER_CONCURRENCY = 100
+WORKER_QUEUE_SIZE = 10000
+WORKER_RETRY_DELAY = 1.0
+WORKER_START_TIMEOUT = 120.0
+
+# Лимиты исходящих сообщений Telegram: сообщений в секунду всего и в один чат, сколько можно отправить
+# подряд, сколько раз повторять отправку после ответа 429 и для скольких чатов хранить счетчики
+SEND_GLOBAL_RATE = 30
+SEND_GLOBAL_BURST = 30
+SEND_CHAT_RATE = 1
+SEND_CHAT_BURST = 3
+SEND_MAX_RETRIES = 3
+SEND_TRACKED_CHATS = 10000
+
+# Общий кэш результатов поиска рейсов (маршрут и дата): сколько секунд хранить результат
+# и сколько поисков держать в памяти
+FLIGHT_CACHE_TTL = 600
+FLIGHT_CACHE_SIZE = 10000
+
+# Очистка брошенных заказов: через сколько секунд без сообщений удалять сессию FSM и строку UserState,
+# как часто проверять и сколько пользователей удалять одним запросом
+SESSION_TTL = 24 * 60 * 60
+SESSION_SWEEP_INTERVAL = 5 * 60
+SESSION_SWEEP_BATCH = 1000
+
+# Лог бота: JSON-строки в файле, который ротируется по размеру и раз в LOG_ROTATE_INTERVAL секунд,
+# сколько старых файлов хранить и сколько записей может ждать фонового потока записи
+LOG_PATH = 'aviaticketbot_messages.log'
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_ROTATE_INTERVAL = 24 * 60 * 60
+LOG_BACKUP_COUNT = 7
+LOG_QUEUE_SIZE = 10000
+
+# Метрики: границы интервалов гистограммы времени вызовов в секундах, путь и адрес HTTP-сервера
+# метрик Prometheus. По умолчанию сервер не запускается (None): порт выбирается при развертывании так, чтобы
+# не совпасть с другими экспортерами на машине. Процесс-обработчик N при --workers слушает METRICS_PORT + 1 + N
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_PATH = '/metrics'
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = None
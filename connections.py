@@ -0,0 +1,93 @@
+from bisect import bisect_left
+from heapq import nsmallest
+from itertools import permutations
+
+import routes
+from config import CONNECTION_CANDIDATES, MAX_TRANSFERS, MIN_TRANSFER_MINUTES
+from timetable import timetable, to_minutes
+
+
+def _path_flight_time(path):
+    """Суммарное время в воздухе по маршруту или None, если на каком-то участке нет рейса"""
+    total = 0
+    for from_id, to_id in zip(path, path[1:]):
+        flight_time = routes.flight_time_by_id(from_id, to_id)
+        if flight_time is None:
+            return None
+        total += flight_time
+    return total
+
+
+def static_paths(from_id, to_id, max_transfers=MAX_TRANSFERS, limit=CONNECTION_CANDIDATES):
+    """Кратчайшие маршруты с пересадками без учета расписания (нижняя оценка времени в пути)"""
+    others = [city_id for city_id in range(routes.CITIES_COUNT) if city_id not in (from_id, to_id)]
+    candidates = []
+    for transfers in range(1, max_transfers + 1):
+        for via in permutations(others, transfers):
+            path = (from_id, *via, to_id)
+            flight_time = _path_flight_time(path)
+            if flight_time is not None:
+                candidates.append((flight_time * 60 + transfers * MIN_TRANSFER_MINUTES, path))
+    return [path for _, path in nsmallest(limit, candidates)]
+
+
+def build_connection_table():
+    """Предрасчет маршрутов с пересадками для всех пар городов без прямого рейса, кроме пар без сообщения"""
+    return {
+        (from_id, to_id): static_paths(from_id, to_id)
+        for from_id in range(routes.CITIES_COUNT)
+        for to_id in range(routes.CITIES_COUNT)
+        if from_id != to_id and routes.flight_time_by_id(from_id, to_id) is None
+        and (from_id, to_id) not in routes.CLOSED_PAIRS
+    }
+
+
+CONNECTION_TABLE = build_connection_table()
+
+
+def has_connection(city_from, city_to):
+    """Есть ли между городами прямой рейс или рейс с пересадками"""
+    if routes.has_route(city_from, city_to):
+        return True
+    return bool(CONNECTION_TABLE.get((routes.CITY_IDS.get(city_from), routes.CITY_IDS.get(city_to))))
+
+
+def _arrival(path, departure):
+    """Самое раннее прибытие по маршруту при вылете первым участком в departure (минуты от EPOCH)"""
+    moment = departure + routes.flight_time_by_id(path[0], path[1]) * 60
+    for from_id, to_id in zip(path[1:], path[2:]):
+        departures = timetable.departures(routes.CITIES[from_id], routes.CITIES[to_id])
+        index = bisect_left(departures, moment + MIN_TRANSFER_MINUTES)
+        if index == len(departures):
+            return None
+        moment = departures[index] + routes.flight_time_by_id(from_id, to_id) * 60
+    return moment
+
+
+def plan(city_from, city_to, after, count=5):
+    """Ближайшие count вариантов перелета с пересадками не раньше момента after.
+
+    Для каждого статически кратчайшего маршрута считается прибытие по расписанию,
+    варианты, которые вылетают раньше, но прилетают не раньше другого, отбрасываются.
+    Возвращает список (вылет, прилет, маршрут) с временем в минутах от EPOCH.
+    """
+    paths = CONNECTION_TABLE.get((routes.CITY_IDS.get(city_from), routes.CITY_IDS.get(city_to)), ())
+    after_minutes = to_minutes(after)
+
+    best = {}
+    for path in paths:
+        departures = timetable.departures(routes.CITIES[path[0]], routes.CITIES[path[1]])
+        index = bisect_left(departures, after_minutes)
+        # Часть ранних вылетов отсеется как невыгодная, поэтому берем их с запасом
+        for departure in departures[index:index + count * 3]:
+            arrival = _arrival(path, departure)
+            if arrival is not None and (departure not in best or arrival < best[departure][1]):
+                best[departure] = (departure, arrival, path)
+
+    itineraries = []
+    earliest_arrival = None
+    for departure, arrival, path in sorted(best.values(), reverse=True):
+        if earliest_arrival is None or arrival < earliest_arrival:
+            earliest_arrival = arrival
+            itineraries.append((departure, arrival, path))
+    return itineraries[::-1][:count]
@@ -0,0 +1,126 @@
+import asyncio
+import sys
+import time
+from collections import OrderedDict
+
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+import models
+from config import SESSION_SWEEP_BATCH, SESSION_SWEEP_INTERVAL, SESSION_TTL
+
+
+def deep_size(value):
+    """Приблизительный размер объекта в памяти вместе с вложенными словарями, списками и строками"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(key) + deep_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(deep_size(item) for item in value)
+    return size
+
+
+def _evict_memory(storage, chat, user):
+    chat, user = map(str, storage.check_address(chat=chat, user=user))
+    users = storage.data.get(chat)
+    if users is None or user not in users:
+        return None
+    record = users.pop(user)
+    if not users:
+        del storage.data[chat]
+    return record
+
+
+async def evict(storage, chat, user):
+    """Удаление сессии из хранилища FSM, возвращает примерный размер удаленной записи в байтах"""
+    if isinstance(storage, MemoryStorage):
+        record = _evict_memory(storage, chat, user)
+    else:
+        record = await storage.evict(chat, user)
+    return 0 if record is None else deep_size(record)
+
+
+class SessionSweeper:
+    """Удаление сессий пользователей, которые бросили заказ.
+
+    touch отмечает активность чата (ActivityMiddleware на каждое сообщение). Чаты хранятся
+    в порядке последней активности, поэтому sweep просматривает только тех, кто молчит дольше ttl:
+    их сессии удаляются из хранилища FSM, а строки UserState - пачками по batch_size.
+    """
+
+    def __init__(self, storage, ttl=SESSION_TTL, interval=SESSION_SWEEP_INTERVAL, batch_size=SESSION_SWEEP_BATCH):
+        self.storage = storage
+        self.ttl = ttl
+        self.interval = interval
+        self.batch_size = batch_size
+        self.activity = OrderedDict()
+        self.sessions = 0
+        self.rows = 0
+        self.bytes = 0
+
+    def touch(self, chat, user, now=None):
+        key = chat, user
+        self.activity[key] = time.monotonic() if now is None else now
+        self.activity.move_to_end(key)
+
+    async def seed(self, owns=None, now=None):
+        """Отметка пользователей с незавершенным заказом из БД, например оставшихся с прошлого запуска.
+        owns(user_id) отбирает пользователей, чьи чаты ведет этот процесс"""
+        user_ids = [user_id for user_id in await models.user_ids() if owns is None or owns(user_id)]
+        now = time.monotonic() if now is None else now
+        for user_id in user_ids:
+            self.activity.setdefault((user_id, user_id), now)
+        return len(user_ids)
+
+    async def sweep(self, now=None):
+        """Удаление сессий, которые не были активны дольше ttl, возвращает (сессий, строк UserState, байт)"""
+        deadline = (time.monotonic() if now is None else now) - self.ttl
+        sessions = rows = freed = 0
+        while self.activity:
+            expired = []
+            for key, last_activity in self.activity.items():
+                if last_activity > deadline or len(expired) >= self.batch_size:
+                    break
+                expired.append(key)
+            if not expired:
+                break
+            # Пачка снимается с учета до ожиданий: touch во время evict вернет чат в activity,
+            # и такой чат, снова активный, уже не удаляется
+            for key in expired:
+                del self.activity[key]
+            evicted = []
+            for chat, user in expired:
+                if (chat, user) in self.activity:
+                    continue
+                freed += await evict(self.storage, chat, user)
+                evicted.append(chat)
+            sessions += len(evicted)
+            if evicted:
+                rows += await models.delete_users(set(evicted))
+        self.sessions += sessions
+        self.rows += rows
+        self.bytes += freed
+        return sessions, rows, freed
+
+    async def run(self, log=None):
+        """Периодическая очистка"""
+        while True:
+            await asyncio.sleep(self.interval)
+            sessions, rows, freed = await self.sweep()
+            if sessions and log is not None:
+                log.info('Удалено брошенных сессий: %s, строк UserState: %s, освобождено около %.1f КиБ',
+                         sessions, rows, freed / 1024)
+
+    def stats(self):
+        return {'tracked': len(self.activity), 'sessions': self.sessions, 'rows': self.rows, 'bytes': self.bytes}
+
+
+class ActivityMiddleware(BaseMiddleware):
+    """Отметка активности чата в SessionSweeper на каждое сообщение"""
+
+    def __init__(self, sweeper):
+        super().__init__()
+        self.sweeper = sweeper
+
+    async def on_pre_process_message(self, message, data):
+        self.sweeper.touch(message.chat.id, message.from_user.id)
@@ -0,0 +1,103 @@
+import itertools
+import re
+import time
+from collections import Counter
+
+from aiogram import Bot
+from aiohttp import web
+
+try:
+    import aresponses
+except ImportError:
+    aresponses = None
+
+API_HOST = 'api.telegram.org'
+METHOD_PATH = re.compile(r'^/bot[^/]+/(?P<method>\w+)$')
+LOCAL_HOST = re.compile(r'^(?:127\.0\.0\.1|localhost)(?::\d+)?$')
+
+
+def make_update(update_id, user_id, text, first_name='Вася'):
+    """Обновление Telegram с текстовым сообщением пользователя"""
+    user = {'id': user_id, 'is_bot': False, 'first_name': first_name}
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private', 'first_name': first_name},
+            'from': user,
+            'text': text,
+        },
+    }
+
+
+def fake_result(method, params, ids, bot_id=1):
+    """Правдоподобный result ответа Bot API на вызов method с параметрами params"""
+    if method == 'getMe':
+        return {'id': bot_id, 'is_bot': True, 'first_name': 'AviaTicketBot', 'username': 'avia_ticket_bot'}
+    if method not in ('sendMessage', 'sendPhoto'):
+        return True
+
+    message = {
+        'message_id': next(ids),
+        'date': int(time.time()),
+        'chat': {'id': int(params['chat_id']), 'type': 'private'},
+        'from': {'id': bot_id, 'is_bot': True, 'first_name': 'AviaTicketBot'},
+    }
+    if method == 'sendMessage':
+        message['text'] = params.get('text', '')
+    else:
+        photo = params.get('photo')
+        file_id = photo if isinstance(photo, str) else f'photo-{next(ids)}'
+        message['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 672, 'height': 401}]
+    return message
+
+
+class FakeBotAPI:
+    """Локальная замена Telegram Bot API на aresponses, чтобы гонять бота без сети.
+
+    Все запросы бота к api.telegram.org получают правдоподобный ответ и записываются в calls,
+    запросы к локальным серверам (например, к webhook бота) проходят как есть.
+    """
+
+    def __init__(self, bot_id=1):
+        if aresponses is None:
+            raise RuntimeError('Для FakeBotAPI нужен пакет aresponses (pip install -r requirements.txt)')
+        self.bot_id = bot_id
+        self.calls = []
+        self.counts = Counter()
+        self._ids = itertools.count(1)
+        self._server = aresponses.ResponsesMockServer()
+
+    async def __aenter__(self):
+        await self._server.__aenter__()
+        self._server.add(API_HOST, METHOD_PATH, 'POST', self._handle, repeat=self._server.INFINITY)
+        self._server.add(LOCAL_HOST, response=self._server.passthrough, repeat=self._server.INFINITY)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._server.__aexit__(*exc_info)
+
+    async def _handle(self, request):
+        method = METHOD_PATH.match(request.path).group('method')
+        params = dict(await request.post())
+        self.calls.append((method, params))
+        self.counts[method] += 1
+        return web.json_response({'ok': True, 'result': fake_result(method, params, self._ids, self.bot_id)})
+
+
+class OfflineBot(Bot):
+    """Бот, который отвечает на вызовы API сам, без HTTP: для нагрузочных замеров обработчиков.
+
+    Работает и в процессах-обработчиках (sharding.Supervisor), где подменить HTTP-клиент нельзя.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._ids = itertools.count(1)
+        self.counts = Counter()
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        self.counts[method] += 1
+        params = dict(data or {}, **(files or {}))
+        return fake_result(method, params, self._ids, self.id)
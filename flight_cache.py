@@ -0,0 +1,73 @@
+import sys
+import time
+from collections import OrderedDict
+
+from config import FLIGHT_CACHE_SIZE, FLIGHT_CACHE_TTL
+
+
+def _deep_size(value):
+    """Примерный размер результата поиска в байтах вместе с вложенными кортежами и строками"""
+    size = sys.getsizeof(value)
+    if isinstance(value, tuple):
+        size += sum(_deep_size(item) for item in value)
+    return size
+
+
+class FlightCache:
+    """Общий для всех пользователей кэш результатов поиска рейсов.
+
+    Ключ - (город отправления, город назначения, начало поиска в минутах от EPOCH), значение -
+    неизменяемый кортеж рейсов. Записи живут ttl секунд, при переполнении вытесняются самые старые.
+    """
+
+    def __init__(self, ttl=FLIGHT_CACHE_TTL, max_entries=FLIGHT_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, flights):
+        if key in self._entries:
+            self._remove(key)
+        flights_size = _deep_size(flights)
+        self._entries[key] = (time.monotonic() + self.ttl, flights, flights_size)
+        self.size += flights_size
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        self.size -= self._entries.pop(key)[2]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'bytes_per_entry': self.size / len(self._entries) if self._entries else 0.0,
+        }
+
+
+flight_cache = FlightCache()
@@ -1,53 +1,63 @@
 from io import BytesIO
 
-from PIL import Image, ImageDraw, ImageFont
-from pony.orm import desc
+from aiogram.utils.exceptions import BadRequest
 
-from models import Registration, db_session
+import metrics
+import models
+from ticket_cache import ticket_cache, ticket_key
+from ticket_renderer import renderer
 
-TEMPLATE_PATH = 'files/ticket_base.png'
-IMAGE_PATH = 'files/aviaticket_example.png'
+CARRIER = 'SKILLBOX-AIRLINES'
 
-SECTION_FONT_PATH = 'files/Verdanab.ttf'
-SECTION_FONT_SIZE = 14
-DATA_FONT_PATH = 'files/Verdana.ttf'
-DATA_FONT_SIZE = 14
 
-BLACK = (0, 0, 0, 255)
-SECTION_OFFSETS = ((35, 100), (35, 160), (35, 240), (35, 300), (300, 100))
-DATA_OFFSETS = ((35, 120), (35, 180), (35, 260), (35, 320), (300, 120))
+def _ticket_data(registration):
+    return (registration['username'], registration['chosen_flight'],
+            registration['sits'], registration['phone_number'], CARRIER)
 
-SECTIONS_TO_DRAW = (
-    'Имя пассажира:',
-    'Рейс:',
-    'Количество мест:',
-    'Телефон для подтверждения:',
-    'Перевозчик:'
-)
 
+def _cache_key(ticket_data):
+    """Ключ кэша учитывает и формат картинки, чтобы не отдать билет в старом формате"""
+    return ticket_key((renderer.output_format, renderer.quality, *ticket_data))
 
-async def draw_ticket(user_id):
 
-    # Отрисовка билета по данным из БД
-    with db_session:
-        sql_data = Registration.select(
-            lambda registration: registration.user_id == user_id
-        ).order_by(desc(Registration.id))[:1]
-        ticket_data = (sql_data[0].username, sql_data[0].chosen_flight,
-                       sql_data[0].sits, sql_data[0].phone_number, 'SKILLBOX-AIRLINES')
+async def _ticket_png(key, ticket_data):
+    """Картинка билета из кэша или только что отрисованная"""
+    png = ticket_cache.get(key)
+    if png is None:
+        png = await renderer.render(ticket_data)
+        ticket_cache.put(key, png)
+    return png
 
-    img = Image.open(TEMPLATE_PATH).convert('RGBA')
-    section_font = ImageFont.truetype(SECTION_FONT_PATH, SECTION_FONT_SIZE)
-    data_font = ImageFont.truetype(DATA_FONT_PATH, DATA_FONT_SIZE)
-    draw = ImageDraw.Draw(img)
 
-    for offset, text in zip(SECTION_OFFSETS, SECTIONS_TO_DRAW):
-        draw.text(xy=offset, text=text, fill=BLACK, font=section_font)
+async def draw_ticket(registration):
+    """Отрисовка билета по записи Registration, которую вернул models.register_user.
+    Бот отправляет билеты через send_ticket, функция нужна тестам и бенчмаркам"""
+    ticket_data = _ticket_data(registration)
+    return BytesIO(await _ticket_png(_cache_key(ticket_data), ticket_data))
 
-    for offset, text in zip(DATA_OFFSETS, ticket_data):
-        draw.text(xy=offset, text=str(text), fill=BLACK, font=data_font)
 
-    temp_file = BytesIO()
-    img.save(temp_file, 'png')
-    temp_file.seek(0)
-    return temp_file
+@metrics.timed()
+async def send_ticket(message, registration, caption=None):
+    """Отправка билета в чат: повторно отправляемый билет не загружается, а берется по file_id"""
+    ticket_data = _ticket_data(registration)
+    key = _cache_key(ticket_data)
+    file_id = ticket_cache.file_id(key)
+    if file_id is not None:
+        try:
+            return await message.answer_photo(file_id, caption=caption)
+        except BadRequest:
+            # Telegram больше не знает этот файл, загружаем билет заново
+            ticket_cache.forget_file_id(key)
+
+    sent = await message.answer_photo(BytesIO(await _ticket_png(key, ticket_data)), caption=caption)
+    if sent.photo:
+        ticket_cache.remember_file_id(key, sent.photo[-1].file_id)
+    return sent
+
+
+async def reissue_ticket(message, registration_id, caption=None):
+    """Повторная отправка билета по номеру заказа (по file_id, если билет уже отправлялся), None если заказа нет"""
+    registration = await models.get_registration(registration_id)
+    if registration is None:
+        return None
+    return await send_ticket(message, registration, caption=caption)
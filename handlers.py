@@ -1,44 +1,62 @@
+import atexit
 import logging
-import re
 
 from aiogram import types
 from aiogram.dispatcher import FSMContext
-from aiogram.dispatcher.filters import Text
+from aiogram.dispatcher.filters import IDFilter, Text
 from aiogram.utils import markdown as md
 from aiogram.types import ParseMode
-from random import sample
-from datetime import datetime, timedelta
-from generate_ticket import draw_ticket
+from generate_ticket import send_ticket
+from responses import Reply
+from session import load_session, save_session
 
+import metrics
 import utils
 import models
+import connections
+import validators
 
-from config import CITIES_AND_FLIGHT_TIME as SFT
+from city_recognizer import CONFIRMATION_SIMILARITY
+from config import LOG_PATH
+from log_pipeline import LogPipeline, event
+from validators import StepValidator
 from states import Steps
 
+try:
+    from settings import ADMIN_ID
+except ImportError:
+    ADMIN_ID = None
+
 log = logging.getLogger('avia_ticket_bot')
 
 
-def configure_logging(log):
-    """Настройка логирования"""
-    stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s', datefmt='%d/%m/%Y %H:%M'))
-    stream_handler.setLevel(logging.INFO)
+pipeline = None
+
 
-    file_handler = logging.FileHandler('aviaticketbot_messages.log', encoding='utf8')
-    file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s', datefmt='%d/%m/%Y %H:%M'))
-    file_handler.setLevel(logging.INFO)
+def configure_logging(log, path=LOG_PATH):
+    """Настройка логирования: записи уходят в очередь, в консоль и файл их пишет фоновый поток.
+
+    Вызывается при запуске бота (app.main, sharding.run_worker), импорт модуля логирование не настраивает.
+    """
+    global pipeline
+    if pipeline is None:
+        atexit.register(stop_logging)
+    else:
+        pipeline.stop()
+    pipeline = LogPipeline(path)
 
     if log.hasHandlers():
         log.handlers.clear()
 
-    log.addHandler(stream_handler)
-    log.addHandler(file_handler)
-
+    log.addHandler(pipeline.handler)
     log.setLevel(logging.INFO)
+    pipeline.start()
 
 
-configure_logging(log)
+def stop_logging():
+    """Запись оставшихся в очереди записей лога и остановка фонового потока"""
+    if pipeline is not None:
+        pipeline.stop()
 
 
 async def send_welcome(message: types.Message, state: FSMContext):
@@ -47,11 +65,14 @@ async def send_welcome(message: types.Message, state: FSMContext):
     if current_state is not None:
         await state.finish()
         await models.delete_user(message.chat.id)
-    log.info(f'{message.chat.first_name} подключился к боту. ID {message.chat.id}\n')
-    await message.reply(f'Привет {message.chat.first_name}! Я бот AirTicketLaggyBot.',
-                        reply_markup=types.ReplyKeyboardRemove())
-    await message.answer(f'Я создан для обработки заказов на авиарейсы.')
-    await message.answer(f'Доступные команды: /ticket, /help, /cancel')
+    log.info('%s подключился к боту. ID %s', message.chat.first_name, message.chat.id,
+             extra=event('connect', user_id=message.chat.id))
+    await (Reply(message)
+           .add(f'Привет {message.chat.first_name}! Я бот AirTicketLaggyBot.',
+                'Я создан для обработки заказов на авиарейсы.',
+                'Доступные команды: /ticket, /help, /cancel')
+           .keyboard(types.ReplyKeyboardRemove())
+           .send(reply=True))
 
 
 async def send_help(message: types.Message):
@@ -69,6 +90,11 @@ async def cancel_command(message: types.Message, state: FSMContext):
     await models.delete_user(message.chat.id)
 
 
+async def send_stats(message: types.Message):
+    """Ответ на команду /stats (только ADMIN_ID): время обработчиков и запросов, состояние кэшей и очередей"""
+    await message.answer(metrics.registry.summary())
+
+
 async def ticket_start(message: types.Message, state: FSMContext):
     """Ответ на команду /ticket"""
     current_state = await state.get_state()
@@ -81,74 +107,88 @@ async def ticket_start(message: types.Message, state: FSMContext):
     await models.create_user(message.chat.id, message.chat.username, 'Город отправления')
 
 
-async def ticket_from_invalid(message: types.Message, state: FSMContext):
+async def ticket_from_invalid(message: types.Message, state: FSMContext, value):
     """Город отправления введен некорректно"""
-    async with state.proxy() as data:
-        if all([not data.get('city_from_check'), message.text.title()[:-1] in SFT.keys()]):
-            data['city_from_check'] = True
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True, selective=True)
-            markup.add(message.text.title()[:-1])
-            await message.answer('Подтвердите город отправления (на русском)', reply_markup=markup)
-        elif not data.get('city_from_check'):
-            data['city_from_check'] = True
-            cities = sample(SFT.keys(), 5)
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True, selective=True)
-            markup.add(cities[0], cities[1], cities[2])
-            markup.add(cities[3], cities[4])
-            await message.answer('Из указанного города нет рейсов. Вы можете выбрать город из предложенных',
-                                 reply_markup=markup)
-        else:
-            await state.finish()
-            await message.answer('Из указанного города нет рейсов\nДля повторного запуска бота - /ticket',
-                                 reply_markup=types.ReplyKeyboardRemove())
-            await models.delete_user(message.chat.id)
-
-
-async def ticket_from(message: types.Message, state: FSMContext):
+    recognition = value
+    session = await load_session(state)
+    if all([not session.city_from_check, recognition.similarity >= CONFIRMATION_SIMILARITY]):
+        session.city_from_check = True
+        await save_session(state, session)
+        markup = types.ReplyKeyboardMarkup(resize_keyboard=True, selective=True)
+        markup.add(recognition.suggestions[0])
+        await message.answer('Подтвердите город отправления (на русском)', reply_markup=markup)
+    elif not session.city_from_check:
+        session.city_from_check = True
+        await save_session(state, session)
+        cities = recognition.suggestions
+        markup = types.ReplyKeyboardMarkup(resize_keyboard=True, selective=True)
+        markup.add(*cities[:3])
+        markup.add(*cities[3:])
+        await message.answer('Из указанного города нет рейсов. Вы можете выбрать город из предложенных',
+                             reply_markup=markup)
+    else:
+        await state.finish()
+        await message.answer('Из указанного города нет рейсов\nДля повторного запуска бота - /ticket',
+                             reply_markup=types.ReplyKeyboardRemove())
+        await models.delete_user(message.chat.id)
+
+
+async def ticket_from(message: types.Message, state: FSMContext, value):
     """Город отправления введен корректно"""
-    async with state.proxy() as data:
-        data['city_from'] = message.text.title()
-        log.debug(f'{data}')
+    session = await load_session(state)
+    session.city_from = value.city
+    log.debug('%r', session)
+    await save_session(state, session)
 
     await state.set_state(Steps.city_to)
     await message.answer('Введите город назначения (на русском)', reply_markup=types.ReplyKeyboardRemove())
     await models.update_user(message.chat.id, 'Город назначения')
 
 
-async def ticket_to_invalid(message: types.Message, state: FSMContext):
+async def ticket_to_invalid(message: types.Message, state: FSMContext, value):
     """Город назначения введен некорректно"""
-    async with state.proxy() as data:
-        if all([not data.get('city_to_check'), message.text.title()[:-1] in SFT.keys()]):
-            data['city_to_check'] = True
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True, selective=True)
-            markup.add(message.text.title()[:-1])
-            await message.answer('Подтвердите город назначения (на русском)', reply_markup=markup)
-        elif not data.get('city_to_check'):
-            data['city_to_check'] = True
-            cities = sample(SFT.keys(), 5)
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True, selective=True)
-            markup.add(cities[0], cities[1], cities[2])
-            markup.add(cities[3], cities[4])
-            await message.answer('В указанный город нет рейсов. Вы можете выбрать город из предложенных',
-                                 reply_markup=markup)
-        else:
-            await state.finish()
-            await message.answer('В указанный город нет рейсов\nДля повторного запуска бота - /ticket',
-                                 reply_markup=types.ReplyKeyboardRemove())
-            await models.delete_user(message.chat.id)
-
-
-async def ticket_to(message: types.Message, state: FSMContext):
+    recognition = value
+    session = await load_session(state)
+    if all([not session.city_to_check, recognition.similarity >= CONFIRMATION_SIMILARITY]):
+        session.city_to_check = True
+        await save_session(state, session)
+        markup = types.ReplyKeyboardMarkup(resize_keyboard=True, selective=True)
+        markup.add(recognition.suggestions[0])
+        await message.answer('Подтвердите город назначения (на русском)', reply_markup=markup)
+    elif not session.city_to_check:
+        session.city_to_check = True
+        await save_session(state, session)
+        cities = recognition.suggestions
+        markup = types.ReplyKeyboardMarkup(resize_keyboard=True, selective=True)
+        markup.add(*cities[:3])
+        markup.add(*cities[3:])
+        await message.answer('В указанный город нет рейсов. Вы можете выбрать город из предложенных',
+                             reply_markup=markup)
+    else:
+        await state.finish()
+        await message.answer('В указанный город нет рейсов\nДля повторного запуска бота - /ticket',
+                             reply_markup=types.ReplyKeyboardRemove())
+        await models.delete_user(message.chat.id)
+
+
+async def ticket_to(message: types.Message, state: FSMContext, value):
     """Город назначения введен корректно"""
-    async with state.proxy() as data:
-        data['city_to'] = message.text.title()
-        if data['city_from'] == data['city_to']:
-            await state.finish()
-            await models.delete_user(message.chat.id)
-            return await message.answer('Города отправления и город назначения должны быть разными\n'
-                                        'Для повторного запуска бота введите /ticket',
-                                        reply_markup=types.ReplyKeyboardRemove())
-        log.debug(f'{data}')
+    session = await load_session(state)
+    session.city_to = value.city
+    if session.city_from == session.city_to:
+        await state.finish()
+        await models.delete_user(message.chat.id)
+        return await message.answer('Города отправления и город назначения должны быть разными\n'
+                                    'Для повторного запуска бота введите /ticket',
+                                    reply_markup=types.ReplyKeyboardRemove())
+    if not connections.has_connection(session.city_from, session.city_to):
+        await state.finish()
+        await models.delete_user(message.chat.id)
+        return await message.answer('Между указанными городами нет рейсов\n'
+                                    'Для повторного запуска бота введите /ticket',
+                                    reply_markup=types.ReplyKeyboardRemove())
+    log.debug('%r', session)
+    await save_session(state, session)
 
     await state.set_state(Steps.flight_date)
     await message.answer('Введите дату вылета в формате 05-11-2021', reply_markup=types.ReplyKeyboardRemove())
@@ -162,58 +202,41 @@ async def ticket_date_invalid(message: types.Message):
                                  'На вчера купить билеты нельзя', sep='\n'))
 
 
-async def ticket_date(message: types.Message, state: FSMContext):
-    """Дата полета введена корректно"""
-    async with state.proxy() as data:
-        data['flight_date'] = message.text
-        data['flights_to_choose'] = await utils.dispatcher(data['city_from'], data['city_to'], data['flight_date'])
-        log.debug(f'{data}')
+async def ticket_date(message: types.Message, state: FSMContext, value):
+    """Дата полета введена корректно, value - разобранная дата"""
+    # В FSM хранится только начало поиска, рейсы берутся из общего кэша и форматируются при отправке
+    session = await load_session(state)
+    session.flight_search = utils.search_start(value)
+    flights = utils.flights_after(session.city_from, session.city_to, session.flight_search)
+    log.debug('%r', session)
+    await save_session(state, session)
 
     await state.set_state(Steps.flight_choice)
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, selective=True)
     markup.add('1', '2', '3')
     markup.add('4', '5')
-    await message.answer('Выберите рейс из предложенных ниже', reply_markup=markup)
-    async with state.proxy() as data:
-        for flight_info in data['flights_to_choose']:
-            info_index = str(data['flights_to_choose'].index(flight_info) + 1)
-            info = md.text(
-                md.text(data["city_from"], flight_info[0], '-', data["city_to"], flight_info[1]),
-                md.text('часов в полете -', flight_info[2]),
-                sep='\n'
-            )
-            data[info_index] = info
-            await message.answer(f"{info_index}) {info}")
+    reply = Reply(message, sep='\n\n').add('Выберите рейс из предложенных ниже').keyboard(markup)
+    for info_index, flight in enumerate(flights, start=1):
+        reply.add(f"{info_index}) {utils.format_flight(session.city_from, session.city_to, flight)}")
+    await reply.send()
     await models.update_user(message.chat.id, 'Выбор рейса')
 
 
-def _ticket_date_check(message):
-    try:
-        if any([datetime.strptime(message.text, '%d-%m-%Y') < datetime.today(),
-                datetime.strptime(message.text, '%d-%m-%Y') >= datetime.today() + timedelta(days=365)]
-               ):
-            return False
-        else:
-            return True
-    except ValueError:
-        return False
-
-
 async def ticket_choose_flight_invalid(message: types.Message):
     """Билет выбран некорректно"""
     await message.answer('Выберите номер рейса от 1 до 5')
 
 
-async def ticket_choose_flight(message: types.Message, state: FSMContext):
+async def ticket_choose_flight(message: types.Message, state: FSMContext, value):
     """Билет выбран корректно"""
-    async with state.proxy() as data:
-        data['chosen_flight'] = message.text
-        await message.answer(f'Выбран вариант {data["chosen_flight"]}')
-        await message.answer(f'{data[data["chosen_flight"]]}')
-        log.debug(f'{data}')
+    session = await load_session(state)
+    session.chosen_flight = int(value)
+    reply = Reply(message).add(f'Выбран вариант {session.chosen_flight}', utils.chosen_flight(session), '')
+    log.debug('%r', session)
+    await save_session(state, session)
 
     await state.set_state(Steps.sits_number)
-    await message.answer('Выберите количество мест от 1 до 5')
+    await reply.add('Выберите количество мест от 1 до 5').send()
     await models.update_user(message.chat.id, 'Выбор количества мест')
 
 
@@ -222,11 +245,12 @@ async def ticket_choose_sits_invalid(message: types.Message):
     await message.answer('Выберите количество мест от 1 до 5')
 
 
-async def ticket_choose_sits(message: types.Message, state: FSMContext):
+async def ticket_choose_sits(message: types.Message, state: FSMContext, value):
     """Количество мест выбрано корректно"""
-    async with state.proxy() as data:
-        data['sits'] = message.text
-        log.debug(f'{data}')
+    session = await load_session(state)
+    session.sits = int(value)
+    log.debug('%r', session)
+    await save_session(state, session)
 
     await state.set_state(Steps.comment)
     await message.answer('Напишите дополнительные сведения о полете (комментарий)',
@@ -241,25 +265,23 @@ async def ticket_comment_invalid(message: types.Message):
 
 async def ticket_comment(message: types.Message, state: FSMContext):
     """Дополнительные сведения о полете"""
-    async with state.proxy() as data:
-        data['comment'] = message.text
-        log.debug(f'{data}')
+    session = await load_session(state)
+    session.comment = message.text
+    log.debug('%r', session)
+    await save_session(state, session)
 
     await state.set_state(Steps.validate_data)
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, selective=True)
     markup.add('Да', 'Нет')
-    await message.answer(
-        md.text(
-            md.text('Выбранный рейс:'),
-            md.text(data[data["chosen_flight"]]),
-            md.text('Количество мест: ', data['sits']),
-            md.text('Ваш комментарий:', data['comment']),
-            sep='\n'
-        ),
-        reply_markup=types.ReplyKeyboardRemove(),
-        parse_mode=ParseMode.MARKDOWN
-    )
-    await message.answer('Верны ли введенные данные? Да/Нет', reply_markup=markup)
+    await (Reply(message)
+           .add(md.text('Выбранный рейс:'),
+                md.text(utils.chosen_flight(session)),
+                md.text('Количество мест: ', session.sits),
+                md.text('Ваш комментарий:', md.escape_md(session.comment)),
+                '',
+                'Верны ли введенные данные? Да/Нет')
+           .keyboard(markup)
+           .send(parse_mode=ParseMode.MARKDOWN))
     await models.update_user(message.chat.id, 'Подтверждение данных')
 
 
@@ -272,9 +294,6 @@ async def ticket_correct_data_invalid(message: types.Message, state: FSMContext)
 
 async def ticket_correct_data(message: types.Message, state: FSMContext):
     """Введенные данные верны"""
-    async with state.proxy() as data:
-        data['correct_data'] = message.text
-        log.debug(f'{data}')
     await state.set_state(Steps.phone_number)
     await message.answer('Укажите номер телефона для связи с Вами', reply_markup=types.ReplyKeyboardRemove())
     await models.update_user(message.chat.id, 'Ввод номера телефона')
@@ -287,47 +306,59 @@ async def ticket_phone_number_invalid(message: types.Message):
 
 async def ticket_phone_number(message: types.Message, state: FSMContext):
     """Корректный номер телефона"""
-    async with state.proxy() as data:
-        data['phone_number'] = message.text
-        await message.answer(
-            md.text('Спасибо за регистрацию. С вами свяжутся по указанному номеру телефона:',
-                    data["phone_number"])
-        )
-        log.info(f'{message.chat.first_name} заполнил(а) форму для заказа авиабилетов. ID {message.chat.id}')
-        log.info(f'Выбранный рейс: {data[data["chosen_flight"]]}')
-        log.info(f'Количество мест: {data["sits"]}')
-        log.info(f'Комментарий: {data["comment"]}')
-        log.info(f'Номер телефона: {data["phone_number"]}\n')
-
-        _data = [message.chat.id, message.chat.first_name, data[data["chosen_flight"]], data["sits"],
-                 data["comment"], data["phone_number"]]
-        await models.register_user(_data)
-        await message.answer('Ваш электронный билет:')
-
-        temp_ticket = await draw_ticket(str(message.chat.id))
-        await message.answer_photo(temp_ticket)
+    session = await load_session(state)
+    session.phone_number = message.text
+    flight = utils.chosen_flight(session)
+    _data = [message.chat.id, message.chat.first_name, flight, session.sits,
+             session.comment, session.phone_number]
+    registration = await models.register_user(_data)
+    log.info('%s заполнил(а) форму для заказа авиабилетов. ID %s', message.chat.first_name, message.chat.id,
+             extra=event('booking', registration_id=registration['id'], user_id=message.chat.id,
+                         city_from=session.city_from, city_to=session.city_to, flight=flight, sits=session.sits,
+                         comment=session.comment, phone_number=session.phone_number))
+    caption = md.text(md.text('Спасибо за регистрацию. С вами свяжутся по указанному номеру телефона:',
+                              session.phone_number),
+                      'Ваш электронный билет:', sep='\n')
+    await send_ticket(message, registration, caption=caption)
 
     """Завершение сценария"""
     await state.finish()
     await models.delete_user(message.chat.id)
 
 
-def register_handlers(_dp, config):
-    """Регистрация обработчиков"""
+def register_handlers(_dp, config, admin_id=ADMIN_ID):
+    """Регистрация обработчиков, каждый измеряется в metrics.registry"""
+    timed = metrics.timed()
+
+    if admin_id:
+        for command_info in config['admin_handlers']:
+            _dp.register_message_handler(timed(command_info[0]), IDFilter(chat_id=admin_id),
+                                         commands=command_info[1], state=command_info[2])
 
     for command_info in config['command_handlers']:
-        _dp.register_message_handler(command_info[0], commands=command_info[1], state=command_info[2])
-        _dp.register_message_handler(command_info[0], command_info[3], state=command_info[2])
+        handler = timed(command_info[0])
+        _dp.register_message_handler(handler, commands=command_info[1], state=command_info[2])
+        _dp.register_message_handler(handler, command_info[3], state=command_info[2])
 
     for communicate_info in config['communicate_handlers']:
-        _dp.register_message_handler(communicate_info[0], state=communicate_info[1])
+        _dp.register_message_handler(timed(communicate_info[0]), state=communicate_info[1])
 
     for handler_info in config['state_handlers']:
-        _dp.register_message_handler(handler_info[0], handler_info[1], state=handler_info[2])
+        _dp.register_message_handler(timed(handler_info[0]), handler_info[1], state=handler_info[2])
+
+
+def _step(state, validate, invalid_handler, valid_handler):
+    validator = StepValidator(validate)
+    return [(invalid_handler, validator.invalid, state), (valid_handler, validator.valid, state)]
 
 
 handlers_config = {
 
+    # Команды администратора, доступны только из чата ADMIN_ID
+    'admin_handlers': (
+        (send_stats, 'stats', '*'),
+    ),
+
     'command_handlers': (
         (send_welcome, 'start', '*', Text(equals='/start', ignore_case=True)),
         (send_help, 'help', '*', Text(equals='/help', ignore_case=True)),
@@ -339,32 +370,15 @@ handlers_config = {
         (send_help, None),
     ),
 
+    # Пары обработчиков (некорректный ввод, корректный ввод) для каждого шага с общей проверкой ввода
     'state_handlers': [
-        (ticket_from_invalid, lambda message: message.text.title() not in SFT.keys(), Steps.city_from),
-        (ticket_from, lambda message: message.text.title() in SFT.keys(), Steps.city_from),
-        (ticket_to_invalid, lambda message: message.text.title() not in SFT.keys(), Steps.city_to),
-        (ticket_to, lambda message: message.text.title() in SFT.keys(), Steps.city_to),
-        (ticket_date_invalid, lambda message: not _ticket_date_check(message), Steps.flight_date),
-        (ticket_date, lambda message: _ticket_date_check(message), Steps.flight_date),
-        (ticket_choose_flight_invalid,
-         lambda message: not all([message.text.isdigit(), message.text in [str(x) for x in range(1, 6)]]),
-         Steps.flight_choice),
-        (ticket_choose_flight,
-         lambda message: all([message.text.isdigit(), message.text in [str(x) for x in range(1, 6)]]),
-         Steps.flight_choice),
-        (ticket_choose_sits_invalid,
-         lambda message: not all([message.text.isdigit(), message.text in [str(x) for x in range(1, 6)]]),
-         Steps.sits_number),
-        (ticket_choose_sits,
-         lambda message: all([message.text.isdigit(), message.text in [str(x) for x in range(1, 6)]]),
-         Steps.sits_number),
-        (ticket_comment_invalid, lambda message: not message.text, Steps.comment),
-        (ticket_comment, lambda message: message.text, Steps.comment),
-        (ticket_correct_data_invalid, lambda message: message.text.title() != 'Да', Steps.validate_data),
-        (ticket_correct_data, lambda message: message.text.title() == 'Да', Steps.validate_data),
-        (ticket_phone_number_invalid,
-         lambda message: not re.match(r'^(\d{3})\D?(\d{3})\D?(\d{4})\D?(\d*)$', message.text), Steps.phone_number),
-        (ticket_phone_number,
-         lambda message: re.match(r'^(\d{3})\D?(\d{3})\D?(\d{4})\D?(\d*)$', message.text), Steps.phone_number),
+        *_step(Steps.city_from, validators.city, ticket_from_invalid, ticket_from),
+        *_step(Steps.city_to, validators.city, ticket_to_invalid, ticket_to),
+        *_step(Steps.flight_date, validators.flight_date, ticket_date_invalid, ticket_date),
+        *_step(Steps.flight_choice, validators.choice, ticket_choose_flight_invalid, ticket_choose_flight),
+        *_step(Steps.sits_number, validators.choice, ticket_choose_sits_invalid, ticket_choose_sits),
+        *_step(Steps.comment, validators.comment, ticket_comment_invalid, ticket_comment),
+        *_step(Steps.validate_data, validators.confirmation, ticket_correct_data_invalid, ticket_correct_data),
+        *_step(Steps.phone_number, validators.phone_number, ticket_phone_number_invalid, ticket_phone_number),
     ]
 }
@@ -0,0 +1,112 @@
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import time
+
+from config import LOG_BACKUP_COUNT, LOG_MAX_BYTES, LOG_PATH, LOG_QUEUE_SIZE, LOG_ROTATE_INTERVAL
+
+TEXT_FORMAT = logging.Formatter('%(asctime)s %(levelname)s %(message)s', datefmt='%d/%m/%Y %H:%M')
+
+
+def event(name, **fields):
+    """Поля структурированного события для extra: log.info('...', extra=event('booking', user_id=...))"""
+    return {'event': name, 'fields': fields}
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна строка JSON на запись: время, уровень, сообщение, имя события и его поля"""
+
+    def format(self, record):
+        line = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        name = getattr(record, 'event', None)
+        if name is not None:
+            line['event'] = name
+            line.update(record.fields)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            line['exception'] = record.exc_text
+        return json.dumps(line, ensure_ascii=False, default=str)
+
+
+class RotatingJsonFileHandler(logging.handlers.RotatingFileHandler):
+    """Файл JSON-строк, который ротируется по размеру (max_bytes) и по времени (interval секунд)"""
+
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, interval=LOG_ROTATE_INTERVAL, backup_count=LOG_BACKUP_COUNT):
+        super().__init__(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf8', delay=True)
+        self.interval = interval
+        self.rollover_at = time.time() + interval
+        self.setFormatter(JsonFormatter())
+
+    def shouldRollover(self, record):
+        if self.interval and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Постановка записи в очередь без ожидания: при переполненной очереди запись отбрасывается.
+
+    В вызывающем потоке только подставляются аргументы сообщения, JSON и запись в файл
+    делает поток QueueListener.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = TEXT_FORMAT.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline:
+    """Очередь записей логгера и фоновый поток, который пишет их в консоль и в JSON-файл с ротацией"""
+
+    def __init__(self, path=LOG_PATH, queue_size=LOG_QUEUE_SIZE, stream=True, **file_options):
+        self.queue = queue.Queue(queue_size)
+        self.handler = NonBlockingQueueHandler(self.queue)
+        self.file_handler = RotatingJsonFileHandler(path, **file_options)
+        self.file_handler.setLevel(logging.INFO)
+        handlers = [self.file_handler]
+        if stream:
+            stream_handler = logging.StreamHandler()
+            stream_handler.setFormatter(TEXT_FORMAT)
+            stream_handler.setLevel(logging.INFO)
+            handlers.append(stream_handler)
+        self.listener = logging.handlers.QueueListener(self.queue, *handlers, respect_handler_level=True)
+        self.started = False
+
+    def start(self):
+        self.listener.start()
+        self.started = True
+
+    def stop(self):
+        """Остановка после записи всего, что уже в очереди, повторный вызов ничего не делает"""
+        if self.started:
+            self.listener.stop()
+            self.started = False
+        for handler in self.listener.handlers:
+            handler.close()
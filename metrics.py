@@ -0,0 +1,191 @@
+import functools
+import inspect
+import time
+from bisect import bisect_left
+
+from aiohttp import web
+
+from config import METRICS_BUCKETS, METRICS_PATH
+from flight_cache import flight_cache
+from ticket_cache import ticket_cache
+
+PREFIX = 'avia_bot'
+
+
+class Timer:
+    """Гистограмма времени выполнения, число ошибок и число выполняющихся сейчас вызовов"""
+
+    __slots__ = ('buckets', 'counts', 'count', 'total', 'errors', 'in_flight')
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.errors = 0
+        self.in_flight = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, q):
+        """Верхняя граница интервала гистограммы, в который попадает квантиль q"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+
+class Registry:
+    """Таймеры вызовов по именам и функции, которые отдают текущие stats() кэшей и очередей"""
+
+    def __init__(self):
+        self.timers = {}
+        self.collectors = {}
+        self.counters = {}
+
+    def timer(self, name):
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = Timer()
+        return timer
+
+    def timed(self, name=None):
+        """Декоратор корутины или обычной функции: время выполнения, ошибки и число выполняющихся вызовов
+        под именем name"""
+        def decorator(func):
+            timer = self.timer(name or f'{func.__module__}.{func.__qualname__}')
+
+            if not inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                def sync_wrapper(*args, **kwargs):
+                    timer.in_flight += 1
+                    started = time.perf_counter()
+                    try:
+                        return func(*args, **kwargs)
+                    except Exception:
+                        timer.errors += 1
+                        raise
+                    finally:
+                        timer.in_flight -= 1
+                        timer.observe(time.perf_counter() - started)
+
+                return sync_wrapper
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                timer.in_flight += 1
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    timer.errors += 1
+                    raise
+                finally:
+                    timer.in_flight -= 1
+                    timer.observe(time.perf_counter() - started)
+
+            return wrapper
+
+        return decorator
+
+    def add_collector(self, name, stats, counters=()):
+        """stats() возвращает словарь чисел, они отдаются с префиксом name.
+
+        Ключи из counters (числа событий с запуска) отдаются как counter с суффиксом _total, остальные как gauge.
+        """
+        self.collectors[name] = stats
+        self.counters[name] = frozenset(counters)
+
+    def collect(self):
+        return {name: stats() for name, stats in self.collectors.items()}
+
+    def prometheus(self):
+        """Все метрики в текстовом формате Prometheus"""
+        lines = [f'# TYPE {PREFIX}_call_seconds histogram']
+        for name, timer in self.timers.items():
+            cumulative = 0
+            for bound, count in zip(timer.buckets, timer.counts):
+                cumulative += count
+                lines.append(f'{PREFIX}_call_seconds_bucket{{name="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'{PREFIX}_call_seconds_bucket{{name="{name}",le="+Inf"}} {timer.count}')
+            lines.append(f'{PREFIX}_call_seconds_sum{{name="{name}"}} {timer.total}')
+            lines.append(f'{PREFIX}_call_seconds_count{{name="{name}"}} {timer.count}')
+        lines.append(f'# TYPE {PREFIX}_call_errors_total counter')
+        lines += [f'{PREFIX}_call_errors_total{{name="{name}"}} {timer.errors}' for name, timer in self.timers.items()]
+        lines.append(f'# TYPE {PREFIX}_calls_in_flight gauge')
+        lines += [f'{PREFIX}_calls_in_flight{{name="{name}"}} {timer.in_flight}' for name, timer in self.timers.items()]
+        for collector, stats in self.collect().items():
+            for key, value in stats.items():
+                if key in self.counters[collector]:
+                    lines.append(f'# TYPE {PREFIX}_{collector}_{key}_total counter')
+                    lines.append(f'{PREFIX}_{collector}_{key}_total {value}')
+                else:
+                    lines.append(f'# TYPE {PREFIX}_{collector}_{key} gauge')
+                    lines.append(f'{PREFIX}_{collector}_{key} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Сводка для команды /stats: вызовы, ошибки, среднее время и квантили в миллисекундах"""
+        lines = []
+        for name, timer in sorted(self.timers.items()):
+            if not timer.count and not timer.in_flight:
+                continue
+            average = timer.total / timer.count * 1000 if timer.count else 0.0
+            lines.append(f'{name}: {timer.count} выз., ошибок {timer.errors}, сейчас {timer.in_flight}, '
+                         f'ср. {average:.1f} мс, p50 ≤ {timer.quantile(0.5) * 1000:g} мс, '
+                         f'p95 ≤ {timer.quantile(0.95) * 1000:g} мс')
+        for collector, stats in self.collect().items():
+            values = ', '.join(f'{key}={value:.3g}' if isinstance(value, float) else f'{key}={value}'
+                               for key, value in stats.items())
+            lines.append(f'{collector}: {values}')
+        return '\n'.join(lines) or 'Нет данных'
+
+
+registry = Registry()
+timed = registry.timed
+
+
+def add_bot_collectors(bot, sweeper, metrics_registry=registry):
+    """Кэши билетов и рейсов, очередь исходящих сообщений бота и очистка брошенных сессий"""
+    metrics_registry.add_collector('ticket_cache', ticket_cache.stats,
+                                   counters=('hits', 'misses', 'evictions', 'file_id_hits'))
+    metrics_registry.add_collector('flight_cache', flight_cache.stats,
+                                   counters=('hits', 'misses', 'evictions', 'expirations'))
+    # bytes очистки - освобожденные с запуска байты, а не текущий размер
+    metrics_registry.add_collector('sessions', sweeper.stats, counters=('sessions', 'rows', 'bytes'))
+    scheduler = getattr(bot, 'scheduler', None)
+    if scheduler is not None:
+        metrics_registry.add_collector('outbound', scheduler.stats, counters=('sent', 'retries', 'failed'))
+
+
+def create_app(metrics_registry=registry):
+    """Приложение aiohttp, которое отдает метрики Prometheus по METRICS_PATH"""
+    async def handle_metrics(request):
+        return web.Response(text=metrics_registry.prometheus(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get(METRICS_PATH, handle_metrics)
+    return app
+
+
+async def start_server(host, port, metrics_registry=registry):
+    """Запуск отдельного HTTP-сервера метрик, возвращает runner для остановки (await runner.cleanup()).
+
+    Если порт занят, выбрасывается OSError.
+    """
+    runner = web.AppRunner(create_app(metrics_registry))
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError:
+        await runner.cleanup()
+        raise
+    return runner
@@ -1,4 +1,13 @@
-from pony.orm import Database, Required, Optional, db_session
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from pony.orm import Database, PrimaryKey, Required, Optional, composite_index, db_session
+
+import metrics
+from config import DB_WORKERS, STATE_FLUSH_INTERVAL, STATE_FLUSH_SIZE, STATE_JOURNAL_INTERVAL, STATE_JOURNAL_PATH
 
 try:
     from settings import DB_CONFIG
@@ -16,40 +25,285 @@ class UserState(db.Entity):
 
 
 class Registration(db.Entity):
+    id = PrimaryKey(int, auto=True)
     user_id = Required(int)
     username = Required(str)
     chosen_flight = Required(str)
     sits = Required(int)
     comment = Required(str)
     phone_number = Required(str)
+    # Последний билет пользователя: WHERE user_id = ... ORDER BY id DESC
+    composite_index(user_id, id)
 
 
-async def create_user(user_id, username, user_state):
+class FSMSession(db.Entity):
+    """Состояние и данные FSM aiogram для storage.PonyStorage"""
+    chat = Required(str)
+    user = Required(str)
+    state = Optional(str, nullable=True)
+    data = Optional(bytes)
+    bucket = Optional(bytes)
+    PrimaryKey(chat, user)
+
+
+# Pony и psycopg2 блокируют поток, поэтому запросы выполняются в пуле потоков, а не в цикле событий.
+# У каждого потока пула свое соединение с БД, warm_up открывает их заранее.
+executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='db')
+
+
+async def run_in_db(func, *args, **kwargs):
+    """Выполнение блокирующей функции работы с БД в пуле потоков"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+
+
+def _connect():
+    with db_session:
+        db.execute('SELECT 1')
+
+
+def warm_up():
+    """Открытие соединений с БД во всех потоках пула"""
+    for future in [executor.submit(_connect) for _ in range(DB_WORKERS)]:
+        future.result()
+
+
+# Прогресс пользователя можно записать сразу (STRONG) или через буфер отложенной записи (EVENTUAL)
+STRONG = 'strong'
+EVENTUAL = 'eventual'
+
+UPSERT_CHUNK_SIZE = 400
+
+
+def _upsert_users(rows, update_columns):
+    """Запись пачки пользователей (user_id, username, user_state) одним INSERT ... ON CONFLICT
+    на каждые UPSERT_CHUNK_SIZE строк. При конфликте по user_id обновляются колонки update_columns"""
+    quote = db.provider.quote_name
+    columns = (UserState.user_id.column, UserState.username.column, UserState.user_state.column)
+    update = ', '.join(f'{quote(column)} = EXCLUDED.{quote(column)}' for column in update_columns)
+    with db_session:
+        for chunk_start in range(0, len(rows), UPSERT_CHUNK_SIZE):
+            params = {}
+            values = []
+            for index, (user_id, username, user_state) in enumerate(rows[chunk_start:chunk_start + UPSERT_CHUNK_SIZE]):
+                params[f'user_id_{index}'] = int(user_id)
+                params[f'username_{index}'] = username or ''
+                params[f'user_state_{index}'] = user_state
+                values.append(f'($user_id_{index}, $username_{index}, $user_state_{index})')
+            db.execute(
+                f'INSERT INTO {quote(UserState._table_)} ({", ".join(quote(column) for column in columns)}) '
+                f'VALUES {", ".join(values)} '
+                f'ON CONFLICT ({quote(UserState.user_id.column)}) DO UPDATE SET {update}',
+                params
+            )
+
+
+def _upsert_states(states):
+    """Запись прогресса пачки пользователей, имя пользователя не меняется"""
+    _upsert_users([(user_id, '', user_state) for user_id, user_state in states.items()],
+                  (UserState.user_state.column,))
+
+
+class StateBuffer:
+    """Буфер отложенной записи UserState.user_state.
+
+    Хранит только последнее состояние каждого пользователя и сбрасывает их в БД одним upsert
+    по таймеру (run) или при накоплении size записей. Изменения копятся в памяти и раз в
+    journal_interval дописываются в журнал из потока БД, recover после падения дописывает в БД
+    то, что не успело сохраниться.
+    """
+
+    def __init__(self, interval=STATE_FLUSH_INTERVAL, size=STATE_FLUSH_SIZE, journal_path=STATE_JOURNAL_PATH,
+                 journal_interval=STATE_JOURNAL_INTERVAL):
+        self.interval = interval
+        self.size = size
+        self.journal_path = journal_path
+        self.journal_interval = journal_interval
+        self.pending = {}
+        self.discarded = set()
+        # pending_lock - короткие операции со словарем и строками журнала из цикла событий,
+        # journal_lock - запись файла журнала (берется раньше pending_lock),
+        # db_lock - порядок между сбросом буфера и немедленными записями в потоках БД
+        self.pending_lock = threading.Lock()
+        self.journal_lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self._journal = None
+        self._journal_lines = []
+        self._flush_task = None
+
+    def _journal_write(self, line):
+        """Строка журнала в очередь на запись, вызывается под pending_lock"""
+        if self.journal_path is not None:
+            self._journal_lines.append(line)
+
+    def _write_journal(self, lines):
+        """Запись строк в файл журнала, вызывается под journal_lock"""
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'a', encoding='utf8')
+        self._journal.write(''.join(lines))
+        self._journal.flush()
+
+    def sync_journal(self):
+        """Дозапись накопленных строк в журнал, выполняется в потоке БД"""
+        with self.journal_lock:
+            with self.pending_lock:
+                lines, self._journal_lines = self._journal_lines, []
+            if lines:
+                self._write_journal(lines)
+        return len(lines)
+
+    def put(self, user_id, user_state):
+        user_id = int(user_id)
+        with self.pending_lock:
+            self.pending[user_id] = user_state
+            self._journal_write(f'{user_id}\t{user_state}\n')
+            full = len(self.pending) >= self.size
+        if full and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.ensure_future(self.flush())
+
+    def discard(self, user_id):
+        """Отмена отложенной записи: пользователь удален или записан немедленно"""
+        user_id = int(user_id)
+        with self.pending_lock:
+            self.pending.pop(user_id, None)
+            self.discarded.add(user_id)
+            self._journal_write(f'-{user_id}\n')
+
+    def _take_pending(self):
+        with self.journal_lock:
+            with self.pending_lock:
+                pending, self.pending = self.pending, {}
+                self.discarded = set()
+                lines, self._journal_lines = self._journal_lines, []
+            # Журнал сбрасываемых записей остается на диске до конца сброса
+            if lines:
+                self._write_journal(lines)
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+                os.replace(self.journal_path, f'{self.journal_path}.flushing')
+        return pending
+
+    def _restore(self, pending):
+        """Возврат в буфер записей, которые не удалось сохранить"""
+        with self.pending_lock:
+            for user_id, user_state in pending.items():
+                if user_id not in self.pending and user_id not in self.discarded:
+                    self.pending[user_id] = user_state
+                    self._journal_write(f'{user_id}\t{user_state}\n')
+
+    def flush_sync(self):
+        """Сброс буфера в БД, выполняется в потоке БД"""
+        with self.db_lock:
+            pending = self._take_pending()
+            try:
+                if pending:
+                    _upsert_states(pending)
+            except Exception:
+                self._restore(pending)
+                raise
+            finally:
+                if self.journal_path is not None and os.path.exists(f'{self.journal_path}.flushing'):
+                    os.remove(f'{self.journal_path}.flushing')
+        return len(pending)
+
+    async def flush(self):
+        return await run_in_db(self.flush_sync)
+
+    async def run(self):
+        """Периодическая дозапись журнала и сброс буфера"""
+        loop = asyncio.get_running_loop()
+        flush_at = loop.time() + self.interval
+        while True:
+            await asyncio.sleep(min(self.journal_interval, self.interval))
+            if loop.time() >= flush_at:
+                flush_at = loop.time() + self.interval
+                await self.flush()
+            elif self._journal_lines:
+                await run_in_db(self.sync_journal)
+
+    def recover(self):
+        """Восстановление несохраненного прогресса из журнала после падения"""
+        if self.journal_path is None:
+            return 0
+        recovered = {}
+        for path in (f'{self.journal_path}.flushing', self.journal_path):
+            if not os.path.exists(path):
+                continue
+            with open(path, encoding='utf8') as journal:
+                for line in journal:
+                    line = line.rstrip('\n')
+                    if line.startswith('-'):
+                        recovered.pop(int(line[1:]), None)
+                    elif line:
+                        user_id, user_state = line.split('\t', 1)
+                        recovered[int(user_id)] = user_state
+        with self.journal_lock, self.pending_lock:
+            if self._journal is None and os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            recovered.update(self.pending)
+            self.pending = recovered
+            self._journal_lines = [f'{user_id}\t{user_state}\n' for user_id, user_state in recovered.items()]
+        return self.flush_sync()
+
+    async def strong(self, func, user_id, *args):
+        """Немедленная запись с отменой отложенной записи того же пользователя"""
+        self.discard(user_id)
+
+        def locked():
+            with self.db_lock:
+                return func(user_id, *args)
+
+        return await run_in_db(locked)
+
+
+state_buffer = StateBuffer()
+
+
+def _create_user(user_id, username, user_state):
+    _upsert_users([(user_id, username, user_state)], (UserState.username.column, UserState.user_state.column))
+
+
+def _update_user(user_id, user_state):
+    _upsert_states({user_id: user_state})
+
+
+def _delete_user(user_id):
+    """Удаление пользователя одним запросом, возвращает True, если строка была"""
+    quote = db.provider.quote_name
     user_id = int(user_id)
     with db_session:
-        if not UserState.get(user_id=user_id):
-            UserState(user_id=user_id, username=username, user_state=user_state)
-        else:
-            UserState.get(user_id=user_id).delete()
-            UserState(user_id=user_id, username=username, user_state=user_state)
+        cursor = db.execute(
+            f'DELETE FROM {quote(UserState._table_)} WHERE {quote(UserState.user_id.column)} = $user_id'
+        )
+        return cursor.rowcount > 0
 
 
-async def update_user(user_id, user_state):
+def _delete_users(user_ids):
+    """Удаление пачки пользователей запросом на каждые UPSERT_CHUNK_SIZE строк, возвращает число удаленных"""
+    quote = db.provider.quote_name
+    user_ids = [int(user_id) for user_id in user_ids]
+    deleted = 0
     with db_session:
-        user = UserState.get(user_id=int(user_id))
-        if not user:
-            UserState(user_id=int(user_id), user_state=user_state)
-            user = UserState.get(user_id=int(user_id))
-        user.user_state = user_state
+        for chunk_start in range(0, len(user_ids), UPSERT_CHUNK_SIZE):
+            chunk = user_ids[chunk_start:chunk_start + UPSERT_CHUNK_SIZE]
+            params = {f'user_id_{index}': user_id for index, user_id in enumerate(chunk)}
+            cursor = db.execute(
+                f'DELETE FROM {quote(UserState._table_)} WHERE {quote(UserState.user_id.column)} '
+                f'IN ({", ".join(f"$user_id_{index}" for index in range(len(chunk)))})',
+                params
+            )
+            deleted += cursor.rowcount
+    return deleted
 
 
-async def delete_user(user_id):
+def _user_ids():
     with db_session:
-        if UserState.get(user_id=int(user_id)):
-            UserState.get(user_id=int(user_id)).delete()
+        return db.select(f'SELECT {db.provider.quote_name(UserState.user_id.column)} '
+                         f'FROM {db.provider.quote_name(UserState._table_)}')
 
 
-async def register_user(data):
+def _register_user(data):
     with db_session:
         user_id, username, chosen_flight, sits, comment, phone_number = data
         new_ticket = Registration(
@@ -60,6 +314,63 @@ async def register_user(data):
             comment=comment,
             phone_number=phone_number,
         )
+        new_ticket.flush()
+        return new_ticket.to_dict()
+
+
+def _get_registration(registration_id):
+    with db_session:
+        registration = Registration.get(id=registration_id)
+        return None if registration is None else registration.to_dict()
+
+
+@metrics.timed()
+async def create_user(user_id, username, user_state):
+    await state_buffer.strong(_create_user, user_id, username, user_state)
+
+
+@metrics.timed()
+async def update_user(user_id, user_state, persistence=EVENTUAL):
+    if persistence == EVENTUAL:
+        state_buffer.put(user_id, user_state)
+    else:
+        await state_buffer.strong(_update_user, user_id, user_state)
+
+
+@metrics.timed()
+async def delete_user(user_id):
+    return await state_buffer.strong(_delete_user, user_id)
+
+
+@metrics.timed()
+async def delete_users(user_ids):
+    """Удаление пачки пользователей с отменой их отложенных записей"""
+    for user_id in user_ids:
+        state_buffer.discard(user_id)
+
+    def locked():
+        with state_buffer.db_lock:
+            return _delete_users(user_ids)
+
+    return await run_in_db(locked)
+
+
+@metrics.timed()
+async def user_ids():
+    """id всех пользователей, у которых есть незавершенный заказ"""
+    return await run_in_db(_user_ids)
+
+
+@metrics.timed()
+async def register_user(data):
+    """Сохранение заказа, возвращает сохраненную запись Registration в виде словаря (с id)"""
+    return await run_in_db(_register_user, data)
+
+
+@metrics.timed()
+async def get_registration(registration_id):
+    """Заказ по первичному ключу или None"""
+    return await run_in_db(_get_registration, registration_id)
 
 
 db.generate_mapping(create_tables=True)
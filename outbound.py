@@ -0,0 +1,234 @@
+import asyncio
+import contextlib
+import contextvars
+import itertools
+import time
+from heapq import heappop, heappush
+
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter
+
+from config import (SEND_CHAT_BURST, SEND_CHAT_RATE, SEND_GLOBAL_BURST, SEND_GLOBAL_RATE, SEND_MAX_RETRIES,
+                    SEND_TRACKED_CHATS)
+
+# Приоритеты отправки: ответы пользователям раньше рассылок и служебных оповещений
+INTERACTIVE = 0
+BULK = 10
+
+send_priority = contextvars.ContextVar('send_priority', default=INTERACTIVE)
+
+# Методы Bot API, которые отправляют сообщение в чат и попадают под лимиты Telegram
+SCHEDULED_METHODS = frozenset((
+    'sendMessage', 'sendPhoto', 'sendDocument', 'sendMediaGroup', 'sendAnimation', 'sendAudio', 'sendVideo',
+    'sendVoice', 'sendSticker', 'sendLocation', 'sendContact', 'sendPoll', 'sendDice', 'forwardMessage',
+    'copyMessage',
+))
+
+
+@contextlib.contextmanager
+def priority(value):
+    """Приоритет всех отправок внутри блока: with priority(BULK): await bot.send_message(...)"""
+    token = send_priority.set(value)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+        self.blocked_until = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Через сколько секунд можно будет взять токен"""
+        self._refill(now)
+        wait = 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, now, seconds):
+        """Запрет отправки на seconds секунд (retry_after из ответа Telegram)"""
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+
+def _rewind(files):
+    """Файлы перед повторной отправкой читаются с начала"""
+    for value in (files or {}).values():
+        file = getattr(value, 'file', value)
+        if hasattr(file, 'seek'):
+            file.seek(0)
+
+
+class OutboundScheduler:
+    """Очередь исходящих сообщений с лимитами Telegram.
+
+    Отправка ждет токен общей корзины (global_rate сообщений в секунду) и корзины своего чата
+    (chat_rate в секунду). Из очереди первыми берутся сообщения с меньшим приоритетом, пока чат
+    упирается в свой лимит, отправляются сообщения других чатов. На ответ 429 на retry_after секунд
+    блокируются и чат, и общая корзина (Telegram отвечает 429 и за превышение общего лимита),
+    сообщение повторяется до max_retries раз.
+    """
+
+    def __init__(self, global_rate=SEND_GLOBAL_RATE, global_burst=SEND_GLOBAL_BURST, chat_rate=SEND_CHAT_RATE,
+                 chat_burst=SEND_CHAT_BURST, max_retries=SEND_MAX_RETRIES, tracked_chats=SEND_TRACKED_CHATS):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.tracked_chats = tracked_chats
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_buckets = {}
+        self._queue = []
+        self._delayed = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._sending = set()
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= self.tracked_chats:
+                self.chat_buckets = {chat: bucket for chat, bucket in self.chat_buckets.items()
+                                     if not bucket.idle(now)}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        return bucket
+
+    async def send(self, chat_id, call, priority=INTERACTIVE):
+        """Отправка через очередь: call - функция без аргументов, которая делает запрос к Bot API"""
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.run())
+        future = loop.create_future()
+        heappush(self._queue, (priority, next(self._seq), chat_id, call, future, time.monotonic(), 0))
+        self._wakeup.set()
+        return await future
+
+    def _release_delayed(self, now):
+        while self._delayed and self._delayed[0][0] <= now:
+            heappush(self._queue, heappop(self._delayed)[1])
+
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            self._release_delayed(now)
+            if not self._queue:
+                self._wakeup.clear()
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                continue
+
+            global_delay = self.global_bucket.delay(now)
+            if global_delay > 0:
+                await asyncio.sleep(global_delay)
+                continue
+
+            job = heappop(self._queue)
+            _, _, chat_id, _, future, enqueued, _ = job
+            if future.done():
+                continue
+            bucket = self._chat_bucket(chat_id, now)
+            chat_delay = bucket.delay(now)
+            if chat_delay > 0:
+                heappush(self._delayed, (now + chat_delay, job))
+                continue
+
+            self.global_bucket.take(now)
+            bucket.take(now)
+            wait = now - enqueued
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            task = asyncio.ensure_future(self._send(job))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, job):
+        priority, seq, chat_id, call, future, enqueued, attempts = job
+        try:
+            result = await call()
+        except RetryAfter as exc:
+            self.retries += 1
+            now = time.monotonic()
+            self.global_bucket.block(now, exc.timeout)
+            self._chat_bucket(chat_id, now).block(now, exc.timeout)
+            if attempts >= self.max_retries:
+                self.failed += 1
+                # Отправитель мог уже отменить ожидание
+                if not future.done():
+                    future.set_exception(exc)
+                return
+            heappush(self._queue, (priority, seq, chat_id, call, future, enqueued, attempts + 1))
+            self._wakeup.set()
+        except Exception as exc:
+            self.failed += 1
+            if not future.done():
+                future.set_exception(exc)
+        else:
+            self.sent += 1
+            if not future.done():
+                future.set_result(result)
+
+    def queue_depth(self):
+        return len(self._queue) + len(self._delayed)
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue_depth(),
+            'in_flight': len(self._sending),
+            'sent': self.sent,
+            'retries': self.retries,
+            'failed': self.failed,
+            'wait_avg': self.wait_total / self.sent if self.sent else 0.0,
+            'wait_max': self.wait_max,
+        }
+
+    async def close(self, timeout=5):
+        """Остановка после отправки того, что уже в очереди (не дольше timeout секунд)"""
+        deadline = time.monotonic() + timeout
+        while (self.queue_depth() or self._sending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+class ScheduledBot(Bot):
+    """Bot, который отправляет сообщения в чаты через OutboundScheduler"""
+
+    def __init__(self, *args, scheduler=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = OutboundScheduler() if scheduler is None else scheduler
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        if method not in SCHEDULED_METHODS or not data or 'chat_id' not in data:
+            return await super().request(method, data, files, **kwargs)
+
+        request = super().request
+
+        async def call():
+            _rewind(files)
+            return await request(method, data, files, **kwargs)
+
+        return await self.scheduler.send(data['chat_id'], call, send_priority.get())
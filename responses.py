@@ -0,0 +1,31 @@
+class Reply:
+    """Ответ обработчика, собранный в одно сообщение.
+
+    Части текста добавляются через add и отправляются одним вызовом Bot API вместе с клавиатурой,
+    вместо отдельного сообщения на каждую строку.
+    """
+
+    def __init__(self, message, sep='\n'):
+        self.message = message
+        self.sep = sep
+        self.parts = []
+        self.reply_markup = None
+
+    def add(self, *parts):
+        self.parts.extend(parts)
+        return self
+
+    def keyboard(self, reply_markup):
+        self.reply_markup = reply_markup
+        return self
+
+    @property
+    def text(self):
+        return self.sep.join(str(part) for part in self.parts)
+
+    async def send(self, reply=False, **kwargs):
+        """Отправка ответа: reply=True - ответом на сообщение пользователя"""
+        if self.reply_markup is not None:
+            kwargs['reply_markup'] = self.reply_markup
+        send = self.message.reply if reply else self.message.answer
+        return await send(self.text, **kwargs)
@@ -0,0 +1,52 @@
+from array import array
+
+from config import CITIES_AND_FLIGHT_TIME
+
+NO_ROUTE = -1
+
+
+def build_route_table(cities_and_flight_time):
+    """Интернирование городов, симметричная матрица времени полета и пары городов без сообщения (None в конфиге)"""
+    cities = []
+    for city_from, destinations in cities_and_flight_time.items():
+        for city in (city_from, *(destinations or ())):
+            if city not in cities:
+                cities.append(city)
+
+    city_ids = {city: index for index, city in enumerate(cities)}
+    size = len(cities)
+    flight_times = array('b', [NO_ROUTE]) * (size * size)
+    closed = set()
+
+    for city_from, destinations in cities_and_flight_time.items():
+        for city_to, flight_time in (destinations or {}).items():
+            from_id, to_id = city_ids[city_from], city_ids[city_to]
+            if flight_time is None:
+                closed.update(((from_id, to_id), (to_id, from_id)))
+                continue
+            flight_times[from_id * size + to_id] = flight_time
+            flight_times[to_id * size + from_id] = flight_time
+
+    return tuple(cities), city_ids, flight_times, frozenset(closed)
+
+
+CITIES, CITY_IDS, FLIGHT_TIMES, CLOSED_PAIRS = build_route_table(CITIES_AND_FLIGHT_TIME)
+CITIES_COUNT = len(CITIES)
+
+
+def flight_time_by_id(from_id, to_id):
+    """Время полета в часах по идентификаторам городов или None, если рейса нет"""
+    flight_time = FLIGHT_TIMES[from_id * CITIES_COUNT + to_id]
+    return None if flight_time == NO_ROUTE else flight_time
+
+
+def flight_time(city_from, city_to):
+    """Время полета в часах между городами или None, если рейса нет"""
+    from_id, to_id = CITY_IDS.get(city_from), CITY_IDS.get(city_to)
+    if from_id is None or to_id is None:
+        return None
+    return flight_time_by_id(from_id, to_id)
+
+
+def has_route(city_from, city_to):
+    return flight_time(city_from, city_to) is not None
@@ -0,0 +1,113 @@
+import json
+import struct
+import zlib
+
+import routes
+
+SESSION_KEY = 'booking'
+VERSION = 2
+# id городов - номера в routes.CITIES, поэтому в сессии хранится и контрольная сумма списка городов:
+# после изменения CITIES_AND_FLIGHT_TIME старые id указывали бы на другие города
+CITIES_CHECKSUM = zlib.crc32('\n'.join(routes.CITIES).encode('utf8'))
+# Версия, контрольная сумма городов, флаги проверок городов, id городов, начало поиска рейсов, номер рейса,
+# места, длины строк
+HEADER = struct.Struct('<BIBbbqBBHH')
+CITY_FROM_CHECK = 1
+CITY_TO_CHECK = 2
+NO_CITY = -1
+NO_SEARCH = -1
+
+# Первый байт упакованной сессии в storage, остальные данные FSM хранятся в JSON и начинаются с '{'
+PACKED_PREFIX = b'\x01'
+
+
+class BookingSession:
+    """Данные заказа пользователя на шагах сценария Steps.
+
+    В FSM хранится упакованной в bytes (pack/unpack): города как id из routes,
+    рейс как начало поиска и номер варианта, строки - только комментарий и телефон.
+    Сессия другой версии формата или другого списка городов распаковывается как пустая.
+    """
+
+    __slots__ = ('city_from_check', 'city_to_check', 'city_from', 'city_to', 'flight_search',
+                 'chosen_flight', 'sits', 'comment', 'phone_number')
+
+    def __init__(self, city_from_check=False, city_to_check=False, city_from=None, city_to=None,
+                 flight_search=None, chosen_flight=None, sits=None, comment='', phone_number=''):
+        self.city_from_check = city_from_check
+        self.city_to_check = city_to_check
+        self.city_from = city_from
+        self.city_to = city_to
+        self.flight_search = flight_search
+        self.chosen_flight = chosen_flight
+        self.sits = sits
+        self.comment = comment
+        self.phone_number = phone_number
+
+    def __eq__(self, other):
+        if not isinstance(other, BookingSession):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'BookingSession({fields})'
+
+    def pack(self):
+        comment = self.comment.encode('utf8')
+        phone_number = self.phone_number.encode('utf8')
+        flags = (CITY_FROM_CHECK if self.city_from_check else 0) | (CITY_TO_CHECK if self.city_to_check else 0)
+        header = HEADER.pack(
+            VERSION, CITIES_CHECKSUM, flags,
+            NO_CITY if self.city_from is None else routes.CITY_IDS[self.city_from],
+            NO_CITY if self.city_to is None else routes.CITY_IDS[self.city_to],
+            NO_SEARCH if self.flight_search is None else self.flight_search,
+            self.chosen_flight or 0, self.sits or 0, len(comment), len(phone_number),
+        )
+        return header + comment + phone_number
+
+    @classmethod
+    def unpack(cls, packed):
+        if not packed or packed[0] != VERSION or len(packed) < HEADER.size:
+            return cls()
+        _, checksum, flags, city_from, city_to, flight_search, chosen_flight, sits, comment_size, phone_size = \
+            HEADER.unpack_from(packed)
+        if checksum != CITIES_CHECKSUM:
+            return cls()
+        comment_end = HEADER.size + comment_size
+        return cls(
+            city_from_check=bool(flags & CITY_FROM_CHECK),
+            city_to_check=bool(flags & CITY_TO_CHECK),
+            city_from=None if city_from == NO_CITY else routes.CITIES[city_from],
+            city_to=None if city_to == NO_CITY else routes.CITIES[city_to],
+            flight_search=None if flight_search == NO_SEARCH else flight_search,
+            chosen_flight=chosen_flight or None,
+            sits=sits or None,
+            comment=packed[HEADER.size:comment_end].decode('utf8'),
+            phone_number=packed[comment_end:comment_end + phone_size].decode('utf8'),
+        )
+
+
+async def load_session(state):
+    data = await state.get_data()
+    return BookingSession.unpack(data.get(SESSION_KEY))
+
+
+async def save_session(state, session):
+    await state.set_data({SESSION_KEY: session.pack()})
+
+
+def dumps(data):
+    """Сериализация данных FSM для хранилищ: сессия заказа хранится как есть, без JSON"""
+    if len(data) == 1 and isinstance(data.get(SESSION_KEY), bytes):
+        return PACKED_PREFIX + data[SESSION_KEY]
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf8')
+
+
+def loads(value):
+    if not value:
+        return {}
+    value = bytes(value)
+    if value[:1] == PACKED_PREFIX:
+        return {SESSION_KEY: value[1:]}
+    return json.loads(value)
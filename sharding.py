@@ -0,0 +1,333 @@
+import asyncio
+import multiprocessing
+import multiprocessing.connection
+import queue
+import signal
+import time
+import zlib
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiohttp import web
+
+import expiry
+import handlers
+import metrics
+import models
+import session
+import webhook
+from config import (FSM_STORAGE, LOG_PATH, METRICS_HOST, METRICS_PORT, STATE_JOURNAL_PATH, WEBHOOK_PATH,
+                    WORKER_CONCURRENCY, WORKER_QUEUE_SIZE, WORKER_RETRY_DELAY, WORKER_START_TIMEOUT)
+from outbound import ScheduledBot
+from storage import PonyStorage, SharedDictStorage
+from ticket_renderer import renderer
+
+STORAGES = ('pony', 'shared', 'memory')
+CHAT_UPDATE_TYPES = ('message', 'edited_message', 'channel_post', 'edited_channel_post')
+
+
+class WorkerDied(RuntimeError):
+    """Процесс-обработчик завершился, не сообщив о готовности или об обработке всех обновлений"""
+
+
+def shard_for(chat_id, workers):
+    """Номер процесса-обработчика для чата: обновления одного чата всегда попадают в один процесс"""
+    return zlib.crc32(str(chat_id).encode()) % workers
+
+
+def update_chat_id(update):
+    """chat.id обновления Telegram (словарь), для обновлений без чата - id пользователя"""
+    for update_type in CHAT_UPDATE_TYPES:
+        if update_type in update:
+            return update[update_type]['chat']['id']
+    callback_query = update.get('callback_query')
+    if callback_query and 'message' in callback_query:
+        return callback_query['message']['chat']['id']
+    for value in update.values():
+        if isinstance(value, dict) and 'from' in value:
+            return value['from']['id']
+    return 0
+
+
+def make_storage(name, shared_records=None):
+    if name == 'pony':
+        return PonyStorage(dumps=session.dumps, loads=session.loads)
+    if name == 'shared':
+        return SharedDictStorage(shared_records)
+    if name == 'memory':
+        return MemoryStorage()
+    raise ValueError(f'Неизвестное хранилище FSM: {name}')
+
+
+async def _process(dp, update, slots):
+    try:
+        await dp.process_update(types.Update(**update))
+    except Exception as exc:
+        handlers.log.exception(exc)
+    finally:
+        slots.release()
+
+
+async def _serve(index, workers, token, updates, results, storage_name, shared_records, bot_class):
+    bot = bot_class(token=token, parse_mode='HTML')
+    storage = make_storage(storage_name, shared_records)
+    dp = Dispatcher(bot, storage=storage)
+    handlers.register_handlers(dp, handlers.handlers_config)
+    sweeper = expiry.SessionSweeper(storage)
+    dp.middleware.setup(expiry.ActivityMiddleware(sweeper))
+    metrics.add_bot_collectors(bot, sweeper)
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+
+    # У каждого процесса свой журнал отложенных записей, после перезапуска он восстанавливается тем же номером
+    if models.state_buffer.journal_path is not None:
+        models.state_buffer.journal_path = f'{STATE_JOURNAL_PATH}.{index}'
+    await models.run_in_db(models.state_buffer.recover)
+    await sweeper.seed(owns=lambda user_id: shard_for(user_id, workers) == index)
+    background = [asyncio.create_task(models.state_buffer.run()), asyncio.create_task(sweeper.run(handlers.log))]
+    if isinstance(storage, PonyStorage):
+        background.append(asyncio.create_task(storage.run()))
+    renderer.start()
+    results.send(('ready', None))
+
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(WORKER_CONCURRENCY)
+    tasks = set()
+    processed = 0
+    metrics_runner = None
+    try:
+        if METRICS_PORT is not None:
+            # Без метрик процесс работает, поэтому занятый порт не мешает обработке обновлений
+            try:
+                metrics_runner = await metrics.start_server(METRICS_HOST, METRICS_PORT + 1 + index)
+            except OSError as exc:
+                handlers.log.error('Сервер метрик процесса %s на %s:%s не запущен: %s', index, METRICS_HOST,
+                                   METRICS_PORT + 1 + index, exc)
+        while True:
+            batch = [await loop.run_in_executor(None, updates.get)]
+            # Все, что уже лежит в очереди, забираем без лишних переходов между потоками
+            while batch[-1] is not None:
+                try:
+                    batch.append(updates.get_nowait())
+                except queue.Empty:
+                    break
+            for update in batch:
+                if update is None:
+                    break
+                await slots.acquire()
+                task = asyncio.create_task(_process(dp, update, slots))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                processed += 1
+            if batch[-1] is None:
+                break
+        await asyncio.gather(*tasks)
+    finally:
+        for task in background:
+            task.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await models.state_buffer.flush()
+        await storage.close()
+        renderer.close()
+        if isinstance(bot, ScheduledBot):
+            await bot.scheduler.close()
+        await (await bot.get_session()).close()
+    results.send(('done', processed))
+
+
+def run_worker(index, token, updates, results, storage_name, shared_records=None, bot_class=Bot, log_level=None,
+               workers=1):
+    """Точка входа процесса-обработчика: обрабатывает обновления из очереди updates до None"""
+    # Ctrl+C получает вся группа процессов, останавливает обработчики Supervisor.close
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # У каждого процесса свой файл лога, чтобы ротация в одном процессе не мешала записи в других
+    handlers.configure_logging(handlers.log, f'{LOG_PATH}.{index}')
+    if log_level is not None:
+        handlers.log.setLevel(log_level)
+    models.warm_up()
+    asyncio.run(_serve(index, workers, token, updates, results, storage_name, shared_records, bot_class))
+    models.executor.shutdown(wait=True)
+
+
+class Supervisor:
+    """Запуск workers процессов-обработчиков и распределение обновлений между ними по chat.id.
+
+    Состояние FSM пользователя живет в одном процессе, поэтому локальные кэши хранилища остаются верными.
+    Хранилище выбирается по имени из STORAGES, для shared общий словарь держит процесс multiprocessing.Manager.
+    Упавший процесс перезапускается при следующем обновлении для него с новой очередью,
+    обновления, которые ждали в старой очереди или обрабатывались, теряются (об этом пишется в лог).
+    """
+
+    def __init__(self, workers, token, storage_name=FSM_STORAGE, bot_class=Bot, log_level=None,
+                 queue_size=WORKER_QUEUE_SIZE, start_timeout=WORKER_START_TIMEOUT):
+        if storage_name not in STORAGES:
+            raise ValueError(f'Неизвестное хранилище FSM: {storage_name}')
+        self.workers = workers
+        self.token = token
+        self.storage_name = storage_name
+        self.bot_class = bot_class
+        self.log_level = log_level
+        self.queue_size = queue_size
+        self.start_timeout = start_timeout
+        self.queues = []
+        self.processes = []
+        self.restarts = 0
+        self._restart_lock = asyncio.Lock()
+        self._context = None
+        self._results = []
+        self._manager = None
+        self._shared_records = None
+
+    def _start_process(self, index):
+        """Процесс с номером index и канал, по которому он сообщает о готовности и о завершении"""
+        reader, writer = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=run_worker, name=f'bot-worker-{index}',
+            args=(index, self.token, self.queues[index], writer, self.storage_name, self._shared_records,
+                  self.bot_class, self.log_level, self.workers))
+        process.start()
+        # Пишет в канал только процесс: когда он завершится, чтение из канала закончится EOFError
+        writer.close()
+        return process, reader
+
+    def _wait(self, kind, indexes, timeout=None):
+        """Ответы kind процессов indexes: ({номер: значение}, номера процессов, которые завершились без ответа)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        pending = set(indexes)
+        received = {}
+        dead = []
+        while pending:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            ready = multiprocessing.connection.wait([self._results[index] for index in pending], remaining)
+            if not ready:
+                raise TimeoutError(f'Процессы-обработчики {sorted(pending)} не ответили {kind!r} за {timeout} с')
+            for index in sorted(pending):
+                if self._results[index] not in ready:
+                    continue
+                try:
+                    result_kind, value = self._results[index].recv()
+                except EOFError:
+                    dead.append(index)
+                    pending.discard(index)
+                    continue
+                # Перед 'done' перезапущенного процесса в канале лежит его 'ready'
+                if result_kind == kind:
+                    received[index] = value
+                    pending.discard(index)
+        return received, sorted(dead)
+
+    def _stop_processes(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        for reader in self._results:
+            reader.close()
+
+    def start(self):
+        """Запуск процессов, возвращается после того, как все они готовы принимать обновления"""
+        self._context = multiprocessing.get_context('spawn')
+        if self.storage_name == 'shared':
+            self._manager = self._context.Manager()
+            self._shared_records = self._manager.dict()
+        self.queues = [self._context.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+        self.processes, self._results = map(list, zip(*(self._start_process(index) for index in range(self.workers))))
+        try:
+            _, dead = self._wait('ready', range(self.workers), self.start_timeout)
+        except TimeoutError:
+            self._stop_processes()
+            raise
+        if dead:
+            self._stop_processes()
+            raise WorkerDied(f'Процессы-обработчики {dead} завершились при запуске, коды выхода: '
+                             f'{[self.processes[index].exitcode for index in dead]}')
+
+    def _restart(self, index):
+        """Новый процесс с новыми очередью и каналом: умерший мог держать блокировку чтения старой очереди"""
+        process = self.processes[index]
+        process.join()
+        lost = self.queues[index].qsize()
+        # Старую очередь никто не прочитает, выход из процесса не должен ждать записи в нее
+        self.queues[index].cancel_join_thread()
+        handlers.log.error('Процесс-обработчик %s завершился с кодом %s, перезапускаем. Потеряны обновления '
+                           'в его очереди (%s) и те, что он не успел обработать', index, process.exitcode, lost)
+        self._results[index].close()
+        self.queues[index] = self._context.Queue(maxsize=self.queue_size)
+        self.processes[index], self._results[index] = self._start_process(index)
+        self.restarts += 1
+
+    def dispatch(self, update):
+        """Передача обновления (словарь из JSON Telegram) процессу, который ведет этот чат.
+
+        Не ждет места в очереди: если очередь процесса полна, сразу выбрасывается queue.Full.
+        """
+        index = shard_for(update_chat_id(update), self.workers)
+        if not self.processes[index].is_alive():
+            self._restart(index)
+        self.queues[index].put_nowait(update)
+
+    async def dispatch_async(self, update):
+        """dispatch для цикла событий основного процесса: перезапуск упавшего процесса (join и запуск нового)
+        идет в потоке, чтобы не останавливать прием обновлений для остальных процессов"""
+        index = shard_for(update_chat_id(update), self.workers)
+        if not self.processes[index].is_alive():
+            async with self._restart_lock:
+                if not self.processes[index].is_alive():
+                    await asyncio.get_running_loop().run_in_executor(None, self._restart, index)
+        self.queues[index].put_nowait(update)
+
+    def close(self):
+        """Остановка после обработки всех переданных обновлений, возвращает их число по всем процессам"""
+        alive = [index for index, process in enumerate(self.processes) if process.is_alive()]
+        for index in alive:
+            self.queues[index].put(None)
+        try:
+            done, dead = self._wait('done', alive)
+        finally:
+            self._stop_processes()
+            if self._manager is not None:
+                self._shared_records = None
+                self._manager.shutdown()
+        dead = sorted(set(range(self.workers)) - set(alive) | set(dead))
+        if dead:
+            raise WorkerDied(f'Процессы-обработчики {dead} завершились до остановки, коды выхода: '
+                             f'{[self.processes[index].exitcode for index in dead]}, '
+                             f'обработано обновлений остальными: {sum(done.values())}')
+        return sum(done.values())
+
+
+async def poll_updates(bot, supervisor, timeout=20, retry_delay=WORKER_RETRY_DELAY):
+    """Long polling в основном процессе: обновления не обрабатываются, а раздаются обработчикам"""
+    offset = None
+    skipped = await bot.get_updates(offset=-1, timeout=1)
+    if skipped:
+        offset = skipped[-1].update_id + 1
+    while True:
+        # Необработанные обновления (в том числе не поместившиеся в очередь) придут снова с тем же offset
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=timeout)
+            for update in updates:
+                await supervisor.dispatch_async(update.to_python())
+                offset = update.update_id + 1
+        except queue.Full:
+            handlers.log.warning('Очередь процесса-обработчика полна, повтор через %s с', retry_delay)
+            await asyncio.sleep(retry_delay)
+        except Exception as exc:
+            handlers.log.exception(exc)
+            await asyncio.sleep(retry_delay)
+
+
+def create_front_app(supervisor):
+    """Приложение webhook в основном процессе: принимает обновления и раздает их обработчикам"""
+    async def receive_update(request):
+        try:
+            await supervisor.dispatch_async(await request.json())
+        except queue.Full:
+            # Telegram повторит доставку позже
+            raise web.HTTPServiceUnavailable()
+        return web.Response(text='ok')
+
+    app = webhook.create_app()
+    app.router.add_post(WEBHOOK_PATH, receive_update)
+    return app
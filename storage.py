@@ -0,0 +1,363 @@
+import asyncio
+import copy
+import json
+import typing
+from collections import OrderedDict
+
+from aiogram.dispatcher.storage import BaseStorage
+from pony.orm import db_session
+
+import models
+from config import FSM_CACHE_SIZE, FSM_FLUSH_INTERVAL, FSM_FLUSH_SIZE
+from models import FSMSession, db
+
+EMPTY_RECORD = {'state': None, 'data': {}, 'bucket': {}}
+
+
+def json_dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf8')
+
+
+def json_loads(value):
+    return json.loads(value) if value else {}
+
+
+def _load_record(chat, user):
+    """Чтение сессии из БД, выполняется в потоке БД"""
+    with db_session:
+        session = FSMSession.get(chat=chat, user=user)
+        return None if session is None else (session.state, session.data, session.bucket)
+
+
+def _write_records(records):
+    """Запись измененных сессий: upsert для непустых и DELETE для пустых, по запросу на пачку"""
+    quote = db.provider.quote_name
+    table = quote(FSMSession._table_)
+    chat, user, state, data, bucket = (quote(getattr(FSMSession, name).column)
+                                       for name in ('chat', 'user', 'state', 'data', 'bucket'))
+    upserts = [(key, record) for key, record in records.items() if record is not None]
+    deletes = [key for key, record in records.items() if record is None]
+    with db_session:
+        for chunk_start in range(0, len(upserts), models.UPSERT_CHUNK_SIZE):
+            params = {}
+            values = []
+            for index, ((chat_id, user_id), record) in enumerate(
+                    upserts[chunk_start:chunk_start + models.UPSERT_CHUNK_SIZE]):
+                params.update({f'chat_{index}': chat_id, f'user_{index}': user_id, f'state_{index}': record[0],
+                               f'data_{index}': record[1], f'bucket_{index}': record[2]})
+                values.append(f'($chat_{index}, $user_{index}, $state_{index}, $data_{index}, $bucket_{index})')
+            db.execute(
+                f'INSERT INTO {table} ({chat}, {user}, {state}, {data}, {bucket}) VALUES {", ".join(values)} '
+                f'ON CONFLICT ({chat}, {user}) DO UPDATE SET {state} = EXCLUDED.{state}, '
+                f'{data} = EXCLUDED.{data}, {bucket} = EXCLUDED.{bucket}',
+                params
+            )
+        for chunk_start in range(0, len(deletes), models.UPSERT_CHUNK_SIZE):
+            params = {}
+            conditions = []
+            for index, (chat_id, user_id) in enumerate(deletes[chunk_start:chunk_start + models.UPSERT_CHUNK_SIZE]):
+                params.update({f'chat_{index}': chat_id, f'user_{index}': user_id})
+                conditions.append(f'({chat} = $chat_{index} AND {user} = $user_{index})')
+            db.execute(f'DELETE FROM {table} WHERE {" OR ".join(conditions)}', params)
+
+
+class PonyStorage(BaseStorage):
+    """Хранилище FSM в БД Pony, которое переживает перезапуск бота.
+
+    Сессии читаются через LRU-кэш на cache_size записей, поэтому активные пользователи
+    не обращаются к БД при чтении. Изменения копятся и записываются пачкой по таймеру (run),
+    при накоплении flush_size измененных сессий и при закрытии хранилища.
+
+    Кэш и отложенная запись рассчитаны на одного владельца сессии: другой процесс с тем же
+    хранилищем прочитает устаревшие данные. Несколько процессов могут работать с одной БД,
+    только если каждый чат обслуживается одним процессом (sharding.shard_for), для общих
+    сессий нужен SharedDictStorage.
+    """
+
+    def __init__(self, cache_size=FSM_CACHE_SIZE, flush_interval=FSM_FLUSH_INTERVAL, flush_size=FSM_FLUSH_SIZE,
+                 dumps=json_dumps, loads=json_loads):
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.dumps = dumps
+        self.loads = loads
+        self._cache = OrderedDict()
+        self._dirty = {}
+        self._flushing = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+
+    async def _record(self, chat, user):
+        chat, user = map(str, self.check_address(chat=chat, user=user))
+        key = chat, user
+        record = self._cache.get(key)
+        if record is not None:
+            self._cache.move_to_end(key)
+            return key, record
+
+        record = self._unsaved(key)
+        if record is None:
+            loaded = await models.run_in_db(_load_record, chat, user)
+            # Пока шло чтение, сессию могли загрузить или изменить другие обработчики
+            record = self._cache.get(key) or self._unsaved(key)
+            if record is None:
+                record = copy.deepcopy(EMPTY_RECORD) if loaded is None else self._decode(loaded)
+
+        self._cache[key] = record
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return key, record
+
+    def _decode(self, loaded):
+        state, data, bucket = loaded
+        return {'state': state, 'data': self.loads(data), 'bucket': self.loads(bucket)}
+
+    def _unsaved(self, key):
+        """Измененная сессия, которая еще не записана в БД (могла уйти из кэша)"""
+        record = self._dirty.get(key)
+        return record if record is not None else self._flushing.get(key)
+
+    def _mark_dirty(self, key, record):
+        self._dirty[key] = record
+        if len(self._dirty) >= self.flush_size and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        """Запись накопленных изменений в БД"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return 0
+            self._flushing, self._dirty = self._dirty, {}
+            records = {
+                key: None if record == EMPTY_RECORD else
+                (record['state'], self.dumps(record['data']), self.dumps(record['bucket']))
+                for key, record in self._flushing.items()
+            }
+            try:
+                await models.run_in_db(_write_records, records)
+            except Exception:
+                for key, record in self._flushing.items():
+                    self._dirty.setdefault(key, record)
+                raise
+            finally:
+                self._flushing = {}
+            return len(records)
+
+    async def run(self):
+        """Периодическая запись изменений"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def evict(self, chat, user):
+        """Удаление сессии из кэша и из БД при следующей записи, возвращает удаленную запись или None.
+
+        Сессия, которой нет в памяти, читается из БД, чтобы вернуть ее и не удалять несуществующие строки.
+        """
+        key = tuple(map(str, self.check_address(chat=chat, user=user)))
+        record = self._cache.pop(key, None) or self._unsaved(key)
+        if record is None:
+            loaded = await models.run_in_db(_load_record, *key)
+            # Пока шло чтение, сессию могли загрузить или изменить другие обработчики
+            record = self._cache.pop(key, None) or self._unsaved(key)
+            if record is None and loaded is not None:
+                record = self._decode(loaded)
+        if record is None or record == EMPTY_RECORD:
+            return None
+        self._mark_dirty(key, copy.deepcopy(EMPTY_RECORD))
+        return record
+
+    async def close(self):
+        await self.flush()
+        self._cache.clear()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        key, record = await self._record(chat, user)
+        return record['state'] if record['state'] is not None else self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[str] = None) -> typing.Dict:
+        key, record = await self._record(chat, user)
+        return copy.deepcopy(record['data'] or default or {})
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        key, record = await self._record(chat, user)
+        record['data'].update(data or {}, **kwargs)
+        self._mark_dirty(key, record)
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        key, record = await self._record(chat, user)
+        record['state'] = self.resolve_state(state)
+        self._mark_dirty(key, record)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key, record = await self._record(chat, user)
+        record['data'] = copy.deepcopy(data or {})
+        self._mark_dirty(key, record)
+
+    async def reset_state(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          with_data: typing.Optional[bool] = True):
+        key, record = await self._record(chat, user)
+        record['state'] = None
+        if with_data:
+            record['data'] = {}
+        self._mark_dirty(key, record)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        key, record = await self._record(chat, user)
+        return copy.deepcopy(record['bucket'] or default or {})
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        key, record = await self._record(chat, user)
+        record['bucket'] = copy.deepcopy(bucket or {})
+        self._mark_dirty(key, record)
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        key, record = await self._record(chat, user)
+        record['bucket'].update(bucket or {}, **kwargs)
+        self._mark_dirty(key, record)
+
+
+class SharedDictStorage(BaseStorage):
+    """Хранилище FSM в общем для нескольких процессов словаре.
+
+    Локальная замена общего хранилища (Redis и т.п.) для запуска с несколькими процессами-обработчиками:
+    records - словарь multiprocessing.Manager().dict() или обычный dict в одном процессе.
+    Сессия записывается целиком, потому что прокси словаря не видит изменений вложенных объектов.
+    """
+
+    def __init__(self, records):
+        self.records = records
+
+    def _key(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        return f'{chat}:{user}'
+
+    def _get(self, key):
+        record = self.records.get(key)
+        return copy.deepcopy(EMPTY_RECORD) if record is None else record
+
+    def _put(self, key, record):
+        if record == EMPTY_RECORD:
+            self.records.pop(key, None)
+        else:
+            self.records[key] = record
+
+    async def evict(self, chat, user):
+        """Удаление сессии, возвращает удаленную запись или None"""
+        return self.records.pop(self._key(chat, user), None)
+
+    async def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        state = self._get(self._key(chat, user))['state']
+        return state if state is not None else self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[str] = None) -> typing.Dict:
+        return copy.deepcopy(self._get(self._key(chat, user))['data'] or default or {})
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        key = self._key(chat, user)
+        record = self._get(key)
+        record['data'].update(data or {}, **kwargs)
+        self._put(key, record)
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        key = self._key(chat, user)
+        record = self._get(key)
+        record['state'] = self.resolve_state(state)
+        self._put(key, record)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key = self._key(chat, user)
+        record = self._get(key)
+        record['data'] = copy.deepcopy(data or {})
+        self._put(key, record)
+
+    async def reset_state(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          with_data: typing.Optional[bool] = True):
+        key = self._key(chat, user)
+        record = self._get(key)
+        record['state'] = None
+        if with_data:
+            record['data'] = {}
+        self._put(key, record)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        return copy.deepcopy(self._get(self._key(chat, user))['bucket'] or default or {})
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        key = self._key(chat, user)
+        record = self._get(key)
+        record['bucket'] = copy.deepcopy(bucket or {})
+        self._put(key, record)
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        key = self._key(chat, user)
+        record = self._get(key)
+        record['bucket'].update(bucket or {}, **kwargs)
+        self._put(key, record)
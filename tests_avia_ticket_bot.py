@@ -1,5 +1,18 @@
+import asyncio
+import concurrent.futures
+import contextlib
 import datetime
+import importlib.util
+import inspect
+import json
 import logging
+import os
+import queue
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
 
 import pytest
 
@@ -8,18 +21,45 @@ import unittest.mock
 from aiogram import Bot, Dispatcher, types
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
-from pony.orm import db_session, rollback
+from aiogram.dispatcher.webhook import configure_app
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from pony.orm import db_session, delete
 
+import city_recognizer
+import connections
+import expiry
 import handlers
+import log_pipeline
+import metrics
+import models
+import outbound
+import routes
+import session
+import sharding
 import states
+import utils
+import validators
+import webhook
 from handlers import handlers_config
-from models import UserState, Registration
-from generate_ticket import draw_ticket
+from models import UserState, Registration, FSMSession
+from storage import PonyStorage, SharedDictStorage
+from generate_ticket import draw_ticket, reissue_ticket, send_ticket
+from ticket_cache import TicketCache
+from timetable import Timetable
+from config import CITIES_AND_FLIGHT_TIME, WEBHOOK_PATH
+from flight_cache import FlightCache
+from ticket_renderer import TicketRenderer, IMAGE_PATH, render_ticket
 
 handlers.log.setLevel(logging.WARN)
+models.state_buffer.journal_path = None
 USER_ID = 1234567890
+TEST_USER_IDS = (USER_ID, 1234)
 USERNAME = 'Вася'
 _flight_date = (datetime.datetime.today() + datetime.timedelta(days=256)).strftime('%d-%m-%Y')
+_flight_datetime = datetime.datetime.strptime(_flight_date, '%d-%m-%Y')
+# Ответ Telegram на отправку билета: бот запоминает file_id самой большой картинки
+SENT_TICKET = types.Message(photo=[types.PhotoSize(file_id='small'), types.PhotoSize(file_id='big')])
 
 TEST_MESSAGES_CORRECT = [
     'Москваа',
@@ -55,6 +95,17 @@ TEST_MESSAGES_SAME_CITIES = [
     ('Крым', handlers_config['state_handlers'][3]),
 ]
 
+TEST_MESSAGES_CONNECTION = [
+    ('Рио-де-Жанейро', handlers_config['state_handlers'][1]),
+    ('Южно-Сахалинск', handlers_config['state_handlers'][3]),
+    (_flight_date, handlers_config['state_handlers'][5]),
+]
+
+TEST_MESSAGES_NO_CONNECTION = [
+    ('Сен-Тропе', handlers_config['state_handlers'][1]),
+    ('Южно-Сахалинск', handlers_config['state_handlers'][3]),
+]
+
 TEST_MESSAGES_VALIDATE_CANCEL = [
     ('Ереван', handlers_config['state_handlers'][1]),
     ('Пекин', handlers_config['state_handlers'][3]),
@@ -66,12 +117,44 @@ TEST_MESSAGES_VALIDATE_CANCEL = [
 ]
 
 
+async def run_state_handler(handler_info, message_mock, state):
+    """Вызов обработчика шага так же, как это делает Dispatcher: фильтр, затем обработчик с value"""
+    result = handler_info[1](message_mock)
+    if not result:
+        raise ValueError(f'Сообщение {message_mock.text!r} не проходит фильтр {handler_info[0].__name__}')
+    kwargs = {'message': message_mock, 'state': state, **(result if isinstance(result, dict) else {})}
+    parameters = inspect.signature(handler_info[0]).parameters
+    await handler_info[0](**{name: value for name, value in kwargs.items() if name in parameters})
+
+
+@contextlib.contextmanager
+def without_direct_flight(city_a, city_b):
+    """Таблица маршрутов без прямого рейса между city_a и city_b: между ними летают только с пересадками"""
+    table = {city: dict(destinations or {}) for city, destinations in CITIES_AND_FLIGHT_TIME.items()}
+    table[city_a].pop(city_b, None)
+    table[city_b].pop(city_a, None)
+    cities, city_ids, flight_times, closed_pairs = routes.build_route_table(table)
+    with unittest.mock.patch.multiple(routes, CITIES=cities, CITY_IDS=city_ids, FLIGHT_TIMES=flight_times,
+                                      CLOSED_PAIRS=closed_pairs, CITIES_COUNT=len(cities)), \
+            unittest.mock.patch('utils.flight_cache', FlightCache()):
+        with unittest.mock.patch('connections.CONNECTION_TABLE', connections.build_connection_table()):
+            yield
+
+
 def isolate_db(test_func):
+    # Обработчики пишут в БД из пула потоков models.executor в отдельных транзакциях,
+    # поэтому вместо отката изменения тестового пользователя удаляются после теста
     async def wrapper(*args, **kwargs):
         with db_session:
-            user = UserState(user_id=USER_ID, username=USERNAME, user_state='default')
+            UserState(user_id=USER_ID, username=USERNAME, user_state='default')
+        try:
             await test_func(*args, **kwargs)
-            rollback()
+        finally:
+            for user_id in TEST_USER_IDS:
+                models.state_buffer.discard(user_id)
+            with db_session:
+                delete(user for user in UserState if user.user_id in TEST_USER_IDS)
+                delete(registration for registration in Registration if registration.user_id in TEST_USER_IDS)
 
     return wrapper
 
@@ -95,7 +178,9 @@ class TestEchoBot(unittest.IsolatedAsyncioTestCase):
             message_mock.chat.username = USERNAME
             message_mock.chat.id = USER_ID
             await handlers.send_welcome(message=message_mock, state=self.state)
-            message_mock.answer.assert_called_with(f'Доступные команды: /ticket, /help, /cancel')
+            message_mock.reply.assert_called_once()
+            assert message_mock.reply.call_args.args[0].endswith('Доступные команды: /ticket, /help, /cancel')
+            message_mock.answer.assert_not_called()
         else:
             raise ValueError('Ошибка в проверке команды test_send_welcome_handler')
 
@@ -159,18 +244,64 @@ class TestEchoBot(unittest.IsolatedAsyncioTestCase):
                 message_mock.chat.first_name = USERNAME
                 message_mock.chat.username = USERNAME
                 message_mock.chat.id = USER_ID
-                if handlers_config['state_handlers'][i][1](message_mock):
-                    try:
-                        await handlers_config['state_handlers'][i][0](message=message_mock,
-                                                                      state=self.state)
-                    except TypeError:
-                        await handlers_config['state_handlers'][i][0](message=message_mock)
-                else:
-                    raise ValueError('Ошибка в проверке сценария TEST_MESSAGES')
-            message_mock.answer.assert_called_with('Ваш электронный билет:')
+                message_mock.answer_photo.return_value = SENT_TICKET
+                await run_state_handler(handlers_config['state_handlers'][i], message_mock, self.state)
+            assert message_mock.answer_photo.call_args.kwargs['caption'].endswith('Ваш электронный билет:')
         else:
             raise ValueError('Ошибка в команде /ticket')
 
+    @pytest.mark.asyncio
+    @isolate_db
+    async def test_api_calls_per_handler(self):
+        """Каждый шаг заказа - один вызов Bot API (раньше 19 вызовов на заказ)"""
+        calls = {}
+        for text in ['/ticket'] + TEST_MESSAGES_CORRECT:
+            message_mock = unittest.mock.AsyncMock(text=text)
+            message_mock.chat.first_name = USERNAME
+            message_mock.chat.username = USERNAME
+            message_mock.chat.id = USER_ID
+            message_mock.answer_photo.return_value = SENT_TICKET
+            if text == '/ticket':
+                handler = handlers.ticket_start
+                await handler(message=message_mock, state=self.state)
+            else:
+                current_state = await self.state.get_state()
+                handler_info = next(handler_info for handler_info in handlers_config['state_handlers']
+                                    if handler_info[2].state == current_state and handler_info[1](message_mock))
+                handler = handler_info[0]
+                await run_state_handler(handler_info, message_mock, self.state)
+            calls[handler.__name__] = calls.get(handler.__name__, 0) + sum(
+                getattr(message_mock, method).await_count for method in ('answer', 'reply', 'answer_photo'))
+        assert calls == {'ticket_start': 1, 'ticket_from_invalid': 1, 'ticket_from': 1, 'ticket_to_invalid': 1,
+                         'ticket_to': 1, 'ticket_date_invalid': 1, 'ticket_date': 1,
+                         'ticket_choose_flight_invalid': 1, 'ticket_choose_flight': 1,
+                         'ticket_choose_sits_invalid': 1, 'ticket_choose_sits': 1, 'ticket_comment_invalid': 1,
+                         'ticket_comment': 1, 'ticket_correct_data': 1, 'ticket_phone_number_invalid': 1,
+                         'ticket_phone_number': 1}
+
+    @pytest.mark.asyncio
+    @isolate_db
+    async def test_step_latency_metrics(self):
+        """Поиск рейсов и отправка билета на шагах заказа попадают в гистограммы /stats и /metrics"""
+        names = ('utils._search', 'generate_ticket.send_ticket', 'ticket_renderer.TicketRenderer.render')
+        counts = {name: metrics.registry.timer(name).count for name in names}
+        with unittest.mock.patch('utils.flight_cache', FlightCache()), \
+                unittest.mock.patch('generate_ticket.ticket_cache', TicketCache()):
+            for text in ['/ticket'] + TEST_MESSAGES_CORRECT:
+                message_mock = unittest.mock.AsyncMock(text=text)
+                message_mock.chat.first_name = USERNAME
+                message_mock.chat.username = USERNAME
+                message_mock.chat.id = USER_ID
+                message_mock.answer_photo.return_value = SENT_TICKET
+                if text == '/ticket':
+                    await handlers.ticket_start(message=message_mock, state=self.state)
+                    continue
+                current_state = await self.state.get_state()
+                handler_info = next(handler_info for handler_info in handlers_config['state_handlers']
+                                    if handler_info[2].state == current_state and handler_info[1](message_mock))
+                await run_state_handler(handler_info, message_mock, self.state)
+        assert all(metrics.registry.timers[name].count > counts[name] for name in names)
+
     @pytest.mark.asyncio
     @isolate_db
     async def test_ticket_from_invalid_twice(self):
@@ -183,11 +314,7 @@ class TestEchoBot(unittest.IsolatedAsyncioTestCase):
             await handlers.ticket_start(message=message_mock, state=self.state)
             for message_text in TEST_MESSAGES_CITY_FROM_INVALID_TWICE:
                 message_mock = unittest.mock.AsyncMock(text=message_text)
-                if handlers_config['state_handlers'][0][1](message_mock):
-                    await handlers_config['state_handlers'][0][0](message=message_mock,
-                                                                  state=self.state)
-                else:
-                    raise ValueError('Ошибка в проверке сценария TEST_MESSAGES_CITY_FROM_INVALID_TWICE')
+                await run_state_handler(handlers_config['state_handlers'][0], message_mock, self.state)
             message_mock.answer.assert_called_with(
                 'Из указанного города нет рейсов\nДля повторного запуска бота - /ticket',
                 reply_markup=types.ReplyKeyboardRemove()
@@ -207,10 +334,7 @@ class TestEchoBot(unittest.IsolatedAsyncioTestCase):
             await handlers.ticket_start(message=message_mock, state=self.state)
             for message_data in TEST_MESSAGES_CITY_TO_INVALID_TWICE:
                 message_mock = unittest.mock.AsyncMock(text=message_data[0])
-                if message_data[1][1](message_mock):
-                    await message_data[1][0](message=message_mock, state=self.state)
-                else:
-                    raise ValueError('Ошибка в проверке сценария TEST_MESSAGES_CITY_TO_INVALID_TWICE')
+                await run_state_handler(message_data[1], message_mock, self.state)
             message_mock.answer.assert_called_with(
                 'В указанный город нет рейсов\nДля повторного запуска бота - /ticket',
                 reply_markup=types.ReplyKeyboardRemove())
@@ -227,16 +351,60 @@ class TestEchoBot(unittest.IsolatedAsyncioTestCase):
             await handlers.ticket_start(message=message_mock, state=self.state)
             for message_data in TEST_MESSAGES_SAME_CITIES:
                 message_mock = unittest.mock.AsyncMock(text=message_data[0])
-                if message_data[1][1](message_mock):
-                    await message_data[1][0](message=message_mock, state=self.state)
-                else:
-                    raise ValueError('Ошибка в проверке сценария TEST_MESSAGES_SAME_CITIES')
+                await run_state_handler(message_data[1], message_mock, self.state)
             message_mock.answer.assert_called_with(
                 'Города отправления и город назначения должны быть разными\n'
                 'Для повторного запуска бота введите /ticket',
                 reply_markup=types.ReplyKeyboardRemove()
             )
 
+    @pytest.mark.asyncio
+    @isolate_db
+    async def test_ticket_connection(self):
+        message_mock = unittest.mock.AsyncMock(text='/ticket')
+        message_mock.chat.username = USERNAME
+        message_mock.chat.id = USER_ID
+        await handlers.ticket_start(message=message_mock, state=self.state)
+        with without_direct_flight('Рио-де-Жанейро', 'Южно-Сахалинск'):
+            for message_data in TEST_MESSAGES_CONNECTION:
+                message_mock = unittest.mock.AsyncMock(text=message_data[0])
+                await run_state_handler(message_data[1], message_mock, self.state)
+        assert str(await self.state.get_state()) == 'Steps:flight_choice'
+        message_mock.answer.assert_called_once()
+        assert 'пересадки: Москва' in message_mock.answer.call_args.args[0]
+
+    @pytest.mark.asyncio
+    @isolate_db
+    async def test_ticket_no_connection(self):
+        message_mock = unittest.mock.AsyncMock(text='/ticket')
+        message_mock.chat.username = USERNAME
+        message_mock.chat.id = USER_ID
+        await handlers.ticket_start(message=message_mock, state=self.state)
+        for message_data in TEST_MESSAGES_NO_CONNECTION:
+            message_mock = unittest.mock.AsyncMock(text=message_data[0])
+            await run_state_handler(message_data[1], message_mock, self.state)
+        assert await self.state.get_state() is None
+        message_mock.answer.assert_called_with('Между указанными городами нет рейсов\n'
+                                               'Для повторного запуска бота введите /ticket',
+                                               reply_markup=types.ReplyKeyboardRemove())
+
+    @pytest.mark.asyncio
+    @isolate_db
+    async def test_comment_markdown_escaped(self):
+        message_mock = unittest.mock.AsyncMock(text='/ticket')
+        message_mock.chat.username = USERNAME
+        message_mock.chat.id = USER_ID
+        await handlers.ticket_start(message=message_mock, state=self.state)
+        comment = 'место_у окна *срочно* `[1]`'
+        for text, handler_info in TEST_MESSAGES_VALIDATE_CANCEL[:-1]:
+            message_mock = unittest.mock.AsyncMock(text=comment if text == 'comment123' else text)
+            await run_state_handler(handler_info, message_mock, self.state)
+        assert str(await self.state.get_state()) == 'Steps:validate_data'
+        text = message_mock.answer.call_args.args[0]
+        assert message_mock.answer.call_args.kwargs['parse_mode'] == types.ParseMode.MARKDOWN
+        assert 'Ваш комментарий: место\\_у окна \\*срочно\\* \\`\\[1\\]\\`' in text
+        assert (await session.load_session(self.state)).comment == comment
+
     @pytest.mark.asyncio
     @isolate_db
     async def test_validate_cancel(self):
@@ -249,10 +417,7 @@ class TestEchoBot(unittest.IsolatedAsyncioTestCase):
             await handlers.ticket_start(message=message_mock, state=self.state)
             for message_data in TEST_MESSAGES_VALIDATE_CANCEL:
                 message_mock = unittest.mock.AsyncMock(text=message_data[0])
-                if message_data[1][1](message_mock):
-                    await message_data[1][0](message=message_mock, state=self.state)
-                else:
-                    raise ValueError('Ошибка в проверке сценария TEST_MESSAGES_VALIDATE_CANCEL')
+                await run_state_handler(message_data[1], message_mock, self.state)
             message_mock.answer.assert_called_with(
                 'Для повторного заказа билетов введите /ticket', reply_markup=types.ReplyKeyboardRemove()
             )
@@ -260,19 +425,830 @@ class TestEchoBot(unittest.IsolatedAsyncioTestCase):
     @pytest.mark.asyncio
     @isolate_db
     async def test_draw_ticket(self):
-        test_ticket = Registration(
-            user_id='1234',
-            username='testuser',
-            chosen_flight='testflight',
-            sits='6',
-            comment='test',
-            phone_number='88005553535',
-        )
-        ticket_file = await draw_ticket('1234')
+        registration = await models.register_user([1234, 'testuser', 'testflight', 6, 'test', '88005553535'])
+        assert registration['id'] and registration['user_id'] == 1234
+        ticket_file = await draw_ticket(registration)
         with open('files/aviaticket_example.png', 'rb') as expected_file:
             expected_bytes = expected_file.read()
         assert ticket_file.read() == expected_bytes
 
+        message_mock = unittest.mock.AsyncMock()
+        message_mock.answer_photo.return_value = SENT_TICKET
+        with unittest.mock.patch('generate_ticket.ticket_cache', TicketCache()):
+            assert await reissue_ticket(message_mock, registration['id']) is SENT_TICKET
+            assert await reissue_ticket(message_mock, registration['id']) is SENT_TICKET
+        first, second = message_mock.answer_photo.call_args_list
+        assert first.args[0].read() == expected_bytes
+        assert second.args == ('big',)
+        assert await reissue_ticket(message_mock, -1) is None
+
+
+class TestModels(unittest.IsolatedAsyncioTestCase):
+
+    async def test_db_calls_leave_event_loop(self):
+        thread_name = await models.run_in_db(lambda: threading.current_thread().name)
+        assert thread_name.startswith('db')
+
+    @isolate_db
+    async def test_update_user(self):
+        await models.update_user(USER_ID, 'Дата вылета', persistence=models.STRONG)
+        with db_session:
+            assert UserState.get(user_id=USER_ID).user_state == 'Дата вылета'
+
+    @isolate_db
+    async def test_create_and_delete_user(self):
+        await models.create_user(USER_ID, None, 'Город отправления')
+        with db_session:
+            user = UserState.get(user_id=USER_ID)
+            assert (user.username, user.user_state) == ('', 'Город отправления')
+        assert await models.delete_user(USER_ID)
+        assert not await models.delete_user(USER_ID)
+
+    @isolate_db
+    async def test_update_user_write_behind(self):
+        await models.update_user(USER_ID, 'Город назначения')
+        await models.update_user(USER_ID, 'Дата вылета')
+        with db_session:
+            assert UserState.get(user_id=USER_ID).user_state == 'default'
+        assert await models.state_buffer.flush() == 1
+        with db_session:
+            assert UserState.get(user_id=USER_ID).user_state == 'Дата вылета'
+
+        await models.update_user(USER_ID, 'Выбор рейса')
+        await models.delete_user(USER_ID)
+        assert await models.state_buffer.flush() == 0
+        with db_session:
+            assert UserState.get(user_id=USER_ID) is None
+
+    @isolate_db
+    async def test_state_buffer_recover(self):
+        with tempfile.TemporaryDirectory() as directory:
+            journal_path = os.path.join(directory, 'user_state.journal')
+            crashed = models.StateBuffer(journal_path=journal_path)
+            crashed.put(USER_ID, 'Комментарий')
+            crashed.put(1234, 'Комментарий')
+            crashed.discard(1234)
+            # Цикл событий в файл не пишет, журнал дописывается из потока БД
+            assert not os.path.exists(journal_path)
+            assert await models.run_in_db(crashed.sync_journal) == 3
+
+            recovered = models.StateBuffer(journal_path=journal_path)
+            assert await models.run_in_db(recovered.recover) == 1
+            assert not os.path.exists(journal_path)
+        with db_session:
+            assert UserState.get(user_id=USER_ID).user_state == 'Комментарий'
+            assert UserState.get(user_id=1234) is None
+
+
+class TestPonyStorage(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncTearDown(self):
+        with db_session:
+            delete(session for session in FSMSession if session.chat == str(USER_ID))
+
+    async def test_session_survives_restart(self):
+        storage = PonyStorage()
+        await storage.set_state(chat=USER_ID, user=USER_ID, state=states.Steps.city_to)
+        await storage.update_data(chat=USER_ID, user=USER_ID, data={'city_from': 'Москва'})
+        with db_session:
+            assert FSMSession.get(chat=str(USER_ID), user=str(USER_ID)) is None
+        assert await storage.flush() == 1
+
+        restarted = PonyStorage()
+        assert await restarted.get_state(chat=USER_ID, user=USER_ID) == 'Steps:city_to'
+        assert await restarted.get_data(chat=USER_ID, user=USER_ID) == {'city_from': 'Москва'}
+
+        await restarted.finish(chat=USER_ID, user=USER_ID)
+        await restarted.close()
+        with db_session:
+            assert FSMSession.get(chat=str(USER_ID), user=str(USER_ID)) is None
+
+    async def test_evicted_dirty_session_is_not_lost(self):
+        storage = PonyStorage(cache_size=1)
+        await storage.set_data(chat=USER_ID, user=USER_ID, data={'sits': '2'})
+        await storage.get_state(chat=USER_ID, user=1234)
+        assert len(storage._cache) == 1
+        with unittest.mock.patch.object(models, 'run_in_db', side_effect=AssertionError('чтение из БД')):
+            assert await storage.get_data(chat=USER_ID, user=USER_ID) == {'sits': '2'}
+            assert await storage.get_data(chat=USER_ID, user=USER_ID) == {'sits': '2'}
+        assert await storage.get_data(chat=USER_ID, user=1234, default={'sits': '1'}) == {'sits': '1'}
+
+
+class TestTicketRenderer(unittest.IsolatedAsyncioTestCase):
+    TICKET_DATA = ('testuser', 'testflight', 6, '88005553535', 'SKILLBOX-AIRLINES')
+
+    def setUp(self):
+        with open(IMAGE_PATH, 'rb') as expected_file:
+            self.expected_bytes = expected_file.read()
+
+    async def test_process_pool(self):
+        renderer = TicketRenderer(workers=1)
+        renderer.start()
+        try:
+            assert await renderer.render(self.TICKET_DATA) == self.expected_bytes
+        finally:
+            renderer.close()
+
+    async def test_timeout_fallback(self):
+        renderer = TicketRenderer(workers=1, timeout=0)
+        renderer.start()
+        try:
+            with self.assertLogs(handlers.log, logging.WARNING):
+                assert await renderer.render(self.TICKET_DATA) == self.expected_bytes
+        finally:
+            renderer.close()
+
+    async def test_slot_is_held_until_pool_task_finishes(self):
+        release = threading.Event()
+
+        def slow_in_pool(*args):
+            if threading.current_thread().name.startswith('pool'):
+                release.wait()
+            return b'ticket'
+
+        renderer = TicketRenderer(queue_size=1, timeout=0.01)
+        with concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='pool') as pool, \
+                unittest.mock.patch('ticket_renderer.render_ticket', slow_in_pool), \
+                self.assertLogs(handlers.log, logging.WARNING):
+            renderer.pool = pool
+            assert await renderer.render(self.TICKET_DATA) == b'ticket'
+            # Билет нарисован в потоке, но задача пула еще идет и занимает место в очереди
+            assert renderer._slots.locked()
+            release.set()
+            await asyncio.wait_for(renderer._slots.acquire(), 1)
+        renderer.pool = None
+
+    async def test_broken_pool_is_restarted_once(self):
+        broken = concurrent.futures.Future()
+        broken.set_exception(BrokenProcessPool())
+        renderer = TicketRenderer(workers=1)
+        renderer.pool = unittest.mock.Mock(submit=unittest.mock.Mock(return_value=broken))
+        with unittest.mock.patch.object(renderer, '_create_pool', return_value='new pool') as create_pool, \
+                self.assertLogs(handlers.log, logging.WARNING):
+            results = await asyncio.gather(*(renderer.render(self.TICKET_DATA) for _ in range(3)))
+        assert results == [self.expected_bytes] * 3
+        create_pool.assert_called_once()
+        assert renderer.pool == 'new pool' and not renderer._slots.locked()
+        renderer.pool = None
+
+    def test_output_formats(self):
+        png = render_ticket(self.TICKET_DATA, 'png')
+        assert png == self.expected_bytes
+        signatures = {'png8': b'\x89PNG', 'jpeg': b'\xff\xd8\xff', 'webp': b'RIFF'}
+        for output_format, signature in signatures.items():
+            encoded = render_ticket(self.TICKET_DATA, output_format, 80)
+            assert encoded.startswith(signature)
+            assert len(encoded) < len(png)
+        # Буфер переиспользуется: после коротких картинок длинный PNG записывается целиком
+        assert render_ticket(self.TICKET_DATA, 'png') == png
+        with pytest.raises(ValueError):
+            TicketRenderer(output_format='gif')
+
+
+class TestTicketCache(unittest.IsolatedAsyncioTestCase):
+    REGISTRATION = {'username': 'testuser', 'chosen_flight': 'testflight', 'sits': 6,
+                    'phone_number': '88005553535'}
+
+    def test_lru_by_size(self):
+        cache = TicketCache(max_bytes=10)
+        cache.put('a', b'12345')
+        cache.put('b', b'12345')
+        assert cache.get('a') == b'12345'
+        cache.put('c', b'123')
+        assert cache.get('b') is None
+        assert cache.get('a') and cache.get('c')
+        assert cache.stats() == {'hits': 3, 'misses': 1, 'evictions': 1, 'file_id_hits': 0,
+                                 'images': 2, 'bytes': 8, 'file_ids': 0}
+
+    async def test_send_ticket_reuses_file_id(self):
+        cache = TicketCache()
+        message_mock = unittest.mock.AsyncMock()
+        message_mock.answer_photo.return_value = SENT_TICKET
+        with unittest.mock.patch('generate_ticket.ticket_cache', cache):
+            await send_ticket(message_mock, self.REGISTRATION)
+            await send_ticket(message_mock, self.REGISTRATION)
+        first, second = message_mock.answer_photo.call_args_list
+        with open(IMAGE_PATH, 'rb') as expected_file:
+            assert first.args[0].read() == expected_file.read()
+        assert second.args == ('big',)
+        assert cache.stats()['file_id_hits'] == 1
+        assert list(cache._file_ids.values()) == ['big']
+
+
+class TestValidators(unittest.IsolatedAsyncioTestCase):
+
+    def test_flight_date(self):
+        assert validators.flight_date(_flight_date) == (True, _flight_datetime)
+        yesterday = datetime.datetime.today() - datetime.timedelta(days=1)
+        assert not validators.flight_date(yesterday.strftime('%d-%m-%Y'))[0]
+        assert not validators.flight_date(_flight_date.replace('-', '.'))[0]
+        assert validators.flight_date('31-02-2030') == (False, None)
+        next_year = datetime.datetime.today() + datetime.timedelta(days=validators.BOOKING_DAYS + 1)
+        assert not validators.flight_date(next_year.strftime('%d-%m-%Y'))[0]
+
+    def test_single_evaluation(self):
+        validate = unittest.mock.Mock(side_effect=validators.choice)
+        validator = validators.StepValidator(validate)
+        message_mock = unittest.mock.Mock(text='3')
+        assert validator.invalid(message_mock) is False
+        assert validator.valid(message_mock) == {'value': '3'}
+        assert validate.call_count == 1
+
+    @isolate_db
+    async def test_dispatcher_passes_value(self):
+        bot = unittest.mock.AsyncMock(Bot)
+        storage = MemoryStorage()
+        dp = Dispatcher(bot, storage=storage)
+        handlers.register_handlers(dp, handlers_config)
+        await storage.set_state(chat=USER_ID, user=USER_ID, state=states.Steps.flight_date)
+        await session.save_session(FSMContext(storage, USER_ID, USER_ID),
+                                   session.BookingSession(city_from='Москва', city_to='Лондон'))
+        update = types.Update(**{'update_id': 1, 'message': {
+            'message_id': 1, 'date': 0, 'text': _flight_date,
+            'chat': {'id': USER_ID, 'type': 'private', 'first_name': USERNAME},
+            'from': {'id': USER_ID, 'is_bot': False, 'first_name': USERNAME}}})
+        Bot.set_current(bot)
+        await dp.process_update(update)
+        assert await storage.get_state(chat=USER_ID, user=USER_ID) == 'Steps:flight_choice'
+        assert list(await storage.get_data(chat=USER_ID, user=USER_ID)) == [session.SESSION_KEY]
+        booking = await session.load_session(FSMContext(storage, USER_ID, USER_ID))
+        assert booking.flight_search == utils.search_start(_flight_datetime)
+
+
+class TestTimetable(unittest.IsolatedAsyncioTestCase):
+
+    async def test_dispatcher_is_deterministic(self):
+        flights = await utils.dispatcher('Москва', 'Екатеринбург', _flight_datetime)
+        assert flights == await utils.dispatcher('Москва', 'Екатеринбург', _flight_datetime)
+        assert len(flights) == 5
+        departures = [datetime.datetime.strptime(flight[0], '%H:%M %d-%m-%Y') for flight in flights]
+        assert departures == sorted(departures)
+        assert departures[0] >= datetime.datetime.strptime(_flight_date, '%d-%m-%Y')
+        assert all(flight[2] == 2 for flight in flights)
+
+    def test_weekday_and_monthday_schedules(self):
+        timetable = Timetable()
+        after = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        for departure in timetable.next_departures('Москва', 'Лондон', after):
+            assert departure.weekday() in (0, 2) and departure.strftime('%H:%M') == '10:00'
+        for departure in timetable.next_departures('Лондон', 'Амстердам', after):
+            assert departure.day in (10, 20) and departure.strftime('%H:%M') == '15:30'
+            assert timetable.has_departure('Лондон', 'Амстердам', departure)
+        assert not timetable.has_departure('Лондон', 'Амстердам', after + datetime.timedelta(minutes=1))
+
+
+class TestFlightCache(unittest.IsolatedAsyncioTestCase):
+
+    def test_ttl_and_size(self):
+        cache = FlightCache(ttl=60, max_entries=2)
+        for day in range(3):
+            cache.put(('Москва', 'Лондон', day), (('10:00', '14:00', 4),))
+        assert cache.get(('Москва', 'Лондон', 0)) is None
+        assert cache.get(('Москва', 'Лондон', 2)) == (('10:00', '14:00', 4),)
+        stats = cache.stats()
+        assert (stats['hits'], stats['misses'], stats['evictions'], stats['entries']) == (1, 1, 1, 2)
+        assert stats['bytes_per_entry'] > 0 and stats['hit_rate'] == 0.5
+
+        expiring = FlightCache(ttl=0)
+        expiring.put('key', ())
+        assert expiring.get('key') is None and expiring.stats()['expirations'] == 1
+
+    async def test_shared_between_users(self):
+        cache = FlightCache()
+        with unittest.mock.patch('utils.flight_cache', cache):
+            flights = await utils.dispatcher('Москва', 'Лондон', _flight_datetime)
+            assert await utils.dispatcher('Москва', 'Лондон', _flight_datetime) is flights
+            booking = session.BookingSession(city_from='Москва', city_to='Лондон', chosen_flight=2,
+                                             flight_search=utils.search_start(_flight_datetime))
+            assert utils.chosen_flight(booking) == utils.format_flight('Москва', 'Лондон', flights[1])
+        assert cache.stats()['hits'] == 2 and cache.stats()['misses'] == 1
+
+
+class TestSession(unittest.IsolatedAsyncioTestCase):
+
+    def test_pack_unpack(self):
+        booking = session.BookingSession(city_from_check=True, city_from='Рио-де-Жанейро', city_to='Москва',
+                                         flight_search=utils.search_start(_flight_datetime), chosen_flight=3,
+                                         sits=2, comment='У окна', phone_number='+79991234567')
+        packed = booking.pack()
+        assert session.BookingSession.unpack(packed) == booking
+        assert len(packed) == session.HEADER.size + len('У окна'.encode()) + len('+79991234567')
+        assert session.BookingSession.unpack(None) == session.BookingSession()
+        assert session.BookingSession.unpack(session.BookingSession().pack()) == session.BookingSession()
+
+    def test_unpack_stale_session(self):
+        packed = session.BookingSession(city_from='Москва', city_to='Лондон', sits=1).pack()
+        # Сессия прежней версии формата и сессия, записанная при другом списке городов
+        assert session.BookingSession.unpack(b'\x01' + packed[1:]) == session.BookingSession()
+        with unittest.mock.patch('session.CITIES_CHECKSUM', session.CITIES_CHECKSUM + 1):
+            assert session.BookingSession.unpack(packed) == session.BookingSession()
+
+    def test_storage_serialization(self):
+        data = {session.SESSION_KEY: session.BookingSession(city_from='Москва').pack()}
+        assert session.dumps(data)[:1] == session.PACKED_PREFIX
+        assert session.loads(session.dumps(data)) == data
+        assert session.loads(session.dumps({'city_from': 'Москва'})) == {'city_from': 'Москва'}
+        assert session.loads(b'{"sits": 2}') == {'sits': 2} and session.loads(b'') == {}
+
+    @isolate_db
+    async def test_pony_storage_restart(self):
+        storage = PonyStorage(dumps=session.dumps, loads=session.loads)
+        booking = session.BookingSession(city_from='Москва', city_to='Лондон', sits=1)
+        await session.save_session(FSMContext(storage, USER_ID, USER_ID), booking)
+        await storage.close()
+        restarted = PonyStorage(dumps=session.dumps, loads=session.loads)
+        assert await session.load_session(FSMContext(restarted, USER_ID, USER_ID)) == booking
+        await restarted.reset_state(chat=USER_ID, user=USER_ID)
+        await restarted.close()
+
+
+class TestExpiry(unittest.IsolatedAsyncioTestCase):
+
+    @isolate_db
+    async def test_sweep_idle_sessions(self):
+        bot = unittest.mock.AsyncMock(Bot)
+        storage = MemoryStorage()
+        dp = Dispatcher(bot, storage=storage)
+        handlers.register_handlers(dp, handlers_config)
+        sweeper = expiry.SessionSweeper(storage, ttl=60, batch_size=1)
+        dp.middleware.setup(expiry.ActivityMiddleware(sweeper))
+        Bot.set_current(bot)
+        for user_id in TEST_USER_IDS:
+            await dp.process_update(types.Update(**{'update_id': user_id, 'message': {
+                'message_id': 1, 'date': 0, 'text': '/ticket',
+                'chat': {'id': user_id, 'type': 'private', 'first_name': USERNAME},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': USERNAME}}}))
+        assert set(sweeper.activity) == {(user_id, user_id) for user_id in TEST_USER_IDS}
+
+        active = TEST_USER_IDS[1]
+        sweeper.touch(active, active, now=sweeper.activity[active, active] + 1000)
+        sessions, rows, freed = await sweeper.sweep(now=sweeper.activity[active, active] - 30)
+        assert (sessions, rows) == (1, 1) and freed > 0
+        assert str(USER_ID) not in storage.data and str(active) in storage.data
+        with db_session:
+            assert UserState.get(user_id=USER_ID) is None and UserState.get(user_id=active) is not None
+        assert sweeper.stats() == {'tracked': 1, 'sessions': 1, 'rows': 1, 'bytes': freed}
+
+        sweeper = expiry.SessionSweeper(storage, ttl=60)
+        assert await sweeper.seed(owns=lambda user_id: user_id in TEST_USER_IDS, now=0) == 1
+        assert await sweeper.sweep(now=61) == (1, 1, sweeper.bytes)
+        assert storage.data == {}
+
+    async def test_sweep_keeps_touched_sessions(self):
+        bot = unittest.mock.AsyncMock(Bot)
+        storage = MemoryStorage()
+        dp = Dispatcher(bot, storage=storage)
+        handlers.register_handlers(dp, handlers_config)
+        sweeper = expiry.SessionSweeper(storage, ttl=60)
+        dp.middleware.setup(expiry.ActivityMiddleware(sweeper))
+        Bot.set_current(bot)
+        for user_id in TEST_USER_IDS:
+            await dp.process_update(types.Update(**{'update_id': user_id, 'message': {
+                'message_id': 1, 'date': 0, 'text': '/ticket',
+                'chat': {'id': user_id, 'type': 'private', 'first_name': USERNAME},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': USERNAME}}}))
+        idle, active = TEST_USER_IDS
+        now = sweeper.activity[active, active] + 1000
+        evict = expiry.evict
+
+        async def evict_and_touch(storage, chat, user):
+            # Пока удаляется первая сессия, приходит сообщение от второго пользователя
+            sweeper.touch(active, active, now=now)
+            return await evict(storage, chat, user)
+
+        with unittest.mock.patch('expiry.evict', evict_and_touch):
+            sessions, rows, freed = await sweeper.sweep(now=now)
+        assert (sessions, rows) == (1, 1) and freed > 0
+        assert list(sweeper.activity) == [(active, active)]
+        assert str(idle) not in storage.data and str(active) in storage.data
+        with db_session:
+            assert UserState.get(user_id=idle) is None and UserState.get(user_id=active) is not None
+
+    async def test_pony_storage_evict(self):
+        storage = PonyStorage()
+        await storage.set_state(chat=USER_ID, user=USER_ID, state=states.Steps.city_to)
+        await storage.flush()
+        assert (await storage.evict(USER_ID, USER_ID))['state'] == 'Steps:city_to'
+        await storage.close()
+        with db_session:
+            assert FSMSession.get(chat=str(USER_ID), user=str(USER_ID)) is None
+        assert await PonyStorage().get_state(chat=USER_ID, user=USER_ID) is None
+
+    async def test_pony_storage_evict_saved_session(self):
+        storage = PonyStorage()
+        await storage.set_state(chat=USER_ID, user=USER_ID, state=states.Steps.city_from)
+        await storage.close()
+        # После перезапуска сессия есть только в БД
+        restarted = PonyStorage()
+        assert (await restarted.evict(USER_ID, USER_ID))['state'] == 'Steps:city_from'
+        assert await restarted.evict(USER_ID, USER_ID) is None
+        assert await restarted.evict(TEST_USER_IDS[1], TEST_USER_IDS[1]) is None
+        assert await restarted.flush() == 1
+        with db_session:
+            assert FSMSession.get(chat=str(USER_ID), user=str(USER_ID)) is None
+
+
+class TestLogPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'bot.log')
+        self.log = logging.getLogger('test_log_pipeline')
+        self.log.propagate = False
+        self.log.setLevel(logging.INFO)
+
+    def tearDown(self):
+        self.log.handlers.clear()
+        self.directory.cleanup()
+
+    def test_json_event(self):
+        pipeline = log_pipeline.LogPipeline(self.path, stream=False)
+        # Остановка не запущенного потока ничего не делает
+        pipeline.stop()
+        pipeline = log_pipeline.LogPipeline(self.path, stream=False)
+        self.log.addHandler(pipeline.handler)
+        pipeline.start()
+        self.log.debug('%r', unittest.mock.Mock(__repr__=unittest.mock.Mock(side_effect=AssertionError)))
+        self.log.info('%s заполнил(а) форму', USERNAME, extra=log_pipeline.event('booking', user_id=USER_ID, sits=2))
+        pipeline.stop()
+        with open(self.path, encoding='utf8') as log_file:
+            lines = [json.loads(line) for line in log_file]
+        assert len(lines) == 1
+        assert lines[0]['message'] == f'{USERNAME} заполнил(а) форму'
+        assert (lines[0]['event'], lines[0]['user_id'], lines[0]['sits']) == ('booking', USER_ID, 2)
+
+    def test_rotation_and_overflow(self):
+        pipeline = log_pipeline.LogPipeline(self.path, queue_size=5, stream=False, max_bytes=200, backup_count=2)
+        self.log.addHandler(pipeline.handler)
+        for index in range(8):
+            self.log.info('Сообщение %s', index)
+        assert pipeline.handler.dropped == 3
+        pipeline.start()
+        pipeline.stop()
+        pipeline.stop()
+        assert not pipeline.started
+        assert os.path.exists(f'{self.path}.1') and not os.path.exists(f'{self.path}.3')
+
+        handler = log_pipeline.RotatingJsonFileHandler(self.path, interval=60)
+        record = logging.LogRecord('test', logging.INFO, __file__, 0, 'Сообщение', None, None)
+        assert not handler.shouldRollover(record)
+        handler.rollover_at = 0
+        assert handler.shouldRollover(record)
+        handler.close()
+
+
+class TestMetrics(unittest.IsolatedAsyncioTestCase):
+
+    async def test_timed(self):
+        registry = metrics.Registry()
+
+        @registry.timed('step')
+        async def step(fail=False):
+            assert registry.timers['step'].in_flight == 1
+            if fail:
+                raise ValueError
+            return 'ok'
+
+        assert await step() == 'ok'
+        with self.assertRaises(ValueError):
+            await step(fail=True)
+        timer = registry.timers['step']
+        assert (timer.count, timer.errors, timer.in_flight) == (2, 1, 0)
+        assert timer.quantile(0.5) == timer.buckets[0]
+
+        registry.add_collector('cache', lambda: {'hits': 3, 'hit_rate': 0.75}, counters=('hits',))
+        text = registry.prometheus()
+        assert 'avia_bot_call_seconds_count{name="step"} 2' in text
+        assert 'avia_bot_call_errors_total{name="step"} 1' in text
+        assert '# TYPE avia_bot_cache_hits_total counter\navia_bot_cache_hits_total 3' in text
+        assert '# TYPE avia_bot_cache_hit_rate gauge\navia_bot_cache_hit_rate 0.75' in text
+        assert registry.summary().startswith('step: 2 выз., ошибок 1')
+        async with TestClient(TestServer(metrics.create_app(registry))) as client:
+            response = await client.get('/metrics')
+            assert response.status == 200 and await response.text() == registry.prometheus()
+
+    async def test_start_server_on_busy_port(self):
+        with socket.socket() as busy:
+            busy.bind(('127.0.0.1', 0))
+            busy.listen()
+            with pytest.raises(OSError):
+                await metrics.start_server('127.0.0.1', busy.getsockname()[1])
+
+    @isolate_db
+    async def test_stats_command_for_admin_only(self):
+        from fake_bot_api import make_update
+        bot = unittest.mock.AsyncMock(Bot)
+        dp = Dispatcher(bot, storage=MemoryStorage())
+        handlers.register_handlers(dp, handlers_config, admin_id=USER_ID)
+        Bot.set_current(bot)
+        with unittest.mock.patch.object(types.Message, 'answer') as answer:
+            await dp.process_update(types.Update(**make_update(1, USER_ID, '/stats')))
+            assert 'handlers.send_stats: 0 выз., ошибок 0, сейчас 1' in answer.call_args.args[0]
+            await dp.process_update(types.Update(**make_update(2, TEST_USER_IDS[1], '/stats')))
+            assert answer.call_args.args[0].startswith('Я бот AirTicketLaggyBot')
+        assert metrics.registry.timers['handlers.send_stats'].count == 1
+        assert metrics.registry.timers['handlers.send_help'].count >= 1
+
+
+class TestLoadTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_full_scenario_offline(self):
+        from benchmarks import load_test
+        test = load_test.LoadTest(users=4, concurrency=4, invalid_rate=0.5, abandon_rate=0, storage_name='memory',
+                                  seed=1)
+        try:
+            _, counts = await test.run()
+        finally:
+            load_test.cleanup(4)
+        assert test.errors == 0 and counts['sendPhoto'] == 4
+        assert len(test.latencies['phone_number']) == 4 and any(step.endswith('_invalid') for step in test.latencies)
+
+
+class TestBenchmarkSuite(unittest.TestCase):
+
+    def test_compare_normalizes_by_reference_and_skips_other_db(self):
+        from benchmarks import suite
+        baseline = {'environment': {'db': 'sqlite'}, 'results': {
+            'reference': {'min': 1.0}, 'utils.dispatcher': {'min': 1.0}, 'validators.city': {'min': 1.0},
+            'models.update_user': {'min': 1.0}}}
+        report = {'environment': {'db': 'postgres'}, 'results': {
+            'reference': {'min': 2.0}, 'utils.dispatcher': {'min': 2.4}, 'validators.city': {'min': 2.6},
+            'models.update_user': {'min': 10.0}, 'city_recognizer.match': {'min': 1.0}}}
+        assert suite.compare(baseline, report, 0.25) == [('validators.city', 2.0, 2.6)]
+
+
+class TestRoutes(unittest.IsolatedAsyncioTestCase):
+
+    def test_route_table_is_symmetric(self):
+        assert routes.flight_time('Москва', 'Екатеринбург') == routes.flight_time('Екатеринбург', 'Москва') == 2
+        assert routes.flight_time('Рио-де-Жанейро', 'Москва') == 14
+        assert routes.flight_time('Москва', 'Москва') is None
+        assert routes.flight_time('Москва', 'Париж') is None
+        assert not routes.has_route('Сен-Тропе', 'Южно-Сахалинск')
+
+    async def test_dispatcher_from_rio(self):
+        flights = await utils.dispatcher('Рио-де-Жанейро', 'Москва', _flight_datetime)
+        assert len(flights) == 5 and flights[0][2] == 14
+
+
+class TestCityRecognizer(unittest.TestCase):
+
+    def test_case_endings_and_lowercase(self):
+        for text, city in (('москвы', 'Москва'), ('в Москву', 'Москва'), ('екатеринбурге', 'Екатеринбург'),
+                           ('афинах', 'Афины'), ('нью йорк', 'Нью-Йорк'), ('в анталию', 'Анталия'),
+                           ('баку', 'Баку'), ('рио-де-жанейро', 'Рио-де-Жанейро')):
+            assert city_recognizer.recognize(text).city == city
+
+    def test_closest_cities(self):
+        recognition = city_recognizer.recognize('Самараа')
+        assert recognition.city is None
+        assert recognition.suggestions[0] == 'Самара' and len(recognition.suggestions) == 5
+        assert recognition.similarity >= city_recognizer.CONFIRMATION_SIMILARITY
+        assert city_recognizer.recognize('Париж').similarity < city_recognizer.CONFIRMATION_SIMILARITY
+
+
+class TestConnections(unittest.IsolatedAsyncioTestCase):
+
+    async def test_connections_without_direct_flight(self):
+        with without_direct_flight('Рио-де-Жанейро', 'Южно-Сахалинск'):
+            flights = await utils.dispatcher('Рио-де-Жанейро', 'Южно-Сахалинск', _flight_datetime)
+        assert len(flights) == 5
+        departures = [datetime.datetime.strptime(flight[0], '%H:%M %d-%m-%Y') for flight in flights]
+        arrivals = [datetime.datetime.strptime(flight[1], '%H:%M %d-%m-%Y') for flight in flights]
+        assert departures == sorted(departures) and arrivals == sorted(arrivals)
+        assert all(arrival - departure >= datetime.timedelta(hours=24)
+                   for departure, arrival in zip(departures, arrivals))
+        assert flights[0][2:] == (23, ('Москва',))
+        # В настоящей таблице между городами есть прямой рейс, и его можно заказать
+        direct = await utils.dispatcher('Рио-де-Жанейро', 'Южно-Сахалинск', _flight_datetime)
+        assert all(flight[2:] == (33, ()) for flight in direct)
+
+    def test_connection_table(self):
+        assert routes.flight_time('Южно-Сахалинск', 'Рио-де-Жанейро') == 33
+        assert not connections.has_connection('Южно-Сахалинск', 'Сен-Тропе')
+        assert not connections.has_connection('Москва', 'Париж')
+        with without_direct_flight('Рио-де-Жанейро', 'Южно-Сахалинск'):
+            assert connections.has_connection('Южно-Сахалинск', 'Рио-де-Жанейро')
+            assert not connections.has_connection('Южно-Сахалинск', 'Сен-Тропе')
+            for path in connections.CONNECTION_TABLE[(routes.CITY_IDS['Рио-де-Жанейро'],
+                                                      routes.CITY_IDS['Южно-Сахалинск'])]:
+                assert 3 <= len(path) <= 4
+
+
+class TestWebhook(unittest.IsolatedAsyncioTestCase):
+
+    async def test_limits(self):
+        app = webhook.create_app(concurrency=2, max_body_size=1024)
+        active = []
+        peak = []
+
+        async def slow_handler(request):
+            await request.read()
+            active.append(request)
+            peak.append(len(active))
+            await asyncio.sleep(0.01)
+            active.remove(request)
+            return web.Response(text='ok')
+
+        app.router.add_post('/', slow_handler)
+        async with TestClient(TestServer(app)) as client:
+            responses = await asyncio.gather(*(client.post('/', data=b'{}') for _ in range(6)))
+            assert [response.status for response in responses] == [200] * 6
+            assert max(peak) == 2
+            response = await client.post('/', data=b'x' * 2048)
+            assert response.status == 413
+
+    @unittest.skipIf(importlib.util.find_spec('aresponses') is None, 'нужен пакет aresponses')
+    async def test_fake_bot_api(self):
+        from fake_bot_api import FakeBotAPI, make_update
+
+        bot = Bot(token='123456:ABCDEF')
+        dp = Dispatcher(bot, storage=MemoryStorage())
+        handlers.register_handlers(dp, handlers_config)
+        app = webhook.create_app()
+        configure_app(dp, app, WEBHOOK_PATH)
+        try:
+            async with FakeBotAPI() as api, TestClient(TestServer(app)) as client:
+                response = await client.post(WEBHOOK_PATH, json=make_update(1, USER_ID, '/help'))
+                assert response.status == 200
+                assert api.counts['sendMessage'] == 1
+                assert 'AirTicketLaggyBot' in api.calls[0][1]['text']
+        finally:
+            await (await bot.get_session()).close()
+
+
+class CrashingBot(Bot):
+    """Бот, с которым процесс-обработчик падает, не успев сообщить о готовности"""
+
+    def __init__(self, *args, **kwargs):
+        os._exit(3)
+
+
+class TestSharding(unittest.IsolatedAsyncioTestCase):
+
+    def test_chat_affinity(self):
+        update = {'update_id': 1, 'message': {'chat': {'id': USER_ID}, 'from': {'id': 1}}}
+        assert sharding.update_chat_id(update) == USER_ID
+        assert sharding.update_chat_id({'update_id': 2, 'callback_query': {'from': {'id': 7}}}) == 7
+        assert sharding.shard_for(USER_ID, 4) == sharding.shard_for(USER_ID, 4)
+        assert set(sharding.shard_for(chat_id, 4) for chat_id in range(100)) == {0, 1, 2, 3}
+
+    async def test_shared_dict_storage(self):
+        records = {}
+        storage = SharedDictStorage(records)
+        await storage.set_state(chat=USER_ID, user=USER_ID, state=states.Steps.city_from)
+        await storage.update_data(chat=USER_ID, user=USER_ID, data={'city_from': 'Москва'})
+        assert records[f'{USER_ID}:{USER_ID}'] == {'state': 'Steps:city_from', 'data': {'city_from': 'Москва'},
+                                                   'bucket': {}}
+        assert await SharedDictStorage(records).get_data(chat=USER_ID, user=USER_ID) == {'city_from': 'Москва'}
+        await storage.finish(chat=USER_ID, user=USER_ID)
+        assert records == {}
+
+    def test_supervisor(self):
+        from fake_bot_api import OfflineBot, make_update
+
+        supervisor = sharding.Supervisor(2, '123456:ABCDEF', storage_name='shared', bot_class=OfflineBot)
+        supervisor.start()
+        try:
+            for update_id in range(10):
+                supervisor.dispatch(make_update(update_id, USER_ID + update_id, '/help'))
+        finally:
+            processed = supervisor.close()
+        assert processed == 10
+
+    def test_worker_crash_on_start(self):
+        supervisor = sharding.Supervisor(2, '123456:ABCDEF', storage_name='memory', bot_class=CrashingBot)
+        with pytest.raises(sharding.WorkerDied, match='коды выхода: \\[3, 3\\]'):
+            supervisor.start()
+        assert not any(process.is_alive() for process in supervisor.processes)
+
+    def test_dead_worker_is_restarted(self):
+        from fake_bot_api import OfflineBot, make_update
+
+        supervisor = sharding.Supervisor(1, '123456:ABCDEF', storage_name='memory', bot_class=OfflineBot)
+        supervisor.start()
+        try:
+            supervisor.processes[0].kill()
+            supervisor.processes[0].join()
+            with self.assertLogs(handlers.log, logging.ERROR):
+                supervisor.dispatch(make_update(1, USER_ID, '/help'))
+            supervisor.dispatch(make_update(2, USER_ID, '/help'))
+        finally:
+            processed = supervisor.close()
+        assert processed == 2 and supervisor.restarts == 1
+
+    async def test_dispatch_does_not_block_loop(self):
+        from fake_bot_api import make_update
+
+        supervisor = sharding.Supervisor(1, '123456:ABCDEF', storage_name='memory')
+        supervisor.queues = [queue.Queue(maxsize=1)]
+        supervisor.processes = [unittest.mock.Mock(**{'is_alive.return_value': True})]
+        await supervisor.dispatch_async(make_update(1, USER_ID, '/help'))
+        # Полная очередь процесса: webhook сразу отвечает 503, Telegram повторит доставку
+        async with TestClient(TestServer(sharding.create_front_app(supervisor))) as client:
+            started = time.monotonic()
+            response = await client.post(WEBHOOK_PATH, json=make_update(2, USER_ID, '/help'))
+            assert response.status == 503 and time.monotonic() - started < 1
+
+        def restart(index):
+            time.sleep(0.3)
+            supervisor.queues[index] = queue.Queue(maxsize=2)
+            supervisor.processes[index] = unittest.mock.Mock(**{'is_alive.return_value': True})
+
+        async def tick():
+            while True:
+                await asyncio.sleep(0.01)
+                ticks.append(1)
+
+        # Упавший процесс перезапускается в потоке один раз, цикл событий в это время работает
+        ticks = []
+        supervisor.processes[0].is_alive.return_value = False
+        ticker = asyncio.create_task(tick())
+        with unittest.mock.patch.object(supervisor, '_restart', side_effect=restart) as restart_mock:
+            await asyncio.gather(supervisor.dispatch_async(make_update(3, USER_ID, '/help')),
+                                 supervisor.dispatch_async(make_update(4, USER_ID, '/help')))
+        ticker.cancel()
+        assert restart_mock.call_count == 1 and supervisor.queues[0].qsize() == 2
+        assert len(ticks) >= 10
+
+
+class TestOutbound(unittest.IsolatedAsyncioTestCase):
+
+    def test_token_bucket(self):
+        bucket = outbound.TokenBucket(rate=2, capacity=2, now=0)
+        bucket.take(0)
+        bucket.take(0)
+        assert bucket.delay(0) == 0.5
+        assert bucket.delay(0.5) == 0
+        bucket.block(0.5, 3)
+        assert bucket.delay(1) == 2.5
+
+    async def test_priority_and_chat_limit(self):
+        scheduler = outbound.OutboundScheduler(global_rate=1000, global_burst=1000, chat_rate=20, chat_burst=1)
+        sent = []
+
+        def call(name):
+            async def send():
+                sent.append(name)
+                return name
+            return send
+
+        results = await asyncio.gather(
+            scheduler.send(1, call('рассылка'), outbound.BULK),
+            scheduler.send(2, call('ответ 1'), outbound.INTERACTIVE),
+            scheduler.send(2, call('ответ 2'), outbound.INTERACTIVE),
+        )
+        await scheduler.close()
+        assert results == ['рассылка', 'ответ 1', 'ответ 2']
+        # Второй ответ в тот же чат ждет свою корзину, рассылка в другой чат уходит раньше
+        assert sent == ['ответ 1', 'рассылка', 'ответ 2']
+        assert scheduler.stats()['sent'] == 3 and scheduler.stats()['queue_depth'] == 0
+
+    async def test_retry_after(self):
+        scheduler = outbound.OutboundScheduler()
+        attempts = []
+
+        async def send():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise outbound.RetryAfter(0.05)
+            return 'ok'
+
+        assert await scheduler.send(USER_ID, send) == 'ok'
+        await scheduler.close()
+        assert len(attempts) == 2 and scheduler.stats()['retries'] == 1
+        assert scheduler.stats()['wait_max'] >= 0.05
+        # 429 останавливает отправку во все чаты, а не только в тот, где он получен
+        assert scheduler.global_bucket.blocked_until == scheduler.chat_buckets[USER_ID].blocked_until > 0
+
+    async def test_retry_after_for_cancelled_send(self):
+        scheduler = outbound.OutboundScheduler(max_retries=0)
+        started = asyncio.Event()
+        answer = asyncio.Event()
+
+        async def send():
+            started.set()
+            await answer.wait()
+            raise outbound.RetryAfter(1)
+
+        waiting = asyncio.create_task(scheduler.send(USER_ID, send))
+        await started.wait()
+        sending = list(scheduler._sending)
+        waiting.cancel()
+        answer.set()
+        await asyncio.gather(*sending)
+        await scheduler.close()
+        assert scheduler.stats()['failed'] == 1
+
+    async def test_scheduled_bot(self):
+        bot = outbound.ScheduledBot(token='123456:ABCDEF')
+        with unittest.mock.patch.object(Bot, 'request', return_value={'ok': True}) as request:
+            with outbound.priority(outbound.BULK):
+                await bot.request('sendMessage', {'chat_id': USER_ID, 'text': 'Бот запущен'})
+            await bot.request('getMe')
+        await bot.scheduler.close()
+        assert request.await_count == 2 and bot.scheduler.stats()['sent'] == 1
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,85 @@
+import hashlib
+from collections import OrderedDict
+
+from config import TICKET_CACHE_BYTES, TICKET_FILE_ID_CACHE_SIZE
+
+FIELD_SEPARATOR = '\x1f'
+
+
+def ticket_key(ticket_data):
+    """Ключ билета - хэш отрисовываемых полей, одинаковые билеты получают один ключ"""
+    payload = FIELD_SEPARATOR.join(str(field) for field in ticket_data)
+    return hashlib.sha256(payload.encode('utf8')).hexdigest()
+
+
+class TicketCache:
+    """Кэш отрисованных билетов по содержимому.
+
+    PNG хранятся в LRU, суммарный размер которого не больше max_bytes. Отдельно запоминается
+    file_id загруженной в Telegram картинки, чтобы повторно отправлять билет без загрузки.
+    """
+
+    def __init__(self, max_bytes=TICKET_CACHE_BYTES, max_file_ids=TICKET_FILE_ID_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.max_file_ids = max_file_ids
+        self._images = OrderedDict()
+        self._file_ids = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.file_id_hits = 0
+
+    def get(self, key):
+        """PNG билета или None"""
+        png = self._images.get(key)
+        if png is None:
+            self.misses += 1
+            return None
+        self._images.move_to_end(key)
+        self.hits += 1
+        return png
+
+    def put(self, key, png):
+        if len(png) > self.max_bytes:
+            return
+        previous = self._images.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous)
+        self._images[key] = png
+        self.size += len(png)
+        while self.size > self.max_bytes:
+            _, evicted = self._images.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def file_id(self, key):
+        """file_id уже загруженного в Telegram билета или None"""
+        file_id = self._file_ids.get(key)
+        if file_id is not None:
+            self._file_ids.move_to_end(key)
+            self.file_id_hits += 1
+        return file_id
+
+    def remember_file_id(self, key, file_id):
+        self._file_ids[key] = file_id
+        self._file_ids.move_to_end(key)
+        if len(self._file_ids) > self.max_file_ids:
+            self._file_ids.popitem(last=False)
+
+    def forget_file_id(self, key):
+        self._file_ids.pop(key, None)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'file_id_hits': self.file_id_hits,
+            'images': len(self._images),
+            'bytes': self.size,
+            'file_ids': len(self._file_ids),
+        }
+
+
+ticket_cache = TicketCache()
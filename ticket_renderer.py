@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from io import BytesIO
+
+from PIL import Image, ImageDraw, ImageFont
+
+import metrics
+from config import TICKET_FORMAT, TICKET_QUALITY, TICKET_QUEUE_SIZE, TICKET_RENDER_TIMEOUT, TICKET_WORKERS
+
+log = logging.getLogger('avia_ticket_bot')
+
+TEMPLATE_PATH = 'files/ticket_base.png'
+IMAGE_PATH = 'files/aviaticket_example.png'
+
+SECTION_FONT_PATH = 'files/Verdanab.ttf'
+SECTION_FONT_SIZE = 14
+DATA_FONT_PATH = 'files/Verdana.ttf'
+DATA_FONT_SIZE = 14
+
+BLACK = (0, 0, 0, 255)
+SECTION_OFFSETS = ((35, 100), (35, 160), (35, 240), (35, 300), (300, 100))
+DATA_OFFSETS = ((35, 120), (35, 180), (35, 260), (35, 320), (300, 120))
+
+SECTIONS_TO_DRAW = (
+    'Имя пассажира:',
+    'Рейс:',
+    'Количество мест:',
+    'Телефон для подтверждения:',
+    'Перевозчик:'
+)
+
+OUTPUT_FORMATS = ('png', 'png8', 'jpeg', 'webp')
+
+_buffers = threading.local()
+
+
+@lru_cache(maxsize=None)
+def _fonts():
+    """Шрифты загружаются с диска один раз"""
+    return (ImageFont.truetype(SECTION_FONT_PATH, SECTION_FONT_SIZE),
+            ImageFont.truetype(DATA_FONT_PATH, DATA_FONT_SIZE))
+
+
+@lru_cache(maxsize=None)
+def _base_image():
+    """Шаблон билета с уже нарисованными подписями разделов"""
+    img = Image.open(TEMPLATE_PATH).convert('RGBA')
+    section_font, _ = _fonts()
+    draw = ImageDraw.Draw(img)
+    for offset, text in zip(SECTION_OFFSETS, SECTIONS_TO_DRAW):
+        draw.text(xy=offset, text=text, fill=BLACK, font=section_font)
+    return img
+
+
+def warm_up():
+    """Загрузка шаблона и шрифтов заранее, в том числе в процессах пула"""
+    _base_image()
+
+
+def _encode_buffer():
+    """Буфер для сжатия, свой в каждом потоке, переиспользуется между билетами"""
+    buffer = getattr(_buffers, 'buffer', None)
+    if buffer is None:
+        buffer = _buffers.buffer = BytesIO()
+    buffer.seek(0)
+    return buffer
+
+
+def encode(img, output_format=TICKET_FORMAT, quality=TICKET_QUALITY):
+    """Сжатие картинки в один из OUTPUT_FORMATS, возвращает bytes"""
+    buffer = _encode_buffer()
+    if output_format == 'png':
+        img.save(buffer, 'png')
+    elif output_format == 'png8':
+        img.quantize(colors=256, method=Image.FASTOCTREE).save(buffer, 'png', optimize=True)
+    elif output_format == 'jpeg':
+        img.convert('RGB').save(buffer, 'jpeg', quality=quality, optimize=True)
+    elif output_format == 'webp':
+        img.save(buffer, 'webp', quality=quality)
+    else:
+        raise ValueError(f'Неизвестный формат билета: {output_format}')
+    # Буфер не обрезается, чтобы не перевыделять память: берем только записанную часть
+    size = buffer.tell()
+    with buffer.getbuffer() as view, view[:size] as encoded:
+        return encoded.tobytes()
+
+
+def render_ticket(ticket_data, output_format=TICKET_FORMAT, quality=TICKET_QUALITY):
+    """Отрисовка данных билета поверх готового шаблона, возвращает картинку в bytes"""
+    img = _base_image().copy()
+    _, data_font = _fonts()
+    draw = ImageDraw.Draw(img)
+
+    for offset, text in zip(DATA_OFFSETS, ticket_data):
+        draw.text(xy=offset, text=str(text), fill=BLACK, font=data_font)
+
+    return encode(img, output_format, quality)
+
+
+class TicketRenderer:
+    """Отрисовка билетов в пуле процессов, чтобы Pillow не блокировал цикл событий.
+
+    Одновременно в пуле не больше queue_size билетов, остальные запросы ждут свободного места.
+    Место освобождается, только когда задача пула завершена или отменена. Если пул не запущен,
+    сломался или не уложился в timeout секунд, билет рисуется в потоке, сломанный пул
+    перезапускается один раз, сколько бы запросов ни заметили поломку.
+    """
+
+    def __init__(self, workers=TICKET_WORKERS, queue_size=TICKET_QUEUE_SIZE, timeout=TICKET_RENDER_TIMEOUT,
+                 output_format=TICKET_FORMAT, quality=TICKET_QUALITY):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f'Неизвестный формат билета: {output_format}')
+        self.workers = workers
+        self.output_format = output_format
+        self.quality = quality
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.pool = None
+        self._slots = asyncio.Semaphore(queue_size)
+        self._restart_lock = asyncio.Lock()
+        # Меняется при каждом запуске и остановке пула: перезапуск нужен, только если пул не сменился
+        self._generation = 0
+
+    def _create_pool(self):
+        pool = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_up)
+        for future in [pool.submit(warm_up) for _ in range(self.workers)]:
+            future.result()
+        return pool
+
+    def start(self):
+        self._generation += 1
+        self.pool = self._create_pool()
+
+    def close(self):
+        self._generation += 1
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pool = None
+
+    async def _restart(self, generation):
+        """Замена сломанного пула, если его еще не заменил другой запрос; билеты пока рисуются в потоках"""
+        async with self._restart_lock:
+            if generation != self._generation or self.pool is None:
+                return
+            log.warning('Пул процессов отрисовки билетов сломан, перезапускаем')
+            self._generation += 1
+            generation = self._generation
+            broken, self.pool = self.pool, None
+            await asyncio.to_thread(broken.shutdown, wait=True, cancel_futures=True)
+            pool = await asyncio.to_thread(self._create_pool)
+            if generation == self._generation:
+                self.pool = pool
+            else:
+                # Пока пул запускался, рендерер остановили
+                pool.shutdown(wait=False, cancel_futures=True)
+
+    def _release(self, loop):
+        """Освобождение места в очереди из потока пула, когда его задача завершилась"""
+        try:
+            loop.call_soon_threadsafe(self._slots.release)
+        except RuntimeError:
+            # Цикл событий уже закрыт, ждать места некому
+            pass
+
+    @metrics.timed()
+    async def render(self, ticket_data):
+        """Картинка билета в bytes в формате output_format"""
+        args = tuple(ticket_data), self.output_format, self.quality
+        if self.pool is None:
+            return await asyncio.to_thread(render_ticket, *args)
+
+        await self._slots.acquire()
+        pool, generation = self.pool, self._generation
+        if pool is None:
+            self._slots.release()
+            return await asyncio.to_thread(render_ticket, *args)
+        try:
+            task = pool.submit(render_ticket, *args)
+        except BrokenProcessPool:
+            self._slots.release()
+            await self._restart(generation)
+            return await asyncio.to_thread(render_ticket, *args)
+        loop = asyncio.get_running_loop()
+        task.add_done_callback(lambda _: self._release(loop))
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(task)), self.timeout)
+        except asyncio.TimeoutError:
+            # Задача, которая еще ждет в очереди пула, снимается, начатая держит место до завершения
+            task.cancel()
+            log.warning('Билет не отрисован в пуле процессов за %s с, рисуем в потоке', self.timeout)
+        except BrokenProcessPool:
+            await self._restart(generation)
+        return await asyncio.to_thread(render_ticket, *args)
+
+
+renderer = TicketRenderer()
@@ -0,0 +1,98 @@
+import datetime
+from array import array
+from bisect import bisect_left
+
+from config import DEFAULT_SCHEDULE, FLIGHT_SCHEDULES, TIMETABLE_HORIZON_DAYS
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MINUTE = datetime.timedelta(minutes=1)
+MINUTES_IN_DAY = 24 * 60
+
+FLIGHT_DATE_FORMAT = '%H:%M %d-%m-%Y'
+
+
+def to_minutes(moment):
+    """Перевод datetime в минуты от EPOCH"""
+    return (moment - EPOCH) // MINUTE
+
+
+def from_minutes(minutes):
+    """Перевод минут от EPOCH обратно в datetime"""
+    return EPOCH + datetime.timedelta(minutes=minutes)
+
+
+def _schedule_key(schedule):
+    """Неизменяемый ключ расписания, одинаковые расписания разворачиваются один раз"""
+    times = tuple(sorted(int(hours) * 60 + int(minutes)
+                         for hours, minutes in (time.split(':') for time in schedule['times'])))
+    return (tuple(sorted(schedule.get('weekdays', ()))),
+            tuple(sorted(schedule.get('monthdays', ()))),
+            times)
+
+
+class Timetable:
+    """Периодическое расписание рейсов, заранее развернутое в отсортированные массивы вылетов"""
+
+    def __init__(self, schedules=None, default_schedule=None, horizon_days=TIMETABLE_HORIZON_DAYS):
+        self.schedules = FLIGHT_SCHEDULES if schedules is None else schedules
+        self.default_schedule = DEFAULT_SCHEDULE if default_schedule is None else default_schedule
+        self.horizon_days = horizon_days
+        self.start_date = None
+        self._departures = {}
+        self._route_departures = {}
+        self._default_departures = array('q')
+
+    def build(self, start_date):
+        """Разворачивание всех расписаний на horizon_days дней начиная с start_date"""
+        start = datetime.datetime.combine(start_date, datetime.time())
+        start_minutes = to_minutes(start)
+        days = [start + datetime.timedelta(days=offset) for offset in range(self.horizon_days)]
+
+        departures = {}
+        route_departures = {}
+        for route, schedule in self.schedules.items():
+            key = _schedule_key(schedule)
+            if key not in departures:
+                departures[key] = self._expand(key, days, start_minutes)
+            route_departures[route] = departures[key]
+        default_key = _schedule_key(self.default_schedule)
+        if default_key not in departures:
+            departures[default_key] = self._expand(default_key, days, start_minutes)
+
+        self._departures = departures
+        self._route_departures = route_departures
+        self._default_departures = departures[default_key]
+        self.start_date = start_date
+
+    @staticmethod
+    def _expand(key, days, start_minutes):
+        weekdays, monthdays, times = key
+        expanded = array('q')
+        for offset, day in enumerate(days):
+            if day.weekday() in weekdays or day.day in monthdays:
+                day_minutes = start_minutes + offset * MINUTES_IN_DAY
+                expanded.extend(day_minutes + time for time in times)
+        return expanded
+
+    def departures(self, city_from, city_to):
+        """Отсортированный массив вылетов (в минутах от EPOCH) по направлению"""
+        today = datetime.date.today()
+        if self.start_date != today:
+            self.build(today)
+        return self._route_departures.get((city_from, city_to), self._default_departures)
+
+    def next_departures(self, city_from, city_to, after, count=5):
+        """Ближайшие count вылетов не раньше момента after"""
+        departures = self.departures(city_from, city_to)
+        index = bisect_left(departures, to_minutes(after))
+        return [from_minutes(minutes) for minutes in departures[index:index + count]]
+
+    def has_departure(self, city_from, city_to, departure):
+        """Проверка, что рейс с таким временем вылета есть в расписании"""
+        departures = self.departures(city_from, city_to)
+        minutes = to_minutes(departure)
+        index = bisect_left(departures, minutes)
+        return index < len(departures) and departures[index] == minutes
+
+
+timetable = Timetable()
@@ -1,25 +1,72 @@
 import datetime
-from random import randrange, randint
 
-from config import CITIES_AND_FLIGHT_TIME as SFT
+import connections
+import metrics
+import routes
+from flight_cache import flight_cache
+from timetable import timetable, from_minutes, to_minutes, FLIGHT_DATE_FORMAT
+
+NUMBER_OF_FLIGHTS = 5
+
+
+def search_start(chosen_date):
+    """Начало поиска в минутах от EPOCH: на вчера купить билет нельзя, ищем не раньше текущей минуты"""
+    return to_minutes(max(chosen_date, datetime.datetime.now()))
 
 
 async def dispatcher(city_from, city_to, chosen_date):
-    flights = []
-    number_of_flights = 5
+    """Ближайшие рейсы начиная с даты chosen_date (datetime), для тестов и бенчмарков.
+    Обработчики ищут через flights_after, время поиска измеряет таймер _search"""
+    return flights_after(city_from, city_to, search_start(chosen_date))
 
-    flight_time = SFT[city_from].get(city_to) if SFT[city_from].get(city_to) else SFT[city_to].get(city_from)
 
-    for _ in range(number_of_flights):
-        departure_time = datetime.datetime.strptime(chosen_date, '%d-%m-%Y') + datetime.timedelta(hours=randint(0, 72))
-        departure_time = departure_time.replace(minute=randrange(0, 60, 10))
-        departure_time_str = departure_time.strftime('%H:%M %d-%m-%Y')
+def flights_after(city_from, city_to, after_minutes):
+    """Ближайшие рейсы не раньше after_minutes, результат поиска общий для всех пользователей"""
+    key = (city_from, city_to, after_minutes)
+    flights = flight_cache.get(key)
+    if flights is None:
+        flights = _search(city_from, city_to, from_minutes(after_minutes))
+        flight_cache.put(key, flights)
+    return flights
 
-        arrival_time = departure_time + datetime.timedelta(hours=flight_time)
-        arrival_time_str = arrival_time.strftime('%H:%M %d-%m-%Y')
 
-        flights.append((departure_time_str, arrival_time_str, flight_time))
+def chosen_flight(session):
+    """Текст выбранного рейса по сессии заказа: маршрут, начало поиска и номер варианта"""
+    flights = flights_after(session.city_from, session.city_to, session.flight_search)
+    return format_flight(session.city_from, session.city_to, flights[session.chosen_flight - 1])
 
-    flights = sorted(flights, key=lambda d: datetime.datetime.strptime(d[0], '%H:%M %d-%m-%Y'))
 
-    return flights
+def format_flight(city_from, city_to, flight):
+    departure, arrival, flight_time, transfers = flight
+    text = f'{city_from} {departure} - {city_to} {arrival}\nчасов в полете - {flight_time}'
+    if transfers:
+        text += f'\nпересадки: {", ".join(transfers)}'
+    return text
+
+
+@metrics.timed()
+def _search(city_from, city_to, after):
+    flight_time = routes.flight_time(city_from, city_to)
+    if flight_time is None:
+        return _connections(city_from, city_to, after, NUMBER_OF_FLIGHTS)
+    duration = datetime.timedelta(hours=flight_time)
+
+    flights = []
+    for departure_time in timetable.next_departures(city_from, city_to, after, NUMBER_OF_FLIGHTS):
+        arrival_time = departure_time + duration
+        flights.append((departure_time.strftime(FLIGHT_DATE_FORMAT), arrival_time.strftime(FLIGHT_DATE_FORMAT),
+                        flight_time, ()))
+
+    return tuple(flights)
+
+
+def _connections(city_from, city_to, after, number_of_flights):
+    """Рейсы с пересадками в том же виде, что и прямые, с городами пересадок в последнем поле"""
+    flights = []
+    for departure, arrival, path in connections.plan(city_from, city_to, after, number_of_flights):
+        transfers = tuple(routes.CITIES[city_id] for city_id in path[1:-1])
+        flight_time = sum(routes.flight_time_by_id(*leg) for leg in zip(path, path[1:]))
+        flights.append((from_minutes(departure).strftime(FLIGHT_DATE_FORMAT),
+                        from_minutes(arrival).strftime(FLIGHT_DATE_FORMAT),
+                        flight_time, transfers))
+    return tuple(flights)
@@ -0,0 +1,76 @@
+import re
+from datetime import datetime, timedelta
+
+import city_recognizer
+
+DATE_PATTERN = re.compile(r'(\d{1,2})-(\d{1,2})-(\d{4})')
+PHONE_PATTERN = re.compile(r'^(\d{3})\D?(\d{3})\D?(\d{4})\D?(\d*)$')
+CHOICES = frozenset(str(number) for number in range(1, 6))
+# На сколько дней вперед продаются билеты
+BOOKING_DAYS = 365
+
+
+# Проверки ввода на шагах сценария: возвращают (ввод корректен, разобранное значение)
+
+def city(text):
+    recognition = city_recognizer.recognize(text)
+    return recognition.city is not None, recognition
+
+
+def flight_date(text):
+    """Дата в формате 05-11-2021 не раньше текущего момента и не дальше BOOKING_DAYS дней"""
+    match = DATE_PATTERN.fullmatch(text)
+    if match is None:
+        return False, None
+    day, month, year = map(int, match.groups())
+    try:
+        date = datetime(year, month, day)
+    except ValueError:
+        return False, None
+    today = datetime.today()
+    return today <= date < today + timedelta(days=BOOKING_DAYS), date
+
+
+def choice(text):
+    return text in CHOICES, text
+
+
+def comment(text):
+    return bool(text), text
+
+
+def confirmation(text):
+    return text.title() == 'Да', text
+
+
+def phone_number(text):
+    match = PHONE_PATTERN.match(text)
+    return match is not None, match
+
+
+class StepValidator:
+    """Проверка ввода на шаге сценария, общая для пары обработчиков (корректный и некорректный ввод).
+
+    Сообщение разбирается один раз, фильтры valid и invalid берут готовый результат
+    и передают разобранное значение в обработчик аргументом value.
+    """
+
+    def __init__(self, validate):
+        self.validate = validate
+        self._message = None
+        self._result = None
+        self.valid = self._filter(True)
+        self.invalid = self._filter(False)
+
+    def check(self, message):
+        if message is not self._message:
+            self._result = self.validate(message.text or '')
+            self._message = message
+        return self._result
+
+    def _filter(self, expected):
+        def message_filter(message):
+            is_valid, value = self.check(message)
+            return {'value': value} if is_valid == expected else False
+
+        return message_filter
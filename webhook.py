@@ -0,0 +1,22 @@
+import asyncio
+
+from aiohttp import web
+
+from config import WEBHOOK_CONCURRENCY, WEBHOOK_MAX_BODY_SIZE
+
+
+def concurrency_limit(limit):
+    """Middleware: одновременно обрабатывается не больше limit запросов, остальные ждут очереди"""
+    slots = asyncio.Semaphore(limit)
+
+    @web.middleware
+    async def middleware(request, handler):
+        async with slots:
+            return await handler(request)
+
+    return middleware
+
+
+def create_app(concurrency=WEBHOOK_CONCURRENCY, max_body_size=WEBHOOK_MAX_BODY_SIZE):
+    """Приложение aiohttp для webhook: запросы больше max_body_size байт отклоняются с кодом 413"""
+    return web.Application(client_max_size=max_body_size, middlewares=[concurrency_limit(concurrency)])